@@ -22,6 +22,9 @@ SKIP_NEED_FILE = "Test requires file {0}"
 
 PKG_DIR = path.dirname(path.dirname(__file__))
 TESTS_DIR = path.dirname(__file__)
+# Loading timestreams stores their image index, and tests write to them, so
+# tests use a fresh copy of the fixtures in data/timestreams.
+TS_DIR = path.join(TESTS_DIR, "data", "tmp", "timestreams")
 
 FILES = {
     "basic_jpg": path.join(TESTS_DIR, "data", "cam_images", "IMG_0001.JPG"),
@@ -36,18 +39,12 @@ FILES = {
                                  "IMG_0001-tiff-exif.json"),
     "empty_dir": path.join(TESTS_DIR, "data", "empty_dir"),
     "tmp_dir": path.join(TESTS_DIR, "data", "tmp"),
-    "timestream": path.join(TESTS_DIR, "data", "timestreams",
-                            "good-timestream"),
-    "timestream_bad": path.join(TESTS_DIR, "data", "timestreams",
-                                "bad-timestream-good-images"),
-    "timestream_gaps": path.join(TESTS_DIR, "data", "timestreams",
-                                 "timestream-with-gaps"),
-    "timestream_datafldr": path.join(TESTS_DIR, "data", "timestreams",
-                                     "timestream-with-data-folder"),
-    "timestream_imgdata": path.join(TESTS_DIR, "data", "timestreams",
-                                    "timestream-with-imgdata"),
-    "not_a_timestream": path.join(TESTS_DIR, "data", "timestreams",
-                                  "not-a-timestream"),
+    "timestream": path.join(TS_DIR, "good-timestream"),
+    "timestream_bad": path.join(TS_DIR, "bad-timestream-good-images"),
+    "timestream_gaps": path.join(TS_DIR, "timestream-with-gaps"),
+    "timestream_datafldr": path.join(TS_DIR, "timestream-with-data-folder"),
+    "timestream_imgdata": path.join(TS_DIR, "timestream-with-imgdata"),
+    "not_a_timestream": path.join(TS_DIR, "not-a-timestream"),
 }
 ZEROS_PIXELS = np.zeros((100, 100, 3), dtype="uint8")
 ZEROS_DATETIME = datetime.datetime(2013, 11, 12, 20, 53, 9)
@@ -97,7 +94,7 @@ TS_STR = """TimeStream called good-timestream
 	interval: 1800
 """.format(FILES["timestream"])
 
-TS_FILES_JPG = [path.join(TESTS_DIR, "data", x) for x in TS_FILES_JPG]
+TS_FILES_JPG = [path.join(path.dirname(TS_DIR), x) for x in TS_FILES_JPG]
 
 TS_FILES = TS_FILES_JPG
 TS_DATES = [
@@ -130,6 +127,10 @@ if path.exists(FILES["empty_dir"]):
     shutil.rmtree(FILES["empty_dir"])
 os.mkdir(FILES["empty_dir"])
 
+if path.exists(TS_DIR):
+    shutil.rmtree(TS_DIR)
+shutil.copytree(path.join(TESTS_DIR, "data", "timestreams"), TS_DIR)
+
 NUM_TEMPS = 0
 
 
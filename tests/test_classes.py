@@ -13,19 +13,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cv2
 import datetime as dt
 from inspect import (
     isgenerator,
 )
+import json
 import numpy as np
+import os
 from os import path
 import shutil
 from unittest import TestCase
 
 from tests import helpers
+import timestream
 from timestream import (
     TimeStream,
     TimeStreamImage,
+    TimeStreamTraverser,
 )
 from timestream.parse import (
     ts_format_date,
@@ -33,6 +38,12 @@ from timestream.parse import (
 from timestream.parse.validate import (
     TS_MANIFEST_KEYS,
 )
+from timestream.util.imgio import (
+    DECODERS,
+    PIXEL_CACHE,
+    read_image,
+    register_decoder,
+)
 
 
 class TestTimeStreamStr(TestCase):
@@ -225,6 +236,104 @@ class TestTimeStreamImageClone(TestCase):
         self.assertEqual(cpy.path, img.path)
 
 
+class TestTimeStreamImagePixelsAt(TestCase):
+
+    """Test TimeStreamImage().pixels_at()"""
+
+    def test_pixels_at(self):
+        """Test JPEGs are decoded downscaled, and cached"""
+        img = TimeStreamImage()
+        img.path = helpers.TS_FILES_JPG[0]
+        quarter = img.pixels_at(4)
+        self.assertIsNone(img._pixels)
+        self.assertEqual(quarter.shape, (9, 13, 3))
+        self.assertIs(img.pixels_at(4), quarter)
+        # Close to the whole image downscaled
+        full = img.pixels.astype(float)
+        self.assertAlmostEqual(quarter.mean(), full.mean(), delta=2)
+        self.assertIs(img.pixels_at(1), img.pixels)
+        with self.assertRaises(ValueError):
+            img.pixels_at(3)
+
+    def test_pixels_at_set(self):
+        """Test pixels that are set are downscaled"""
+        img = TimeStreamImage()
+        img.path = helpers.TS_FILES_JPG[0]
+        img.pixels_at(2)
+        img.pixels = np.ones((40, 30, 3), dtype="uint8")
+        np.testing.assert_array_equal(img.pixels_at(2),
+                                      np.ones((20, 15, 3)))
+
+
+class TestTimeStreamImageChannelOrder(TestCase):
+
+    """Test the channel order of TimeStreamImage().pixels"""
+
+    def setUp(self):
+        PIXEL_CACHE.clear()
+        ts = TimeStream()
+        ts.decoder = "opencv"
+        self.img = TimeStreamImage()
+        self.img.parent_timestream = ts
+        self.img.path = helpers.TS_FILES_JPG[0]
+
+    def test_native_order(self):
+        """Test pixels from OpenCV are kept BGR, and converted to RGB once"""
+        img = self.img
+        bgr = cv2.imread(img.path)
+        self.assertEqual(img.channel_order, "BGR")
+        self.assertIs(img.pixels_as("BGR"), img._pixels)
+        self.assertIs(img.pixels_as(None), img._pixels)
+        np.testing.assert_array_equal(img.pixels_as("BGR"), bgr)
+        rgb = img.pixels
+        self.assertTrue(rgb.flags.c_contiguous)
+        np.testing.assert_array_equal(rgb, bgr[:, :, ::-1])
+        # The converted pixels are those held from then on
+        self.assertIs(img.pixels, rgb)
+        self.assertIs(img.pixels_as(None), rgb)
+        self.assertEqual(img.channel_order, "RGB")
+        half = img.pixels_at(2, "BGR")
+        self.assertIs(img.pixels_at(2, None), half)
+        np.testing.assert_array_equal(img.pixels_at(2), half[:, :, ::-1])
+        with self.assertRaises(ValueError):
+            img.pixels_as("GRB")
+
+    def test_edit_write(self):
+        """Test changes to converted pixels are written"""
+        img = self.img
+        self.assertEqual(img.channel_order, "BGR")
+        img.pixels[0:10, 0:10] = 0
+        np.testing.assert_array_equal(img.pixels_as("BGR")[0:10, 0:10], 0)
+        fpath = helpers.make_tmp_file() + ".png"
+        try:
+            img.write(fpath)
+            self.assertEqual(img.channel_order, "BGR")
+            np.testing.assert_array_equal(cv2.imread(fpath)[0:10, 0:10], 0)
+        finally:
+            os.remove(fpath)
+
+    def test_set_pixels(self):
+        """Test pixels set in either order are written the same"""
+        blue = np.zeros((10, 10, 3), dtype="uint8")
+        blue[:, :, 0] = 255
+        img = TimeStreamImage()
+        img.set_pixels(blue, "BGR")
+        self.assertEqual(img.channel_order, "BGR")
+        self.assertListEqual(img.pixels[0, 0].tolist(), [0, 0, 255])
+        fpath = helpers.make_tmp_file() + ".png"
+        try:
+            img.write(fpath)
+            np.testing.assert_array_equal(cv2.imread(fpath), blue)
+            img.pixels = blue[:, :, ::-1]
+            self.assertEqual(img.channel_order, "RGB")
+            img.write(fpath, overwrite=True)
+            np.testing.assert_array_equal(cv2.imread(fpath), blue)
+        finally:
+            os.remove(fpath)
+        with self.assertRaises(ValueError):
+            img.set_pixels(blue, None)
+
+
 class TestTimeStreamIterByFiles(TestCase):
 
     """Test TimeStream().iter_by_files()"""
@@ -303,6 +412,132 @@ class TestTimeStreamIterByTimepoints(TestCase):
             # will fail above, or be a problem in our data files which should
             # change the date and make the previous statement fail.
 
+    def test_iter_by_timepoints_prefetch(self):
+        """Test TimeStream().iter_by_timepoints, decoding images ahead"""
+        ts = TimeStream()
+        ts.load(helpers.FILES["timestream_gaps"])
+        res = ts.iter_by_timepoints(remove_gaps=False, prefetch=2)
+        self.assertTrue(isgenerator(res))
+        for iii, image in enumerate(res):
+            self.assertEqual(image.datetime, helpers.TS_DATES_PARSED[iii])
+            if iii in {3, 5}:
+                self.assertEqual(0, len(image.pixels))
+                continue
+            self.assertIsNotNone(image._pixels)
+            self.assertEqual(image.pixels.shape, helpers.TS_JPG_SHAPE)
+        self.assertEqual(iii, 6)
+
+    def test_iter_by_timepoints_prefetch_error(self):
+        """Test errors decoding images ahead are raised at their image"""
+        bad = helpers.TS_DATES[2]
+
+        def decode(fpath):
+            if bad in fpath:
+                raise RuntimeError("Can't decode {}".format(fpath))
+            return read_image(fpath, "opencv")
+        register_decoder("failing", decode, ["jpg"])
+        PIXEL_CACHE.clear()
+        try:
+            ts = TimeStream()
+            ts.load(helpers.FILES["timestream"])
+            ts.decoder = "failing"
+            res = ts.iter_by_timepoints(prefetch=3)
+            for iii in range(2):
+                self.assertEqual(next(res).datetime,
+                                 helpers.TS_DATES_PARSED[iii])
+            with self.assertRaises(RuntimeError):
+                next(res)
+        finally:
+            del DECODERS["failing"]
+
+    def test_iter_by_timepoints_prefetch_truncated(self):
+        """Test truncated images decoded ahead raise at their image"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            ts_path = path.join(tmp_path, "good-timestream")
+            shutil.copytree(helpers.FILES["timestream"], ts_path)
+            fpath = helpers.TS_FILES_JPG[2].replace(
+                helpers.FILES["timestream"], ts_path)
+            with open(fpath, "rb") as fh:
+                head = fh.read(400)
+            with open(fpath, "wb") as fh:
+                fh.write(head)
+            PIXEL_CACHE.clear()
+            ts = TimeStream()
+            ts.load(ts_path)
+            res = ts.iter_by_timepoints(prefetch=3)
+            for iii in range(2):
+                self.assertEqual(next(res).pixels.shape,
+                                 helpers.TS_JPG_SHAPE)
+            with self.assertRaises(IOError):
+                next(res)
+        finally:
+            shutil.rmtree(tmp_path)
+
+
+class TestTimeStreamTraverser(TestCase):
+
+    """Test TimeStreamTraverser"""
+    dates = helpers.TS_GAPS_DATES_PARSED
+
+    def setUp(self):
+        self.tst = TimeStreamTraverser(helpers.FILES["timestream_gaps"])
+
+    def test_step(self):
+        """Test TimeStreamTraverser next and prev, with wrap-around"""
+        self.assertEqual(len(self.tst), len(self.dates))
+        self.assertEqual(self.tst.curr().datetime, self.dates[0])
+        self.assertEqual(self.tst.next().datetime, self.dates[1])
+        self.assertEqual(self.tst.next().datetime, self.dates[2])
+        self.assertEqual(self.tst.prev().datetime, self.dates[1])
+        self.assertEqual(self.tst.prev().datetime, self.dates[0])
+        self.assertEqual(self.tst.prev().datetime, self.dates[-1])
+        self.assertEqual(self.tst.next().datetime, self.dates[0])
+
+    def test_cache(self):
+        """Test going back to images already seen doesn't decode them"""
+        cache = self.tst.pixel_cache
+        self.assertGreater(cache.max_bytes, 0)
+        pixels = self.tst.curr().pixels
+        self.tst.next().pixels
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        np.testing.assert_array_equal(self.tst.prev().pixels, pixels)
+        self.tst.next().pixels
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(PIXEL_CACHE.max_bytes, 0)
+
+    def test_seek(self):
+        """Test TimeStreamTraverser.seek"""
+        img = self.tst.seek(dt.datetime(2013, 10, 30, 4, 30))
+        self.assertEqual(img.datetime, self.dates[3])
+        self.assertEqual(self.tst.next().datetime, self.dates[4])
+        img = self.tst.seek("2013_10_30_03_30_00")
+        self.assertEqual(img.datetime, self.dates[1])
+        img = self.tst.seek(dt.datetime(2014, 1, 1))
+        self.assertEqual(img.datetime, self.dates[-1])
+
+    def test_nearest(self):
+        """Test TimeStreamTraverser.nearest"""
+        img = self.tst.nearest(dt.datetime(2013, 10, 30, 4, 20))
+        self.assertEqual(img.datetime, self.dates[2])
+        img = self.tst.nearest(dt.datetime(2013, 10, 30, 4, 40),
+                               tolerance=dt.timedelta(minutes=20))
+        self.assertEqual(img.datetime, self.dates[3])
+        self.assertIsNone(self.tst.nearest(dt.datetime(2013, 10, 30, 4, 30),
+                                           tolerance=60))
+        # A failed lookup doesn't move
+        self.assertEqual(self.tst.curr().datetime, self.dates[3])
+
+    def test_between(self):
+        """Test TimeStreamTraverser.between"""
+        res = [img.datetime for img in
+               self.tst.between(dt.datetime(2013, 10, 30, 3, 30),
+                                dt.datetime(2013, 10, 30, 5, 0))]
+        self.assertListEqual(res, self.dates[1:4])
+        res = [img.datetime for img in self.tst.between()]
+        self.assertListEqual(res, self.dates)
+        self.assertEqual(self.tst.curr().datetime, self.dates[0])
+
 
 class TestTimeStreamCreate(TestCase):
 
@@ -361,6 +596,89 @@ class TestTimeStreamWrite(TestCase):
             self.assertDictEqual(img.data, ts.image_data[str_date])
             self.assertTrue(path.exists, img.path)
 
+    def test_timestream_write_index(self):
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg")
+        for date in helpers.TS_DATES_PARSED:
+            img = TimeStreamImage()
+            img.pixels = np.zeros((10, 10, 3), dtype="uint8")
+            img.datetime = date
+            ts.write_image(img)
+            self.assertTrue(ts.has_image(date))
+        # The image index should be persisted, and give the correct manifest
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertEqual(loaded.interval, helpers.TS_DICT_PARSED["interval"])
+        for date in helpers.TS_DATES_PARSED:
+            self.assertTrue(loaded.has_image(date))
+        self.assertFalse(loaded.has_image(dt.datetime(2010, 10, 10)))
+
+    def test_timestream_write_journal(self):
+        """Test metadata is journalled, compacted and loaded from both"""
+        compact = timestream.TS_JOURNAL_COMPACT
+        timestream.TS_JOURNAL_COMPACT = 3
+        try:
+            ts = TimeStream()
+            ts.create(self.tmp_path, ext="jpg")
+            for iii, date in enumerate(helpers.TS_DATES_PARSED[:4]):
+                img = TimeStreamImage()
+                img.pixels = np.zeros((10, 10, 3), dtype="uint8")
+                img.datetime = date
+                img.data["n"] = iii
+                ts.write_image(img)
+        finally:
+            timestream.TS_JOURNAL_COMPACT = compact
+        # The first three are in the snapshot, the last in the journal
+        with open(ts.image_db_path) as db_fh:
+            self.assertEqual(len(json.load(db_fh)), 3)
+        with open(ts.journal_path) as jnl_fh:
+            self.assertEqual(len(jnl_fh.readlines()), 1)
+        # As left by an interrupted write
+        with open(ts.journal_path, "a") as jnl_fh:
+            jnl_fh.write('["2013_')
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertEqual(len(loaded.image_data), 4)
+        for iii, date in enumerate(helpers.TS_DATES[:4]):
+            self.assertEqual(loaded.image_data[date], {"n": iii})
+        loaded.close()
+        self.assertFalse(path.exists(loaded.journal_path))
+        with open(loaded.image_db_path) as db_fh:
+            self.assertEqual(len(json.load(db_fh)), 4)
+
+    def test_timestream_batch(self):
+        """Test metadata is only written when a write session commits"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg")
+        with ts.batch(every=3) as batch:
+            self.assertTrue(ts.in_batch)
+            with self.assertRaises(RuntimeError):
+                ts.batch()
+            for iii, date in enumerate(helpers.TS_DATES_PARSED[:4]):
+                img = TimeStreamImage()
+                img.pixels = np.zeros((10, 10, 3), dtype="uint8")
+                img.datetime = date
+                ts.write_image(img)
+                ts.write_metadata()
+                self.assertEqual(path.exists(ts.db_path), iii >= 2)
+            self.assertTrue(path.exists(ts.journal_path))
+            ts.data["foo"] = "bar"
+            batch.commit()
+            self.assertFalse(path.exists(ts.journal_path))
+            ts.data["foo"] = "baz"
+        self.assertFalse(ts.in_batch)
+        with open(ts.db_path) as db_fh:
+            self.assertEqual(json.load(db_fh)["foo"], "baz")
+        with open(ts.image_db_path) as db_fh:
+            self.assertEqual(len(json.load(db_fh)), 4)
+        # close() commits a session too
+        ts.batch()
+        ts.data["foo"] = "qux"
+        ts.close()
+        self.assertFalse(ts.in_batch)
+        with open(ts.db_path) as db_fh:
+            self.assertEqual(json.load(db_fh)["foo"], "qux")
+
     def tearDown(self):
         try:
             shutil.rmtree(self.tmp_path)
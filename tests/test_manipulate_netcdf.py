@@ -0,0 +1,56 @@
+import netCDF4
+import numpy as np
+import os
+from unittest import TestCase
+
+from tests import helpers
+from tests import test_parse_tsnc
+from timestream.manipulate.netcdf import (
+    ts_to_tsnc,
+)
+from timestream.parse import (
+    ts_iter_numpy,
+)
+from timestream.parse.tsnc import (
+    TimeStreamNetCDF,
+)
+
+
+class TestTsToTsnc(TestCase):
+
+    """Test timestream.manipulate.netcdf.ts_to_tsnc"""
+
+    def setUp(self):
+        self.fname = helpers.make_tmp_file() + ".nc"
+        self.frames = np.array(
+            [mat for _, mat in ts_iter_numpy(helpers.TS_FILES_JPG)])
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def _check(self):
+        tsnc = TimeStreamNetCDF(self.fname)
+        self.assertListEqual(list(tsnc), helpers.TS_DATES_PARSED)
+        for time, frame in zip(helpers.TS_DATES_PARSED, self.frames):
+            np.testing.assert_array_equal(tsnc.read(time), frame)
+        tsnc.close()
+
+    def test_convert(self):
+        """Test converting a v1 timestream"""
+        count = ts_to_tsnc(helpers.FILES["timestream"], self.fname,
+                           threads=2)
+        self.assertEqual(count, len(helpers.TS_DATES_PARSED))
+        self._check()
+
+    def test_resume_legacy(self):
+        """Test resuming a file written before image data was stored"""
+        test_parse_tsnc.make_tsnc(self.fname, self.frames[:3],
+                                  helpers.TS_DATES_PARSED[:3])
+        # The pixels of a frame whose time was never written
+        root = netCDF4.Dataset(self.fname, "a")
+        root.variables["pixel"][3, :, :, :] = self.frames[5]
+        root.close()
+        count = ts_to_tsnc(helpers.FILES["timestream"], self.fname,
+                           threads=2)
+        self.assertEqual(count, len(helpers.TS_DATES_PARSED) - 3)
+        self._check()
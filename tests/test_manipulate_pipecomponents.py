@@ -0,0 +1,285 @@
+import csv
+import cv2
+import datetime as dt
+import numpy as np
+import os
+from os import path
+import shutil
+import time
+from unittest import TestCase
+
+from tests import helpers
+import timestream
+from timestream import TimeStreamImage
+from timestream.manipulate.configuration import PCFGSection
+import timestream.manipulate.correct_detect as cd
+import timestream.manipulate.pipecomponents as tm_pc
+from timestream.manipulate.pipecomponents import (
+    ColorCardDetector,
+    PlantExtractor,
+    PotDetector,
+    ResultingFeatureWriter_csv,
+    ResultingFeatureWriter_ndarray,
+    TrayDetector,
+)
+from timestream.manipulate.pot import (
+    ImagePotHandler,
+    ImagePotMatrix,
+    ImagePotRectangle,
+)
+from timestream.util import imgio
+
+
+def make_image(time, features, metaids={}):
+    """Make an image with pots having ``features``, by pot id"""
+    img = TimeStreamImage(dt=time)
+    img.pixels = np.zeros((20, 20, 3), dtype=np.uint8)
+    img.ipm = ImagePotMatrix(img)
+    for potId, feats in features.items():
+        rect = ImagePotRectangle([0, 0, 5, 5], img.pixels.shape)
+        pot = ImagePotHandler(potId, rect, img.ipm, metaids=metaids)
+        pot.getCalcedFeatures().update(feats)
+        img.ipm.addPot(pot)
+    return img
+
+
+class TestResultingFeatureWriterNdarray(TestCase):
+
+    """Test writing features to an npz file"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        os.mkdir(self.tmp_path)
+        self.outputfile = path.join(self.tmp_path, "features")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_write(self):
+        """Test features are only exported on close"""
+        context = PCFGSection("--")
+        writer = ResultingFeatureWriter_ndarray(context,
+                                                outputfile=self.outputfile)
+        times = [dt.datetime(2014, 6, 1, 12, i) for i in range(3)]
+        features = [
+            {1: {"area": 1.0, "perimeter": 2.0}, 2: {"area": 3.0,
+                                                     "perimeter": 4.0}},
+            {1: {"area": 5.0, "perimeter": 6.0}, 2: {"area": 7.0,
+                                                     "perimeter": 8.0}},
+            {1: {"area": 9.0, "roundness": 0.5}},
+        ]
+        for when, feats in zip(times, features):
+            img = make_image(when, feats)
+            context.setVal("origImg", img)
+            self.assertIs(writer(context, img), img)
+        self.assertFalse(path.exists(self.outputfile + ".npz"))
+        writer.close()
+        self.assertFalse(path.exists(self.outputfile + ".featmat"))
+
+        npz = np.load(self.outputfile + ".npz")
+        # In the order features were first seen
+        fNames = npz["fNames"].tolist()
+        self.assertListEqual(sorted(fNames[:2]), ["area", "perimeter"])
+        self.assertEqual(fNames[2], "roundness")
+        self.assertListEqual(npz["pIds"].tolist(), [1, 2])
+        self.assertListEqual(npz["tStamps"].tolist(),
+                             [time.mktime(x.timetuple()) * 1000
+                              for x in times])
+        featMat = npz["featMat"]
+        self.assertEqual(featMat.shape, (3, 2, 3))
+        order = [fNames.index(x) for x in ("area", "perimeter", "roundness")]
+        featMat = featMat[order]
+        np.testing.assert_array_equal(featMat[:, :, 1], [[5, 7], [6, 8],
+                                                         [0, 0]])
+        np.testing.assert_array_equal(featMat[:, :, 2], [[9, 0], [0, 0],
+                                                         [0.5, 0]])
+
+
+class TestResultingFeatureWriterCsv(TestCase):
+
+    """Test writing features to csv files"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        self.times = [dt.datetime(2014, 6, 1, 12, i) for i in range(2)]
+        self.stamps = ["%f" % (time.mktime(x.timetuple()) * 1000)
+                       for x in self.times]
+        self.features = [
+            {2: {"area": 1.0}, 1: {"area": 2.0}},
+            {2: {"area": 3.0}, 1: {"area": 4.0}},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def _write(self, metaids={"trayID": 7}, **kwargs):
+        context = PCFGSection("--")
+        writer = ResultingFeatureWriter_csv(context, outputdir=self.tmp_path,
+                                            **kwargs)
+        for when, feats in zip(self.times, self.features):
+            img = make_image(when, feats, metaids=metaids)
+            context.setVal("origImg", img)
+            writer(context, img)
+        return writer
+
+    def test_buffered(self):
+        """Test rows are buffered until there are flushrows of them"""
+        writer = self._write(flushrows=3)
+        outputfile = path.join(self.tmp_path, "area.csv")
+        self.assertEqual(path.getsize(outputfile), 0)
+        writer.close()
+        with open(outputfile) as ifh:
+            self.assertListEqual(ifh.read().splitlines(), [
+                "timestamp,1,2",
+                self.stamps[0] + ",2.000000,1.000000",
+                self.stamps[1] + ",4.000000,3.000000",
+            ])
+        writer = self._write(flushrows=2, overwrite=True)
+        with open(outputfile) as ifh:
+            self.assertEqual(len(ifh.readlines()), 3)
+        writer.close()
+
+    def test_long_format(self):
+        """Test writing all features to one long format file"""
+        writer = self._write(longformat="features.csv")
+        writer.close()
+        with open(path.join(self.tmp_path, "features.csv")) as ifh:
+            self.assertListEqual(ifh.read().splitlines(), [
+                "timestamp,potId,metaids,feature,value",
+                self.stamps[0] + ",1,trayID=7,area,2.000000",
+                self.stamps[0] + ",2,trayID=7,area,1.000000",
+                self.stamps[1] + ",1,trayID=7,area,4.000000",
+                self.stamps[1] + ",2,trayID=7,area,3.000000",
+            ])
+
+    def test_long_format_quoting(self):
+        """Test metaids needing quoting, and the file name given"""
+        metaids = {"trayID": "a,b", "note": "c;d\ne"}
+        writer = self._write(metaids=metaids, longformat="features.txt")
+        writer.close()
+        with open(path.join(self.tmp_path, "features.txt"), "rb") as ifh:
+            rows = list(csv.reader(ifh))
+        self.assertEqual(len(rows), 5)
+        self.assertListEqual(rows[1][:2], [self.stamps[0], "1"])
+        mids, = csv.reader([rows[1][2]], delimiter=";")
+        self.assertListEqual(mids, ["note=c;d\ne", "trayID=a,b"])
+
+
+def make_bgr():
+    """A smooth BGR image, which templates cut out of it match"""
+    rand = np.random.RandomState(1)
+    img = cv2.GaussianBlur(rand.randint(0, 256, (240, 320, 3)).astype(
+        np.float32), (0, 0), 4)
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+class TestColorCardDetector(TestCase):
+
+    """Test images are decoded once at half scale to find colour cards"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        os.mkdir(self.tmp_path)
+        self.fpath = path.join(self.tmp_path, "image.jpg")
+        cv2.imwrite(self.fpath, make_bgr())
+        card = cv2.imread(self.fpath)[40:88, 48:120]
+        cv2.imwrite(path.join(self.tmp_path, "card.png"), card)
+        self.trueColors, _ = cd.getColorcardColors(card[:, :, ::-1],
+                                                   GridSize=[6, 4])
+        self.scales = []
+        self.decode_image = imgio.decode_image
+        imgio.decode_image = self._decode
+
+    def tearDown(self):
+        imgio.decode_image = self.decode_image
+        shutil.rmtree(self.tmp_path)
+
+    def _decode(self, fpath, decoder=None, scale=1):
+        self.scales.append(scale)
+        return self.decode_image(fpath, decoder, scale)
+
+    def _detect(self, **kwargs):
+        context = PCFGSection("--")
+        context.setVal("ints.path", self.tmp_path)
+        detector = ColorCardDetector(
+            context, mess="Cards", colorcardTrueColors=self.trueColors,
+            colorcardFile="card.png", colorcardPosition=[84, 64],
+            settingPath=".", **kwargs)
+        tsi = TimeStreamImage(dt=dt.datetime(2014, 6, 1, 12))
+        tsi.path = self.fpath
+        return detector(context, tsi)[1]
+
+    def test_found(self):
+        """Test the image is only decoded in full to extract the card"""
+        params = self._detect(minIntensity=10)
+        self.assertIsNotNone(params[0])
+        self.assertListEqual(self.scales, [2, 1])
+
+    def test_dark(self):
+        """Test dark images are only decoded at half scale"""
+        self.assertListEqual(self._detect(minIntensity=255),
+                             [None, None, None])
+        self.assertListEqual(self.scales, [2])
+
+
+class TestChannelOrder(TestCase):
+
+    """Test the pixels are converted once through tray, pot and plant
+    detection"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        os.mkdir(self.tmp_path)
+        self.bgr = make_bgr()
+        # The tray and pot templates are cut out of the image
+        cv2.imwrite(path.join(self.tmp_path, "tray_00.png"),
+                    self.bgr[56:184, 96:224])
+        cv2.imwrite(path.join(self.tmp_path, "pot.png"),
+                    self.bgr[104:136, 144:176])
+        self.conversions = 0
+        self.convert_order = tm_pc.convert_order
+        tm_pc.convert_order = timestream.convert_order = self._count
+
+    def tearDown(self):
+        tm_pc.convert_order = timestream.convert_order = self.convert_order
+        shutil.rmtree(self.tmp_path)
+
+    def _count(self, pixels, src, dst):
+        converted = self.convert_order(pixels, src, dst)
+        if converted is not pixels:
+            self.conversions += 1
+        return converted
+
+    def _run(self, order):
+        context = PCFGSection("--")
+        context.setVal("ints.path", self.tmp_path)
+        context.setVal("outputwithimage", {})
+        components = [
+            TrayDetector(context, mess="Trays", trayFiles="tray_%02d.png",
+                         trayNumber=1, trayPositions=[[160, 120]],
+                         settingPath="."),
+            PotDetector(context, mess="Pots", potFile="pot.png",
+                        potTemplateFile="pot.png", potPositions=[],
+                        potSize=[32, 24], traySize=[128, 128],
+                        settingPath="."),
+            PlantExtractor(context, meth="method1"),
+        ]
+        tsi = TimeStreamImage(dt=dt.datetime(2014, 6, 1, 12))
+        tsi.set_pixels(self.bgr if order == "BGR" else self.bgr[:, :, ::-1],
+                       order)
+        res = [tsi]
+        for component in components:
+            res = component(context, *res)
+        self.assertListEqual(components[0].trayLocs, [(160, 120)])
+        self.assertEqual(len(list(tsi.ipm.iter_through_pots())), 20)
+        self.assertEqual(tsi.channel_order, "RGB")
+
+    def test_bgr(self):
+        """Test BGR pixels are only converted to RGB for segmenting"""
+        self._run("BGR")
+        self.assertEqual(self.conversions, 1)
+
+    def test_rgb(self):
+        """Test RGB pixels are only converted for matching trays"""
+        self._run("RGB")
+        self.assertEqual(self.conversions, 1)
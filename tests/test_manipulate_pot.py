@@ -0,0 +1,99 @@
+import cPickle
+import numpy as np
+from unittest import TestCase
+
+from timestream import TimeStreamImage
+from timestream.manipulate.plantSegmenter import PotSegmenter
+from timestream.manipulate.pot import (
+    ImagePotHandler,
+    ImagePotMatrix,
+    ImagePotRectangle,
+    PackedMask,
+)
+
+
+class EmptySegmenter(PotSegmenter):
+
+    """Segments nothing, as with a bad segmentation"""
+
+    def segment(self, img, hints):
+        return np.zeros(img.shape[0:2], dtype=np.uint8), hints
+
+
+class TestPackedMask(TestCase):
+
+    """Test timestream.manipulate.pot.PackedMask"""
+
+    def _check(self, mask):
+        packed = PackedMask(mask)
+        unpacked = packed.unpack()
+        self.assertEqual(unpacked.dtype, np.uint8)
+        np.testing.assert_array_equal(unpacked, mask != 0)
+        np.testing.assert_array_equal(np.asarray(packed), mask != 0)
+        self.assertEqual(packed.any(), mask.any())
+        return packed
+
+    def test_dense(self):
+        """Test a noisy mask is bit-packed"""
+        mask = np.random.RandomState(0).rand(101, 53) > 0.5
+        packed = self._check(mask.astype(np.float64))
+        self.assertIsNotNone(packed._bits)
+        self.assertEqual(packed.nbytes, (101 * 53 + 7) // 8)
+
+    def test_sparse(self):
+        """Test a sparse mask is run-length encoded"""
+        mask = np.zeros((200, 300), dtype=np.uint8)
+        mask[50:60, 100:120] = 1
+        packed = self._check(mask)
+        self.assertIsNotNone(packed._runs)
+        self.assertEqual(packed.nbytes, 20 * 4)
+        # Starting with the mask set, and empty
+        self._check(1 - mask)
+        self._check(np.zeros((200, 300)))
+        # As passed between processes
+        packed = cPickle.loads(cPickle.dumps(packed, cPickle.HIGHEST_PROTOCOL))
+        np.testing.assert_array_equal(packed.unpack(), mask)
+
+
+class TestImagePotHandlerMask(TestCase):
+
+    """Test masks of ImagePotHandler"""
+
+    def setUp(self):
+        self.img = TimeStreamImage()
+        self.img.pixels = np.zeros((40, 40, 3), dtype=np.uint8)
+
+    def _pot(self, ipm, rect, ps=None):
+        rect = ImagePotRectangle(rect, self.img.pixels.shape)
+        pot = ImagePotHandler(1, rect, ipm, ps=ps)
+        ipm.addPot(pot)
+        return pot
+
+    def test_set_mask(self):
+        """Test setting masks, which resets features"""
+        pot = self._pot(ImagePotMatrix(self.img), [0, 0, 10, 5])
+        np.testing.assert_array_equal(pot.mask, np.zeros((5, 10)))
+        mask = np.eye(5, 10)
+        pot.getCalcedFeatures()["area"] = 5.0
+        pot.mask = mask
+        self.assertDictEqual(pot.getCalcedFeatures(), {})
+        self.assertIsInstance(pot.packedMask, PackedMask)
+        np.testing.assert_array_equal(pot.mask, mask)
+        pot.mask = PackedMask(1 - mask)
+        np.testing.assert_array_equal(pot.mask, 1 - mask)
+        with self.assertRaises(TypeError):
+            pot.mask = [[1]]
+
+    def test_prev_mask(self):
+        """Test falling back to the previous pot's mask, fit to size"""
+        ipmPrev = ImagePotMatrix(self.img)
+        prev = self._pot(ipmPrev, [0, 0, 6, 4])
+        prevMask = np.arange(24).reshape((4, 6)) % 3 == 0
+        prev.mask = prevMask
+        ipm = ImagePotMatrix(self.img, ipmPrev=ipmPrev)
+        pot = self._pot(ipm, [0, 0, 3, 7], ps=EmptySegmenter())
+        # Padded 2 rows above and 1 below, cropped by 2 columns left and 1
+        # right
+        expect = np.zeros((7, 3), dtype=np.uint8)
+        expect[2:6] = prevMask[:, 2:5]
+        np.testing.assert_array_equal(pot.mask, expect)
@@ -2,17 +2,29 @@ import datetime as dt
 from inspect import (
     isgenerator,
 )
+import json
 import os
+from os import path
+import shutil
 from unittest import TestCase
 
 from tests import helpers
 from timestream.parse import (
+    TimeStreamIndex,
+    ts_load_index,
     ts_guess_manifest,
     all_files_with_ext,
     all_files_with_exts,
+    iter_date_range,
     ts_iter_images,
     ts_get_image,
+    ts_get_images,
+    ts_get_manifest,
+    ts_timepoint_grid,
+    ts_format_date,
     ts_parse_date,
+    ts_parse_date_path,
+    ts_parse_dates,
 )
 
 
@@ -45,6 +57,13 @@ class TestAllFilesWithExt(TestCase):
         res = list(res)
         self.assertListEqual(res, helpers.TS_FILES_JPG)
 
+    def test_with_timestream_threads(self):
+        for threads in [1, 2, 16]:
+            res = all_files_with_ext(helpers.FILES["timestream"], "jpg",
+                                     threads=threads)
+            self.assertTrue(isgenerator(res))
+            self.assertListEqual(list(res), helpers.TS_FILES_JPG)
+
     def test_with_timestream_ext_xyz(self):
         res = all_files_with_ext(helpers.FILES["timestream"], "xyz")
         self.assertTrue(isgenerator(res))
@@ -123,6 +142,139 @@ class TestGuessManifest(TestCase):
         self.assertTrue(isinstance(got, dict))
         self.assertDictEqual(got, helpers.TS_DICT)
 
+    def test_empty_dir(self):
+        with self.assertRaises(ValueError):
+            ts_guess_manifest(helpers.FILES["empty_dir"])
+
+
+class TestTimeStreamIndex(TestCase):
+
+    """Tests for timestream.parse.TimeStreamIndex and ts_load_index"""
+    _multiprocess_can_split_ = True
+    maxDiff = None
+
+    def test_build_good_ts(self):
+        """Test building a TimeStreamIndex of a good timestream"""
+        index = TimeStreamIndex(helpers.FILES["timestream"])
+        index.build()
+        self.assertEqual(len(index), len(helpers.TS_DATES))
+        self.assertListEqual(index.timestamps, helpers.TS_DATES)
+        self.assertListEqual(list(index), helpers.TS_DATES_PARSED)
+        self.assertDictEqual(index.manifest, helpers.TS_DICT)
+
+    def test_contains_with_gaps(self):
+        """Test TimeStreamIndex membership on a timestream with gaps"""
+        index = TimeStreamIndex(helpers.FILES["timestream_gaps"])
+        index.build()
+        for date in helpers.TS_DATES_PARSED:
+            expect = date in helpers.TS_GAPS_DATES_PARSED
+            self.assertEqual(date in index, expect)
+            self.assertEqual(ts_format_date(date) in index, expect)
+
+    def test_load_index_roundtrip(self):
+        """Test ts_load_index stores an index that can be read back"""
+        built = ts_load_index(helpers.FILES["timestream"], rebuild=True)
+        loaded = TimeStreamIndex(helpers.FILES["timestream"])
+        self.assertTrue(loaded.load())
+        self.assertListEqual(loaded.timestamps, built.timestamps)
+        self.assertDictEqual(loaded.manifest, built.manifest)
+
+    def test_add(self):
+        """Test TimeStreamIndex.add keeps order and manifest up to date"""
+        index = TimeStreamIndex(helpers.FILES["empty_dir"])
+        for date in reversed(helpers.TS_DATES_PARSED):
+            index.add(date)
+        self.assertListEqual(index.timestamps, helpers.TS_DATES)
+        self.assertEqual(index.manifest["start_datetime"],
+                         helpers.TS_DICT["start_datetime"])
+        self.assertEqual(index.manifest["end_datetime"],
+                         helpers.TS_DICT["end_datetime"])
+        self.assertEqual(index.manifest["interval"],
+                         helpers.TS_DICT["interval"])
+
+    def test_daily_interval(self):
+        """Test intervals of a day or more aren't taken modulo a day"""
+        dates = [dt.datetime(2014, 6, d, 12) for d in (1, 2, 4)]
+        index = TimeStreamIndex(helpers.FILES["empty_dir"])
+        for date in dates:
+            index.add(date)
+        self.assertEqual(index.manifest["interval"], 86400)
+        index._set_timestamps(ts_format_date(x) for x in dates)
+        self.assertEqual(index.manifest["interval"], 86400)
+
+    def test_refresh(self):
+        """Test TimeStreamIndex.refresh picks up added and removed images"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            shutil.copytree(helpers.FILES["timestream"], tmp_path)
+            shutil.rmtree(path.join(tmp_path, "_data"), ignore_errors=True)
+            index = ts_load_index(tmp_path)
+            self.assertFalse(index.refresh())
+            # Add an image in a new hour directory, and remove another
+            first = helpers.TS_FILES_JPG[0]
+            new_dir = path.join(tmp_path, "2013", "2013_10", "2013_10_30",
+                                "2013_10_30_07")
+            os.mkdir(new_dir)
+            shutil.copy(first, path.join(new_dir, path.basename(first)
+                                         .replace("_03_00_00", "_07_00_00")))
+            last_dir = path.dirname(helpers.TS_FILES_JPG[-1])
+            shutil.rmtree(path.join(tmp_path, path.relpath(
+                last_dir, helpers.FILES["timestream"])))
+            # Make sure mtimes change, whatever the filesystem's resolution
+            day_dir = path.dirname(new_dir)
+            later = path.getmtime(day_dir) + 10
+            os.utime(day_dir, (later, later))
+            self.assertTrue(index.refresh())
+            expect = helpers.TS_DATES[:-1] + ["2013_10_30_07_00_00"]
+            self.assertListEqual(index.timestamps, expect)
+            self.assertEqual(index.manifest["end_datetime"], expect[-1])
+            self.assertEqual(index.manifest["interval"],
+                             helpers.TS_DICT["interval"])
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def test_lookup_no_refresh(self):
+        """Test looking up images doesn't refresh an index in memory"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            shutil.copytree(helpers.FILES["timestream"], tmp_path)
+            index = ts_load_index(tmp_path)
+            refreshes = []
+            index.refresh = lambda: refreshes.append(1)
+            self.assertIsNotNone(ts_get_image(tmp_path, helpers.TS_DATES[0]))
+            ts_get_images(tmp_path, helpers.TS_DATES)
+            self.assertListEqual(refreshes, [])
+            ts_load_index(tmp_path, refresh=True)
+            self.assertListEqual(refreshes, [1])
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def test_lookup_added(self):
+        """Test looking up images added since the index was loaded"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            # Keep the name, which is part of the image file names
+            ts_path = path.join(tmp_path, "good-timestream")
+            shutil.copytree(helpers.FILES["timestream"], ts_path)
+            date = "2013_10_30_04_15_00"
+            self.assertIsNone(ts_get_image(ts_path, date))
+            fpath = path.join(path.dirname(helpers.TS_FILES_JPG[2]),
+                              "good-timestream_2013_10_30_04_15_00_00.JPG")
+            fpath = fpath.replace(helpers.FILES["timestream"], ts_path)
+            shutil.copy(helpers.TS_FILES_JPG[2], fpath)
+            self.assertEqual(ts_get_image(ts_path, date), fpath)
+            self.assertListEqual(ts_get_images(ts_path, [date]), [fpath])
+            self.assertIn(date, ts_load_index(ts_path))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def test_build_bad(self):
+        """Test building a TimeStreamIndex of a non-timestream"""
+        index = TimeStreamIndex(helpers.FILES["empty_dir"])
+        self.assertFalse(index.load())
+        with self.assertRaises(ValueError):
+            index.build()
+
 
 class TestGetImage(TestCase):
 
@@ -177,6 +329,55 @@ class TestGetImage(TestCase):
                          helpers.TS_DATES[0], n="this should be an int")
 
 
+class TestGetImages(TestCase):
+
+    """Test function timestream.parse.ts_get_images"""
+
+    def test_get_images(self):
+        """Test ts_get_images with present and missing dates"""
+        ts = helpers.FILES["timestream"]
+        dates = helpers.TS_DATES[:3] + ["2010_10_10_10_10_10"] + \
+            helpers.TS_DATES_PARSED[3:]
+        res = ts_get_images(ts, dates)
+        expt = helpers.TS_FILES_JPG[:3] + [None] + helpers.TS_FILES_JPG[3:]
+        self.assertListEqual(res, expt)
+
+    def test_get_images_bad_params(self):
+        """Test giving bad paramters to ts_get_images raises ValueError"""
+        with self.assertRaises(ValueError):
+            ts_get_images(None, helpers.TS_DATES)
+        with self.assertRaises(ValueError):
+            ts_get_images(helpers.FILES["timestream"], [None])
+        with self.assertRaises(ValueError):
+            ts_get_images(helpers.FILES["timestream"], ["NOTADATE"])
+
+
+class TestGetManifest(TestCase):
+
+    """Test function timestream.parse.ts_get_manifest"""
+
+    def test_get_manifest_cached(self):
+        """Test ts_get_manifest notices manifest files changing"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            shutil.copytree(helpers.FILES["timestream"], tmp_path)
+            manifest = ts_get_manifest(tmp_path)
+            self.assertListEqual(manifest["missing"], [])
+            # Changing the returned manifest doesn't change the cached one
+            manifest["missing"].append(helpers.TS_DATES[0])
+            self.assertListEqual(ts_get_manifest(tmp_path)["missing"], [])
+            # Adding a manifest file is picked up
+            manifest["start_datetime"] = helpers.TS_DATES[0]
+            manifest["end_datetime"] = helpers.TS_DATES[-1]
+            with open(path.join(tmp_path, "good-timestream.tsm"), "w") as fh:
+                json.dump(manifest, fh)
+            manifest = ts_get_manifest(tmp_path)
+            self.assertListEqual(manifest["missing"], helpers.TS_DATES[:1])
+            self.assertIsNone(ts_get_image(tmp_path, helpers.TS_DATES[0]))
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
 class TestParseDate(TestCase):
 
     """Test function timestream.parse.ts_parse_date"""
@@ -203,3 +404,71 @@ class TestParseDate(TestCase):
         date_str = "2013_12_11"
         with self.assertRaises(ValueError):
             ts_parse_date(date_str)
+
+
+class TestParseDates(TestCase):
+
+    """Test function timestream.parse.ts_parse_dates"""
+
+    def test_parse_dates_valid(self):
+        """Test timestream.parse.ts_parse_dates with valid dates"""
+        res = ts_parse_dates(helpers.TS_DATES + ["2012_02_29_23_59_59"])
+        self.assertEqual(res.dtype.str, "<M8[s]")
+        self.assertListEqual(res.tolist(), helpers.TS_DATES_PARSED +
+                             [dt.datetime(2012, 2, 29, 23, 59, 59)])
+        self.assertEqual(len(ts_parse_dates([])), 0)
+
+    def test_parse_dates_invalid(self):
+        """Test timestream.parse.ts_parse_dates with invalid dates"""
+        for bad in ["2013_02_30_10_09_08", "2013_12_11_24_09_08",
+                    "2013-12-11-10-09-08", "2013_12_11_10_09_080",
+                    "2013_12_11"]:
+            with self.assertRaises(ValueError):
+                ts_parse_dates(helpers.TS_DATES + [bad])
+
+    def test_parse_date_path(self):
+        """Test timestream.parse.ts_parse_date_path"""
+        for fname, date in zip(helpers.TS_FILES_JPG, helpers.TS_DATES_PARSED):
+            self.assertEqual(ts_parse_date_path(fname), date)
+        # Timestream names may contain underscores
+        self.assertEqual(
+            ts_parse_date_path("a_ts_2013_12_11_10_09_08_00.png"),
+            dt.datetime(2013, 12, 11, 10, 9, 8))
+
+
+class TestTimepointGrid(TestCase):
+
+    """Test function timestream.parse.ts_timepoint_grid"""
+    start = dt.datetime(2013, 12, 11, 10, 0, 0)
+    end = dt.datetime(2013, 12, 13, 10, 0, 0)
+
+    def test_grid_matches_date_range(self):
+        """Test ts_timepoint_grid gives the same schedule as iter_date_range"""
+        res = ts_timepoint_grid(self.start, self.end, 900)
+        self.assertEqual(res.dtype.str, "<M8[s]")
+        self.assertListEqual(res.tolist(),
+                             list(iter_date_range(self.start, self.end, 900)))
+
+    def test_grid_hour_window(self):
+        """Test ts_timepoint_grid with start and end hours"""
+        res = ts_timepoint_grid(self.start, self.end, 3600,
+                                start_hour=dt.time(9, 0, 0),
+                                end_hour=dt.time(11, 0, 0)).tolist()
+        expt = [dt.datetime(2013, 12, day, hour, 0, 0)
+                for day in (11, 12, 13) for hour in (9, 10, 11)]
+        self.assertListEqual(res, expt)
+
+    def test_grid_ignored(self):
+        """Test ts_timepoint_grid with ignored timestamps"""
+        ignored = ["2013_12_11_11_00_00", dt.datetime(2013, 12, 13, 10, 0, 0),
+                   "2013_12_11_11_30_00"]
+        res = ts_timepoint_grid(self.start, self.end, 3600,
+                                ignored=ignored).tolist()
+        self.assertEqual(len(res), 47)
+        self.assertNotIn(dt.datetime(2013, 12, 11, 11, 0, 0), res)
+        self.assertEqual(res[-1], dt.datetime(2013, 12, 13, 9, 0, 0))
+
+    def test_grid_empty(self):
+        """Test ts_timepoint_grid with end before start"""
+        res = ts_timepoint_grid(self.end, self.start, 60)
+        self.assertEqual(len(res), 0)
@@ -0,0 +1,135 @@
+import datetime as dt
+import numpy as np
+import os
+from os import path
+import shutil
+from unittest import TestCase
+
+from tests import helpers
+from timestream import (
+    TimeStream,
+    TimeStreamImage,
+)
+from timestream.parse.imgdb import (
+    ImageDataDB,
+    TS_IMGDB_FNAME,
+    ts_image_data_to_sqlite,
+)
+
+
+class TestImageDataDB(TestCase):
+
+    """Test storing image metadata in SQLite"""
+
+    def setUp(self):
+        self.fname = helpers.make_tmp_file() + ".sqlite"
+        self.db = ImageDataDB(self.fname)
+        self.db[dt.datetime(2014, 5, 31, 12)] = {"processed": "yes"}
+        self.db["2014_06_01_12_00_00"] = {"processed": "yes",
+                                          "trayLocs": [[1, 2]]}
+        self.db["2014_06_02_12_00_00"] = {"processed": "no", "trayLocs": []}
+        self.db["2014_07_01_12_00_00"] = {"processed": "yes", "trayLocs": []}
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.fname)
+
+    def test_mapping(self):
+        """Test ImageDataDB behaves as a dict"""
+        self.assertEqual(len(self.db), 4)
+        self.assertIn("2014_05_31_12_00_00", self.db)
+        self.assertIn(dt.datetime(2014, 6, 1, 12), self.db)
+        self.assertNotIn("2014_05_31_12_00_01", self.db)
+        self.assertEqual(self.db["2014_06_01_12_00_00"]["trayLocs"], [[1, 2]])
+        self.assertEqual(list(self.db)[0], "2014_05_31_12_00_00")
+        self.db["2014_06_01_12_00_00"] = {"processed": "no"}
+        self.assertDictEqual(self.db["2014_06_01_12_00_00"],
+                             {"processed": "no"})
+        del self.db["2014_06_01_12_00_00"]
+        self.assertEqual(len(self.db), 3)
+        with self.assertRaises(KeyError):
+            self.db["2014_06_01_12_00_00"]
+        # Still there once reopened
+        self.db.close()
+        self.db = ImageDataDB(self.fname)
+        self.assertEqual(len(self.db), 3)
+
+    def test_query(self):
+        """Test ImageDataDB.query"""
+        june = (dt.datetime(2014, 6, 1), dt.datetime(2014, 6, 30, 23, 59, 59))
+        res = [date for date, _ in self.db.query(*june)]
+        self.assertListEqual(res, ["2014_06_01_12_00_00",
+                                   "2014_06_02_12_00_00"])
+        res = list(self.db.query(*june, has=["trayLocs"],
+                                 where={"processed": "yes"}))
+        self.assertListEqual(res, [("2014_06_01_12_00_00",
+                                    {"processed": "yes",
+                                     "trayLocs": [[1, 2]]})])
+        res = [date for date, _ in self.db.query(has=["trayLocs"])]
+        self.assertEqual(len(res), 3)
+        # Replaced data is reindexed
+        self.db["2014_06_01_12_00_00"] = {"processed": "no"}
+        self.assertListEqual(list(self.db.query(*june, has=["trayLocs"],
+                                                where={"processed": "yes"})),
+                             [])
+
+    def test_timestream_data(self):
+        """Test storing the data of a timestream"""
+        self.assertDictEqual(self.db.timestream_data(), {})
+        self.db.set_timestream_data({"a": 1, "b": {"c": [2]}})
+        self.assertDictEqual(self.db.timestream_data(), {"a": 1,
+                                                         "b": {"c": [2]}})
+
+
+class TestTimeStreamImageDB(TestCase):
+
+    """Test v1 timestreams storing image metadata in SQLite"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def _write(self, ts):
+        for iii, date in enumerate(helpers.TS_DATES_PARSED[:3]):
+            img = TimeStreamImage()
+            img.pixels = np.zeros((10, 10, 3), dtype="uint8")
+            img.datetime = date
+            img.data["n"] = iii
+            ts.write_image(img)
+        ts.data["foo"] = "bar"
+
+    def test_write_load(self):
+        """Test writing and loading with TimeStream.create(image_db=True)"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg", image_db=True)
+        self._write(ts)
+        ts.close()
+        self.assertTrue(path.exists(path.join(ts.data_dir, TS_IMGDB_FNAME)))
+        self.assertFalse(path.exists(ts.image_db_path))
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertIsInstance(loaded.image_data, ImageDataDB)
+        self.assertEqual(loaded.data["foo"], "bar")
+        self.assertEqual(len(loaded.image_data), 3)
+        for iii, img in enumerate(loaded.iter_by_files()):
+            self.assertEqual(img.data, {"n": iii})
+
+    def test_migrate(self):
+        """Test ts_image_data_to_sqlite"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg")
+        self._write(ts)
+        ts.close()
+        self.assertEqual(ts_image_data_to_sqlite(self.tmp_path), 3)
+        self.assertFalse(path.exists(ts.image_db_path))
+        self.assertFalse(path.exists(ts.db_path))
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertIsInstance(loaded.image_data, ImageDataDB)
+        self.assertEqual(loaded.data["foo"], "bar")
+        for iii, date in enumerate(helpers.TS_DATES[:3]):
+            self.assertEqual(loaded.image_data[date], {"n": iii})
+        with self.assertRaises(ValueError):
+            ts_image_data_to_sqlite(self.tmp_path)
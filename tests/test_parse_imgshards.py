@@ -0,0 +1,163 @@
+import datetime as dt
+import numpy as np
+import os
+from os import path
+import shutil
+from unittest import TestCase
+
+from tests import helpers
+from timestream import (
+    TimeStream,
+    TimeStreamImage,
+)
+from timestream.parse.imgshards import (
+    ShardedImageData,
+    TS_SHARDS_DIR,
+    ts_shard_image_data,
+)
+
+DAYS = [dt.datetime(2014, 6, 1, 12), dt.datetime(2014, 6, 2, 12),
+        dt.datetime(2014, 7, 1, 12)]
+
+
+class TestShardedImageData(TestCase):
+
+    """Test storing image metadata in a file per day or month"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        self.shards = ShardedImageData(self.tmp_path)
+        for iii, date in enumerate(DAYS):
+            self.shards[date] = {"n": iii}
+        self.shards["2014_06_01_13_00_00"] = {"n": 3}
+        self.shards.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_mapping(self):
+        """Test ShardedImageData behaves as a dict, and is lazily loaded"""
+        self.assertListEqual(sorted(os.listdir(self.tmp_path)),
+                             ["2014_06_01.json", "2014_06_02.json",
+                              "2014_07_01.json", "shards.json"])
+        shards = ShardedImageData(self.tmp_path)
+        self.assertEqual(shards.by, "day")
+        self.assertEqual(len(shards._shards), 0)
+        self.assertIn(DAYS[0], shards)
+        self.assertNotIn("2014_06_01_12_00_01", shards)
+        self.assertNotIn("2015_01_01_12_00_00", shards)
+        self.assertEqual(shards["2014_06_01_13_00_00"], {"n": 3})
+        self.assertListEqual(list(shards._shards), ["2014_06_01"])
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(list(shards)[1], "2014_06_01_13_00_00")
+        del shards[DAYS[1]]
+        shards.flush()
+        self.assertFalse(path.exists(path.join(self.tmp_path,
+                                               "2014_06_02.json")))
+        with self.assertRaises(KeyError):
+            ShardedImageData(self.tmp_path)[DAYS[1]]
+        with self.assertRaises(ValueError):
+            ShardedImageData(self.tmp_path, by="month")
+
+    def test_range(self):
+        """Test only the shards of a range are read"""
+        shards = ShardedImageData(self.tmp_path)
+        res = list(shards.iteritems(dt.datetime(2014, 6, 1, 12, 30),
+                                    dt.datetime(2014, 6, 30)))
+        self.assertListEqual(res, [("2014_06_01_13_00_00", {"n": 3}),
+                                   ("2014_06_02_12_00_00", {"n": 1})])
+        self.assertListEqual(sorted(shards._shards),
+                             ["2014_06_01", "2014_06_02"])
+
+    def test_evict(self):
+        """Test shards are dropped beyond the budget, written if changed"""
+        shards = ShardedImageData(self.tmp_path, max_bytes=1)
+        shards[DAYS[0]] = {"n": 10}
+        shards[DAYS[2]]
+        self.assertListEqual(list(shards._shards), ["2014_07_01"])
+        self.assertEqual(ShardedImageData(self.tmp_path)[DAYS[0]], {"n": 10})
+        self.assertEqual(shards[DAYS[0]], {"n": 10})
+
+    def test_evict_written(self):
+        """Test shards written to count towards the budget"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            shards = ShardedImageData(tmp_path, max_bytes=1000)
+            for day in range(1, 4):
+                for minute in range(20):
+                    shards[dt.datetime(2014, 6, day, 12, minute)] = {"n": 1}
+                self.assertLessEqual(shards._nbytes, 1000)
+            self.assertListEqual(list(shards._shards), ["2014_06_03"])
+            shards.flush()
+            self.assertEqual(len(ShardedImageData(tmp_path)), 60)
+        finally:
+            shutil.rmtree(tmp_path)
+
+    def test_by_month(self):
+        """Test sharding by month"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            shards = ShardedImageData(tmp_path, by="month")
+            for iii, date in enumerate(DAYS):
+                shards[date] = {"n": iii}
+            shards.flush()
+            self.assertListEqual(sorted(os.listdir(tmp_path)),
+                                 ["2014_06.json", "2014_07.json",
+                                  "shards.json"])
+            self.assertEqual(ShardedImageData(tmp_path)[DAYS[1]], {"n": 1})
+        finally:
+            shutil.rmtree(tmp_path)
+
+
+class TestTimeStreamImageShards(TestCase):
+
+    """Test v1 timestreams storing image metadata in shards"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def _write(self, ts):
+        for iii, date in enumerate(DAYS):
+            img = TimeStreamImage()
+            img.pixels = np.zeros((10, 10, 3), dtype="uint8")
+            img.datetime = date
+            img.data["n"] = iii
+            ts.write_image(img)
+
+    def test_write_load(self):
+        """Test writing and loading with TimeStream.create(image_shards=...)"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg", image_shards="month")
+        self._write(ts)
+        ts.close()
+        self.assertFalse(path.exists(ts.image_db_path))
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertIsInstance(loaded.image_data, ShardedImageData)
+        self.assertEqual(loaded.image_data.by, "month")
+        # Timepoints are a day apart, from start
+        imgs = list(loaded.iter_by_timepoints(
+            start=dt.datetime(2014, 7, 1, 12), end=dt.datetime(2014, 7, 2)))
+        self.assertEqual(len(imgs), 1)
+        self.assertEqual(imgs[0].data, {"n": 2})
+        self.assertListEqual(list(loaded.image_data._shards), ["2014_07"])
+
+    def test_migrate(self):
+        """Test ts_shard_image_data"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="jpg")
+        self._write(ts)
+        ts.close()
+        self.assertEqual(ts_shard_image_data(self.tmp_path), 3)
+        self.assertFalse(path.exists(ts.image_db_path))
+        self.assertTrue(path.isdir(path.join(ts.data_dir, TS_SHARDS_DIR)))
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        self.assertIsInstance(loaded.image_data, ShardedImageData)
+        for iii, img in enumerate(loaded.iter_by_files()):
+            self.assertEqual(img.data, {"n": iii})
+        with self.assertRaises(ValueError):
+            ts_shard_image_data(self.tmp_path)
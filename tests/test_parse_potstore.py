@@ -0,0 +1,164 @@
+import datetime as dt
+import numpy as np
+import os
+from os import path
+import shutil
+from unittest import TestCase
+
+from tests import helpers
+from timestream import (
+    TimeStream,
+    TimeStreamImage,
+)
+from timestream.manipulate.pot import (
+    ImagePotHandler,
+    ImagePotMatrix,
+    ImagePotRectangle,
+)
+from timestream.parse.potstore import (
+    PotStore,
+)
+
+TIMES = [dt.datetime(2014, 6, 1, 12, i) for i in range(4)]
+
+
+class TestPotStore(TestCase):
+
+    """Test storing pots by column"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        self.store = PotStore(self.tmp_path)
+        self.rects = np.arange(4 * 3 * 4).reshape((4, 3, 4))
+        self.features = np.arange(4 * 3 * 2, dtype=float).reshape((4, 3, 2))
+        for iii in range(3):
+            self.store.write(TIMES[iii], (100, 200), [1, 2, 3],
+                             self.rects[iii], ["area", "perimeter"],
+                             self.features[iii],
+                             [{"trayID": 1}, {"trayID": 1}, {"trayID": 2}])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_read(self):
+        """Test reading one image, and ranges of them"""
+        self.assertEqual(len(self.store), 3)
+        self.assertIn(TIMES[1], self.store)
+        self.assertNotIn(TIMES[3], self.store)
+        size, rects, features = self.store.read(TIMES[1])
+        self.assertEqual(size, (100, 200))
+        np.testing.assert_array_equal(rects, self.rects[1])
+        np.testing.assert_array_equal(features, self.features[1])
+        times, rects = self.store.rects(TIMES[1], TIMES[2])
+        self.assertEqual(times.tolist(), TIMES[1:3])
+        self.assertIsInstance(rects, np.memmap)
+        np.testing.assert_array_equal(rects, self.rects[1:3])
+        times, features = self.store.features(end=TIMES[0])
+        np.testing.assert_array_equal(features, self.features[:1])
+        with self.assertRaises(KeyError):
+            self.store.read(TIMES[3])
+
+    def test_reopen(self):
+        """Test the store is read back, dropping an interrupted write"""
+        rects_path = path.join(self.tmp_path, "rects.i4")
+        with open(rects_path, "ab") as col_fh:
+            col_fh.write(self.rects[3].astype(np.int32).tostring())
+        size = path.getsize(rects_path)
+        store = PotStore(self.tmp_path)
+        self.assertEqual(len(store), 3)
+        # Reading leaves the files alone
+        self.assertEqual(path.getsize(rects_path), size)
+        self.assertEqual(store.pot_ids, [1, 2, 3])
+        self.assertEqual(store.feature_names, ["area", "perimeter"])
+        self.assertEqual(store.metaids[2], {"trayID": 2})
+        times, rects = store.rects()
+        np.testing.assert_array_equal(rects, self.rects[:3])
+        store.write(TIMES[3], (100, 200), [1, 2, 3], self.rects[3])
+        np.testing.assert_array_equal(store.rects()[1], self.rects)
+        self.assertEqual(path.getsize(rects_path), size)
+
+    def test_new_columns(self):
+        """Test adding pots and features, and replacing an image"""
+        self.store.write(TIMES[3], (100, 200), [4, 1], [[0, 0, 1, 1],
+                                                        [1, 1, 2, 2]],
+                         ["roundness"], [[0.5], [0.25]])
+        self.store.write(TIMES[0], (100, 200), [2], [[3, 3, 4, 4]])
+        # The arrays were rewritten to new files, and the old removed
+        self.assertListEqual(sorted(os.listdir(self.tmp_path)),
+                             ["features.2.f8", "pots.json", "rects.2.i4",
+                              "sizes.i4", "times.i8"])
+        store = PotStore(self.tmp_path)
+        self.assertEqual(store.pot_ids, [1, 2, 3, 4])
+        self.assertEqual(store.feature_names,
+                         ["area", "perimeter", "roundness"])
+        times, rects = store.rects()
+        self.assertEqual(rects.shape, (4, 4, 4))
+        np.testing.assert_array_equal(rects[0], [[-1] * 4, [3, 3, 4, 4],
+                                                 [-1] * 4, [-1] * 4])
+        np.testing.assert_array_equal(rects[1, :3], self.rects[1])
+        np.testing.assert_array_equal(rects[1, 3], [-1] * 4)
+        np.testing.assert_array_equal(rects[3, [0, 3]],
+                                      [[1, 1, 2, 2], [0, 0, 1, 1]])
+        times, features = store.features(TIMES[1], TIMES[3])
+        np.testing.assert_array_equal(features[0, :3, :2], self.features[1])
+        self.assertTrue(np.all(np.isnan(features[0, :, 2])))
+        self.assertEqual(features[2, 3, 2], 0.5)
+
+
+class TestTimeStreamPots(TestCase):
+
+    """Test v1 timestreams storing the pots of their images"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_write_read(self):
+        """Test ImagePotMatrix is written and read back from the pot store"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="png")
+        img = TimeStreamImage(dt=TIMES[0])
+        img.pixels = np.zeros((50, 60, 3), dtype="uint8")
+        img.ipm = ImagePotMatrix(img)
+        for pid, rect in ((1, [0, 0, 10, 10]), (2, [10, 20, 30, 40])):
+            pot = ImagePotHandler(pid, ImagePotRectangle(rect, (50, 60, 3)),
+                                  img.ipm, metaids={"trayID": 1})
+            pot.getCalcedFeatures()["area"] = float(pid)
+            img.ipm.addPot(pot)
+        ts.write_image(img)
+        ts.close()
+        # No pickle was written
+        self.assertFalse(path.exists(path.join(ts.data_dir, "2014")))
+
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        img, = list(loaded.iter_by_files())
+        self.assertIsNone(img._ipm)
+        # Pots are checked against the image
+        img.pixels = np.zeros((50, 60, 3), dtype="uint8")
+        ipm = img.ipm
+        self.assertEqual(sorted(ipm.potIds), [1, 2])
+        np.testing.assert_array_equal(ipm.getPot(2).rect.asList(),
+                                      [10, 20, 30, 40])
+        self.assertEqual(ipm.getPot(2).getFeature("area"), 2.0)
+        self.assertEqual(ipm.getPot(1).getMetaId("trayID"), 1)
+        self.assertEqual(ipm.potFeatures, ["area"])
+
+    def test_read_without_pixels(self):
+        """Test reading the pots of an image doesn't decode it"""
+        ts = TimeStream()
+        ts.create(self.tmp_path, ext="png")
+        img = TimeStreamImage(dt=TIMES[0])
+        img.pixels = np.zeros((50, 60, 3), dtype="uint8")
+        img.ipm = ImagePotMatrix(img)
+        img.ipm.addPot(ImagePotHandler(
+            1, ImagePotRectangle([0, 0, 10, 10], (50, 60, 3)), img.ipm))
+        ts.write_image(img)
+        ts.close()
+        loaded = TimeStream()
+        loaded.load(self.tmp_path)
+        img, = list(loaded.iter_by_files())
+        self.assertEqual(img.ipm.getPot(1).rect.imgSize, (50, 60))
+        self.assertIsNone(img._pixels)
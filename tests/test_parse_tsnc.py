@@ -0,0 +1,238 @@
+import datetime as dt
+import json
+import netCDF4
+import numpy as np
+import os
+from os import path
+from unittest import TestCase
+
+from tests import helpers
+from timestream import (
+    TimeStream,
+    TimeStreamImage,
+    TimeStreamTraverser,
+)
+from timestream.parse import (
+    ts_format_date,
+)
+import timestream.parse.tsnc as tsnc_mod
+from timestream.parse.tsnc import (
+    TimeStreamNetCDF,
+    TSNC_TIME_UNITS,
+)
+
+TIMES = [
+    dt.datetime(2013, 10, 30, 3, 0),
+    dt.datetime(2013, 10, 30, 3, 30),
+    dt.datetime(2013, 10, 30, 4, 30),
+]
+
+
+def make_tsnc(fname, frames, times, data=None):
+    """Write a v2 timestream like ts_to_tsnc does"""
+    root = netCDF4.Dataset(fname, "w", format="NETCDF4")
+    root.createDimension("y", frames.shape[1])
+    root.createDimension("x", frames.shape[2])
+    root.createDimension("z", frames.shape[3])
+    root.createDimension("t", None)
+    time_var = root.createVariable("time", "f8", ("t",))
+    time_var.units = TSNC_TIME_UNITS
+    time_var.calendar = "standard"
+    pixels = root.createVariable("pixel", "u1", ("t", "y", "x", "z"),
+                                 zlib=True)
+    if data is not None:
+        data_var = root.createVariable("image_data", str, ("t",))
+    for tidx, time in enumerate(times):
+        time_var[tidx] = netCDF4.date2num(time, TSNC_TIME_UNITS)
+        pixels[tidx, :, :, :] = frames[tidx]
+        if data is not None:
+            data_var[tidx] = json.dumps(data[tidx])
+    root.close()
+
+
+class TestTimeStreamNetCDF(TestCase):
+
+    """Test reading v2 timestreams"""
+
+    def setUp(self):
+        self.fname = helpers.make_tmp_file() + ".nc"
+        rand = np.random.RandomState(42)
+        # 255 is the netcdf fill value of u1, which must not be masked
+        self.frames = rand.randint(200, 256, (3, 6, 8, 3)).astype(np.uint8)
+        # Written out of order, as happens when appending
+        order = [0, 2, 1]
+        make_tsnc(self.fname, self.frames[order], [TIMES[i] for i in order],
+                  data=[{"n": i} for i in order])
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_reader(self):
+        """Test TimeStreamNetCDF lookups and reads"""
+        tsnc = TimeStreamNetCDF(self.fname)
+        self.assertEqual(len(tsnc), 3)
+        self.assertListEqual(list(tsnc), TIMES)
+        self.assertIn(TIMES[1], tsnc)
+        self.assertNotIn(dt.datetime(2013, 10, 30, 4, 0), tsnc)
+        self.assertEqual(tsnc.manifest["interval"], 1800)
+        self.assertEqual(tsnc.manifest["end_datetime"],
+                         ts_format_date(TIMES[-1]))
+        for time, frame in zip(TIMES, self.frames):
+            np.testing.assert_array_equal(tsnc.read(time), frame)
+        np.testing.assert_array_equal(tsnc.read(TIMES[2], (1, 4, 2, 5)),
+                                      self.frames[2, 1:4, 2:5])
+        with self.assertRaises(KeyError):
+            tsnc.read(dt.datetime(2013, 10, 30, 4, 0))
+        self.assertDictEqual(tsnc.image_data(),
+                             dict((ts_format_date(t), {"n": i})
+                                  for i, t in enumerate(TIMES)))
+        tsnc.close()
+
+    def test_timestream_load(self):
+        """Test TimeStream.load and iteration with a v2 timestream"""
+        ts = TimeStream()
+        ts.load(self.fname)
+        self.assertEqual(ts.version, 2)
+        self.assertEqual(ts.start_datetime, TIMES[0])
+        self.assertEqual(ts.end_datetime, TIMES[-1])
+        res = list(ts.iter_by_timepoints(remove_gaps=False))
+        self.assertEqual(len(res), 4)
+        self.assertEqual(len(res[2].pixels), 0)
+        for img, time, frame in zip(res[:2] + res[3:], TIMES, self.frames):
+            self.assertEqual(img.datetime, time)
+            self.assertIsNone(img.path)
+            self.assertEqual(img.data, {"n": TIMES.index(time)})
+            np.testing.assert_array_equal(img.pixels_window((0, 2, 0, 3)),
+                                          frame[0:2, 0:3])
+            self.assertIsNone(img._pixels)
+            np.testing.assert_array_equal(img.pixels, frame)
+        res = [img.datetime for img in ts.iter_by_files()]
+        self.assertListEqual(res, TIMES)
+
+    def test_traverser(self):
+        """Test TimeStreamTraverser with a v2 timestream"""
+        tst = TimeStreamTraverser(self.fname)
+        self.assertEqual(len(tst), 3)
+        img = tst.seek(TIMES[2])
+        np.testing.assert_array_equal(img.pixels, self.frames[2])
+
+    def test_append_legacy(self):
+        """Test appending to a file without image data"""
+        make_tsnc(self.fname, self.frames[:2], TIMES[:2])
+        tsnc = TimeStreamNetCDF(self.fname, mode="a")
+        tsnc.append(TIMES[2], self.frames[2], {"n": 2})
+        tsnc.close()
+        tsnc = TimeStreamNetCDF(self.fname)
+        self.assertListEqual(list(tsnc), TIMES)
+        np.testing.assert_array_equal(tsnc.read(TIMES[2]), self.frames[2])
+        self.assertDictEqual(tsnc.image_data(),
+                             {ts_format_date(TIMES[2]): {"n": 2}})
+        tsnc.close()
+
+    def test_interrupted_flush(self):
+        """Test frames are only seen once their time is written"""
+        tsnc = TimeStreamNetCDF(self.fname, mode="a")
+        tsnc.append(dt.datetime(2013, 10, 30, 5, 0), self.frames[0],
+                    {"bad": object()})
+        with self.assertRaises(TypeError):
+            tsnc.flush()
+        # The frame is kept, to be written again
+        self.assertEqual(len(tsnc._buffer), 1)
+        tsnc._buffer = []
+        tsnc.root.close()
+        tsnc = TimeStreamNetCDF(self.fname, mode="a")
+        self.assertEqual(len(tsnc.root.dimensions["t"]), 4)
+        self.assertListEqual(list(tsnc), TIMES)
+        tsnc.append(dt.datetime(2013, 10, 30, 5, 0), self.frames[1])
+        tsnc.close()
+        tsnc = TimeStreamNetCDF(self.fname)
+        self.assertListEqual(list(tsnc), TIMES + [
+            dt.datetime(2013, 10, 30, 5, 0)])
+        np.testing.assert_array_equal(
+            tsnc.read(dt.datetime(2013, 10, 30, 5, 0)), self.frames[1])
+        np.testing.assert_array_equal(tsnc.read(TIMES[1]), self.frames[1])
+        tsnc.close()
+
+
+class TestTimeStreamNetCDFWrite(TestCase):
+
+    """Test writing v2 timestreams"""
+
+    def setUp(self):
+        self.fname = helpers.make_tmp_file() + ".nc"
+        rand = np.random.RandomState(42)
+        self.frames = rand.randint(0, 256, (4, 6, 8, 3)).astype(np.uint8)
+        self.times = TIMES + [dt.datetime(2013, 10, 30, 5, 0)]
+        self.buffer_frames = tsnc_mod.TSNC_BUFFER_FRAMES
+        tsnc_mod.TSNC_BUFFER_FRAMES = 2
+
+    def tearDown(self):
+        tsnc_mod.TSNC_BUFFER_FRAMES = self.buffer_frames
+        os.remove(self.fname)
+
+    def _write(self, ts, iii, overwrite_mode="skip"):
+        img = TimeStreamImage(dt=self.times[iii])
+        img.pixels = self.frames[iii]
+        img.data = {"n": iii}
+        ts.write_image(img, overwrite_mode=overwrite_mode)
+
+    def test_write_v2(self):
+        """Test TimeStream.write_image with a v2 timestream"""
+        ts = TimeStream()
+        ts.create(self.fname, version=2, start=self.times[0],
+                  end=self.times[0])
+        self.assertEqual(ts.name, path.basename(self.fname)[:-3])
+        for iii in range(3):
+            self._write(ts, iii)
+        # Two are flushed, one is buffered
+        self.assertEqual(len(ts._index.root.dimensions["t"]), 2)
+        self.assertTrue(ts.has_image(self.times[2]))
+        ts.data["foo"] = "bar"
+        ts.close()
+
+        ts = TimeStream()
+        ts.load(self.fname)
+        self.assertEqual(ts.end_datetime, self.times[2])
+        self.assertEqual(ts.data["foo"], "bar")
+        pixels = ts._index.root.variables["pixel"]
+        self.assertListEqual(list(pixels.chunking()), [1, 6, 8, 3])
+        self.assertTrue(pixels.filters()["zlib"])
+        for iii, img in enumerate(ts.iter_by_files()):
+            self.assertEqual(img.datetime, self.times[iii])
+            self.assertEqual(img.data, {"n": iii})
+            np.testing.assert_array_equal(img.pixels, self.frames[iii])
+
+        # Append to the existing file
+        self._write(ts, 3)
+        self._write(ts, 0)
+        with self.assertRaises(ValueError):
+            self._write(ts, 0, overwrite_mode="raise")
+        # Overwriting replaces the written frame
+        img = TimeStreamImage(dt=self.times[1])
+        img.pixels = self.frames[3]
+        ts.write_image(img, overwrite_mode="overwrite")
+        ts.close()
+
+        ts = TimeStream()
+        ts.load(self.fname)
+        res = list(ts.iter_by_files())
+        self.assertEqual(len(res), 4)
+        np.testing.assert_array_equal(res[1].pixels, self.frames[3])
+        np.testing.assert_array_equal(res[3].pixels, self.frames[3])
+        self.assertEqual(res[3].data, {"n": 3})
+
+    def test_tile(self):
+        """Test chunking the pixel array into tiles"""
+        tsnc = TimeStreamNetCDF.create(self.fname, "tiled", "png",
+                                       complevel=1, tile=(4, 16))
+        for iii in range(2):
+            tsnc.append(self.times[iii], self.frames[iii])
+        tsnc.close()
+        tsnc = TimeStreamNetCDF(self.fname)
+        pixels = tsnc.root.variables["pixel"]
+        # Tiles are clipped to the frame
+        self.assertListEqual(list(pixels.chunking()), [1, 4, 8, 3])
+        self.assertEqual(pixels.filters()["complevel"], 1)
+        np.testing.assert_array_equal(tsnc.read(self.times[1]),
+                                      self.frames[1])
+        tsnc.close()
@@ -1,11 +1,18 @@
 import json
 import numpy as np
+import os
+import shutil
+import time
 from unittest import TestCase
 
+from tests import helpers
 from timestream.util import (
     dict_unicode_to_str,
     jsonify_data,
     dejsonify_data,
+    imap_prefetch,
+    json_dump_atomic,
+    numpy2npy,
     str2numpy,
     numpy2str,
 )
@@ -124,6 +131,34 @@ class TestJsonifyDataDict(TestCase):
         self.assertEqual(dct["array"].dtype, back["array"].dtype)
         self.assertEqual(dct["array"].shape, back["array"].shape)
 
+    def test_jsonify_sidecar(self):
+        """Test jsonify_data with large arrays in .npy sidecars"""
+        tmp_path = helpers.make_tmp_file()
+        try:
+            large = np.arange(20000, dtype="float32").reshape((200, 100))
+            dct = {"large": large, "small": np.arange(3),
+                   "nested": {"large": large[::-1]}, }
+            res = jsonify_data(dct, sidecar_dir=tmp_path)
+            self.assertIn("NP_NPY.large", json.loads(res))
+            self.assertIn("NP_ARR.small", json.loads(res))
+            self.assertEqual(len(os.listdir(tmp_path)), 2)
+            # Arrays already saved aren't saved again
+            jsonify_data(dct, sidecar_dir=tmp_path)
+            self.assertEqual(len(os.listdir(tmp_path)), 2)
+            back = dejsonify_data(res, sidecar_dir=tmp_path)
+            self.assertIsInstance(back["large"], np.memmap)
+            np.testing.assert_array_equal(back["large"], large)
+            self.assertEqual(back["large"].dtype, large.dtype)
+            np.testing.assert_array_equal(back["nested"]["large"],
+                                          large[::-1])
+            np.testing.assert_array_equal(back["small"], np.arange(3))
+            back = dejsonify_data(res, sidecar_dir=tmp_path, mmap_mode=None)
+            self.assertNotIsInstance(back["large"], np.memmap)
+            with self.assertRaises(ValueError):
+                dejsonify_data(res)
+        finally:
+            shutil.rmtree(tmp_path)
+
     def test_jsonify_numpy_shaped(self):
         """Test jsonify_data with dict w/ 3d numpy array"""
         dct = {"array": np.arange(27).reshape((3, 3, 3)), }
@@ -176,3 +211,96 @@ class TestStrNumpy(TestCase):
         arr_str = numpy2str(arr)
         arr_loaded = str2numpy(arr_str)
         self._arrays_eq(arr, arr_loaded)
+
+
+class TestJsonDumpAtomic(TestCase):
+
+    """Test ts.util.json_dump_atomic"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        os.mkdir(self.tmp_path)
+        self.fpath = os.path.join(self.tmp_path, "data.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_replace(self):
+        """Test the file is replaced, and no temporary files are left"""
+        json_dump_atomic({"a": 1}, self.fpath)
+        os.chmod(self.fpath, 0o640)
+        json_dump_atomic({"a": 2}, self.fpath)
+        with open(self.fpath) as fh:
+            self.assertDictEqual(json.load(fh), {"a": 2})
+        self.assertEqual(os.stat(self.fpath).st_mode & 0o777, 0o640)
+        self.assertListEqual(os.listdir(self.tmp_path), ["data.json"])
+
+    def test_failure(self):
+        """Test a failed write leaves the old file alone"""
+        json_dump_atomic({"a": 1}, self.fpath)
+        with self.assertRaises(TypeError):
+            json_dump_atomic({"a": object()}, self.fpath)
+        with open(self.fpath) as fh:
+            self.assertDictEqual(json.load(fh), {"a": 1})
+        self.assertListEqual(os.listdir(self.tmp_path), ["data.json"])
+
+
+class TestNumpy2Npy(TestCase):
+
+    """Test ts.util.numpy2npy"""
+
+    def setUp(self):
+        self.tmp_path = helpers.make_tmp_file()
+        self.sidecar_dir = os.path.join(self.tmp_path, "sidecar")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_concurrent(self):
+        """Test concurrent writers of one array leave only its file"""
+        arr = np.arange(1000).reshape((10, 100))
+        fnames = list(imap_prefetch(lambda _: numpy2npy(arr, self.sidecar_dir),
+                                    range(8), threads=8))
+        self.assertEqual(len(set(fnames)), 1)
+        self.assertListEqual(os.listdir(self.sidecar_dir), fnames[:1])
+        np.testing.assert_array_equal(
+            np.load(os.path.join(self.sidecar_dir, fnames[0])), arr)
+
+
+class TestImapPrefetch(TestCase):
+
+    """Test ts.util.imap_prefetch"""
+
+    def test_order(self):
+        """Results come back in order, however long each call takes"""
+        def slow(x):
+            time.sleep(0.001 * (10 - x))
+            return x * 2
+        for threads in (1, 4):
+            res = list(imap_prefetch(slow, range(10), threads))
+            self.assertListEqual(res, [x * 2 for x in range(10)])
+
+    def test_bounded(self):
+        """At most ``prefetch`` items are taken ahead of the consumer"""
+        taken = []
+
+        def items():
+            for x in range(20):
+                taken.append(x)
+                yield x
+        gen = imap_prefetch(lambda x: x, items(), threads=2, prefetch=3)
+        self.assertEqual(next(gen), 0)
+        self.assertLessEqual(len(taken), 4)
+        self.assertListEqual(list(gen), list(range(1, 20)))
+
+    def test_error(self):
+        """Errors are raised when their result is reached"""
+        def fail_on_3(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        res = []
+        with self.assertRaises(ValueError):
+            for x in imap_prefetch(fail_on_3, range(10), threads=2):
+                res.append(x)
+        self.assertListEqual(res, [0, 1, 2])
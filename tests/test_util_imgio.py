@@ -0,0 +1,213 @@
+import cv2
+import numpy as np
+import os
+from unittest import TestCase
+
+from tests import helpers
+from timestream import (
+    TimeStream,
+)
+from timestream.util import imgio
+from timestream.util.imgio import (
+    DECODERS,
+    PIXEL_CACHE,
+    PixelCache,
+    convert_order,
+    decode_image,
+    decoders_for,
+    read_image,
+    register_decoder,
+    time_decoders,
+)
+
+
+class TestReadImage(TestCase):
+
+    """Test timestream.util.imgio.read_image"""
+
+    def setUp(self):
+        self.calls = []
+
+        def decode(fpath):
+            self.calls.append(fpath)
+            return helpers.ZEROS_PIXELS
+        register_decoder("zeros", decode, ["jpg"])
+
+    def tearDown(self):
+        del DECODERS["zeros"]
+        imgio._CHOSEN.clear()
+
+    def test_decoders_for(self):
+        """Test decoders are chosen by the image type of the extension"""
+        self.assertIn("zeros", decoders_for("a/b.JPG"))
+        self.assertNotIn("zeros", decoders_for("a/b.png"))
+        self.assertNotIn("zeros", decoders_for("a/b.cr2"))
+        self.assertIn("opencv", decoders_for("a/b.cr2"))
+
+    def test_calibrate(self):
+        """Test the fastest decoder of a format is picked, once"""
+        fpath = helpers.FILES["zeros_jpg"]
+        times = time_decoders(fpath, rounds=1)
+        names = [x[1] for x in times]
+        self.assertIn("opencv", names)
+        self.assertIn("zeros", names)
+        self.assertListEqual([x[0] for x in times],
+                             sorted(x[0] for x in times))
+        imgio._CHOSEN.clear()
+        self.calls = []
+        read_image(fpath)
+        chosen = imgio._CHOSEN["jpg"]
+        self.assertIn(chosen, names)
+        read_image(fpath)
+        self.assertEqual(imgio._CHOSEN, {"jpg": chosen})
+        if chosen == "zeros":
+            self.assertEqual(len(self.calls), imgio.CALIBRATE_ROUNDS + 1)
+
+    def test_reference(self):
+        """Test only decoders decoding as the reference does are timed"""
+        fpath = helpers.FILES["zeros_jpg"]
+        register_decoder("grey", lambda x: helpers.ZEROS_PIXELS + 128,
+                         ["jpg"])
+        try:
+            names = [x[1] for x in time_decoders(fpath, rounds=1)]
+        finally:
+            del DECODERS["grey"]
+        self.assertIn("zeros", names)
+        self.assertNotIn("grey", names)
+
+    def test_bit_depth(self):
+        """Test 16-bit images keep their bit depth, whichever is fastest"""
+        fpath = helpers.make_tmp_file() + ".png"
+        pixels = np.zeros((10, 10, 3), dtype="uint16")
+        pixels[:, :, 2] = 65000
+        cv2.imwrite(fpath, pixels)
+        try:
+            self.assertNotIn("pillow", [x[1] for x in time_decoders(fpath)])
+            decoded = read_image(fpath)
+        finally:
+            os.remove(fpath)
+        self.assertEqual(decoded.dtype, np.uint16)
+        self.assertEqual(decoded[:, :, 0].max(), 65000)
+
+    def test_decoder(self):
+        """Test decoding with a given decoder"""
+        fpath = helpers.FILES["zeros_jpg"]
+        pixels = read_image(fpath, "opencv")
+        np.testing.assert_array_equal(pixels, cv2.imread(fpath)[:, :, ::-1])
+        # Decoded in OpenCV's order, converted to RGB by read_image
+        pixels, order = decode_image(fpath, "opencv")
+        self.assertEqual(order, "BGR")
+        np.testing.assert_array_equal(pixels, cv2.imread(fpath))
+        self.assertEqual(decode_image(fpath, "zeros")[1], "RGB")
+        self.assertIs(read_image(fpath, "zeros"), helpers.ZEROS_PIXELS)
+        # Downscaled after decoding, as it can't downscale as it decodes
+        self.assertEqual(read_image(fpath, "zeros", scale=4).shape,
+                         (25, 25, 3))
+        self.assertEqual(read_image(fpath, "opencv", scale=8).shape,
+                         (13, 13, 3))
+        self.assertEqual(imgio._CHOSEN, {})
+        with self.assertRaises(ValueError):
+            read_image(fpath, "nonexistent")
+
+    def test_convert_order(self):
+        """Test converting the order of channels"""
+        pixels = np.arange(24, dtype="uint8").reshape((2, 4, 3))
+        converted = convert_order(pixels, "RGB", "BGR")
+        np.testing.assert_array_equal(converted, pixels[:, :, ::-1])
+        self.assertTrue(converted.flags.c_contiguous)
+        self.assertIs(convert_order(pixels, "BGR", "BGR"), pixels)
+        grey = pixels[:, :, 0]
+        self.assertIs(convert_order(grey, "RGB", "BGR"), grey)
+        with self.assertRaises(ValueError):
+            convert_order(pixels, "RGB", "GRB")
+
+    def test_bad_image(self):
+        """Test an image no decoder can decode"""
+        fpath = helpers.make_tmp_file() + ".png"
+        with open(fpath, "w") as ofh:
+            ofh.write("not a png")
+        try:
+            with self.assertRaises(IOError):
+                read_image(fpath)
+            self.assertNotIn("png", imgio._CHOSEN)
+        finally:
+            os.remove(fpath)
+
+    def test_timestream_decoder(self):
+        """Test the decoder of a timestream is used for its images"""
+        ts = TimeStream()
+        ts.load(helpers.FILES["timestream"])
+        ts.decoder = "zeros"
+        PIXEL_CACHE.clear()
+        img = next(ts.iter_by_files())
+        self.assertIs(img.pixels, helpers.ZEROS_PIXELS)
+        self.assertListEqual(self.calls, [img.path])
+
+
+class TestPixelCache(TestCase):
+
+    """Test timestream.util.imgio.PixelCache"""
+
+    def setUp(self):
+        self.fpaths = helpers.TS_FILES_JPG[:3]
+        nbytes = read_image(self.fpaths[0]).nbytes
+        self.cache = PixelCache(max_bytes=2 * nbytes)
+
+    def test_decode(self):
+        """Test pixels are cached, least recently used dropped first"""
+        first, order = self.cache.decode(self.fpaths[0])
+        # Each read gets its own copy, which it can change
+        first[0, 0] = 0
+        again = self.cache.decode(self.fpaths[0])[0]
+        self.assertIsNot(again, first)
+        self.assertTrue(again.flags.writeable)
+        np.testing.assert_array_equal(again, read_image(self.fpaths[0],
+                                                        order=order))
+        self.cache.decode(self.fpaths[1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(self.cache.nbytes, 2 * first.nbytes)
+        # Drops the second, used less recently than the first
+        self.cache.decode(self.fpaths[0])
+        self.cache.decode(self.fpaths[2])
+        self.assertEqual(len(self.cache), 2)
+        np.testing.assert_array_equal(self.cache.decode(self.fpaths[0])[0],
+                                      again)
+        self.cache.decode(self.fpaths[1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 4))
+        # Each scale is cached separately
+        self.assertEqual(self.cache.decode(self.fpaths[1], scale=2)[0].shape,
+                         (18, 26, 3))
+        self.cache.clear()
+        self.assertEqual((len(self.cache), self.cache.nbytes), (0, 0))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_decoder_key(self):
+        """Test pixels are cached by the decoder which decoded them"""
+        pixels, order = self.cache.decode(self.fpaths[0], "opencv")
+        self.assertEqual(order, "BGR")
+        pixels, order = self.cache.decode(self.fpaths[0], "pillow")
+        self.assertEqual(order, "RGB")
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_modified(self):
+        """Test an image is decoded again once its file changes"""
+        fpath = helpers.make_tmp_file() + ".jpg"
+        try:
+            cv2.imwrite(fpath, np.zeros((10, 10, 3), dtype="uint8"))
+            self.assertEqual(self.cache.read(fpath).max(), 0)
+            cv2.imwrite(fpath, np.ones((10, 10, 3), dtype="uint8") * 255)
+            stat = os.stat(fpath)
+            os.utime(fpath, (stat.st_atime, stat.st_mtime + 1))
+            self.assertEqual(self.cache.read(fpath).min(), 255)
+            self.assertEqual(self.cache.misses, 2)
+        finally:
+            os.remove(fpath)
+        with self.assertRaises(IOError):
+            self.cache.read(fpath)
+
+    def test_disabled(self):
+        """Test nothing is cached with a budget of 0 bytes, the default"""
+        self.assertEqual(PIXEL_CACHE.max_bytes, 0)
+        self.cache.max_bytes = 0
+        self.cache.read(self.fpaths[0])
+        self.assertEqual(len(self.cache), 0)
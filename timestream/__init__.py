@@ -24,12 +24,14 @@
 from copy import deepcopy
 import cv2
 import datetime as dt
+from itertools import izip
 import json
 import logging
 import numpy as np
 import os
 from os import path
 from sys import stderr
+import threading
 from timestream.manipulate.pot import ImagePotMatrix
 import cPickle
 
@@ -40,17 +42,47 @@ from timestream.parse import (
     _is_ts_v1,
     _is_ts_v2,
     _ts_date_to_path,
-    ts_guess_manifest_v1,
+    TimeStreamIndex,
+    ts_load_index,
     all_files_with_ext,
     ts_parse_date_path,
     ts_parse_date,
     ts_format_date,
-    iter_date_range,
+    ts_timepoint_grid,
+)
+from timestream.parse.imgdb import (
+    ImageDataDB,
+    TS_IMGDB_FNAME,
+)
+from timestream.parse.imgshards import (
+    ShardedImageData,
+    TS_SHARDS_DIR,
+)
+from timestream.parse.potstore import (
+    PotStore,
+    TS_POTSTORE_DIR,
+)
+from timestream.parse.tsnc import (
+    TimeStreamNetCDF,
 )
 from timestream.parse.validate import (
     IMAGE_EXT_TO_TYPE,
     TS_MANIFEST_KEYS,
 )
+from timestream.util import (
+    PREFETCH_THREADS,
+    imap_prefetch,
+    json_dump_atomic,
+)
+from timestream.util.imgio import (
+    CHANNEL_ORDERS,
+    INTERACTIVE_CACHE_BYTES,
+    PIXEL_CACHE,
+    SCALES,
+    PixelCache,
+    convert_order,
+    downscale,
+)
 from timestream.util.imgmeta import (
     get_exif_date,
 )
@@ -63,6 +95,9 @@ del get_versions
 
 LOG = logging.getLogger("timestreamlib")
 NOW = dt.datetime.now()
+#: Number of per-image metadata entries appended to the journal of a v1
+#: timestream before it is compacted into the image_data.json snapshot
+TS_JOURNAL_COMPACT = 1000
 
 
 def setup_module_logging(level=logging.DEBUG, handler=logging.StreamHandler,
@@ -82,7 +117,13 @@ def setup_module_logging(level=logging.DEBUG, handler=logging.StreamHandler,
 class TimeStream(object):
 
     def __init__(self, version=None):
-        """A TimeStream, including metadata and parsers"""
+        """A TimeStream, including metadata and parsers
+
+        ``decoder`` names the decoder its images are read with (see
+        ``timestream.util.imgio``), otherwise whichever is fastest is used.
+        Its images are read through ``pixel_cache``, a ``PixelCache``, or
+        through ``PIXEL_CACHE`` if it is None.
+        """
         # Store version
         self._version = None
         if version:
@@ -97,8 +138,17 @@ class TimeStream(object):
         self.image_data = {}
         self.data = {}
         self.image_db_path = None
+        self.journal_path = None
+        self._journal_len = 0
+        self._batch = None
+        self._pot_store = None
         self.db_path = None
         self.data_dir = None
+        self._index = None
+        self.decoder = None
+        self.pixel_cache = None
+        # netcdf4 files can't be read by more than one thread at once
+        self._read_lock = threading.Lock()
 
     def __str__(self):
         ret = "TimeStream "
@@ -165,33 +215,64 @@ class TimeStream(object):
             os.mkdir(self.data_dir)
 
         self.image_db_path = path.join(self.data_dir, "image_data.json")
+        self.journal_path = path.join(self.data_dir, "image_data.journal")
+        self._pot_store = None
         self.db_path = path.join(self.data_dir, "timestream_data.json")
 
     @path.deleter
     def path(self):
         del self._path
 
-    def load(self, ts_path):
-        """Load a timestream from ``ts_path``, reading metadata"""
+    def load(self, ts_path, rebuild_index=False):
+        """Load a timestream from ``ts_path``, reading metadata
+
+        The image index under ``_data/`` is reused if it exists, and only
+        patched from directories that changed since, unless ``rebuild_index``
+        is True. Per-image metadata is read from the last snapshot, then
+        updated from the journal of images written since, unless it is stored
+        in SQLite or in shards, where it is only read as needed.
+        """
         self.path = ts_path
         if not path.exists(self.path):
             msg = "Timestream at {} does not exsit".format(self.path)
             LOG.error(msg)
             raise ValueError(msg)
-        try:
-            with open(self.image_db_path) as db_fh:
-                self.image_data = json.load(db_fh)
-        except IOError:
-            self.image_data = {}
+        sqlite_path = path.join(self.data_dir, TS_IMGDB_FNAME)
+        if path.exists(sqlite_path):
+            self.image_data = ImageDataDB(sqlite_path)
+            self.data = self.image_data.timestream_data()
+            self.read_metadata(rebuild_index=rebuild_index)
+            return
+        shards_dir = path.join(self.data_dir, TS_SHARDS_DIR)
+        if path.isdir(shards_dir):
+            self.image_data = ShardedImageData(shards_dir)
+        else:
+            try:
+                with open(self.image_db_path) as db_fh:
+                    self.image_data = json.load(db_fh)
+            except IOError:
+                self.image_data = {}
+        self._read_journal()
         try:
             with open(self.db_path) as db_fh:
                 self.data = json.load(db_fh)
         except IOError:
             self.data = {}
-        self.read_metadata()
+        self.read_metadata(rebuild_index=rebuild_index)
 
     def create(self, ts_path, version=1, ext="png", type=None, start=NOW,
-               end=NOW, name=None):
+               end=NOW, name=None, image_db=False, image_shards=None):
+        """Create a new timestream at ``ts_path``, or write to an existing one.
+
+        With ``image_db``, the metadata of a v1 timestream's images is stored
+        in SQLite (see ``ImageDataDB``) rather than JSON. With
+        ``image_shards``, ``"day"`` or ``"month"``, it is stored in a JSON
+        file per day or month (see ``ShardedImageData``).
+        """
+        if image_db and image_shards:
+            msg = "Image data can't be stored in both SQLite and shards"
+            LOG.error(msg)
+            raise ValueError(msg)
         self.version = version
         if not isinstance(ts_path, str):
             msg = "Timestream path must be a str"
@@ -218,7 +299,10 @@ class TimeStream(object):
         self.start_datetime = start
         self.end_datetime = end
         if name is None:
-            self.name = path.basename(ts_path)
+            name = path.basename(ts_path)
+            if self.version == 2:
+                name = path.splitext(name)[0]
+        self.name = name
         if type:
             self.image_type = type
         else:
@@ -228,6 +312,24 @@ class TimeStream(object):
                 msg = "Invalid image ext {}".format(ext)
                 LOG.error(msg)
                 raise ValueError(msg)
+        if self.version == 1:
+            if image_db:
+                self.image_data = ImageDataDB(path.join(self.data_dir,
+                                                        TS_IMGDB_FNAME))
+            elif image_shards:
+                self.image_data = ShardedImageData(
+                    path.join(self.data_dir, TS_SHARDS_DIR), by=image_shards)
+            self._index = TimeStreamIndex(self.path)
+            self._index.manifest.update(name=self.name, version=1,
+                                        image_type=self.image_type,
+                                        extension=self.extension, interval=1,
+                                        missing=[])
+        elif path.exists(self.path):
+            # Append to the existing file
+            self._index = TimeStreamNetCDF(self.path, mode="a")
+        else:
+            self._index = TimeStreamNetCDF.create(self.path, self.name,
+                                                  self.extension)
 
     def write_image(self, image, overwrite_mode="skip"):
         if not self.name:
@@ -285,14 +387,83 @@ class TimeStream(object):
                 self.end_datetime = image.datetime
             if image.datetime < self.start_datetime:
                 self.start_datetime = image.datetime
-            self.image_data[ts_format_date(image.datetime)] = image.data
-            self.write_metadata()
             # FIXME: pass the overwrite_mode
             image.write(fpath=fpath, overwrite=True)
-            self.write_pickled_image(image, overwrite=True)
+            if image.ipm is not None:
+                self.pot_store.write(image.datetime, *image.ipm.asArrays())
+            # Only index the image once it is on disk
+            if self._index is not None:
+                self._index.add(image.datetime)
+            self._journal_image(ts_format_date(image.datetime), image.data)
 
         else:
-            raise NotImplementedError("v2 timestreams not implemented yet")
+            tsnc = self._tsnc_for_writing()
+            exists = image.datetime in tsnc
+            if exists:
+                if overwrite_mode == "skip":
+                    return
+                elif overwrite_mode in {"increment", "raise"}:
+                    # v2 timestreams have no sub-second image numbers, so
+                    # there is no incrementing.
+                    msg = "Image already exists at {} in {}".format(
+                        ts_format_date(image.datetime), self.path)
+                    LOG.error(msg)
+                    raise ValueError(msg)
+            if image.datetime > self.end_datetime:
+                self.end_datetime = image.datetime
+            if image.datetime < self.start_datetime:
+                self.start_datetime = image.datetime
+            self.image_data[ts_format_date(image.datetime)] = image.data
+            if exists:
+                tsnc.replace(image.datetime, image.pixels, image.data)
+            else:
+                tsnc.append(image.datetime, image.pixels, image.data)
+
+    def _tsnc_for_writing(self):
+        """Get the file of a v2 timestream, opened for appending"""
+        if self._index is None or self._index.mode != "a":
+            if self._index is not None:
+                self._index.close()
+            self._index = TimeStreamNetCDF(self.path, mode="a")
+        return self._index
+
+    def close(self):
+        """Write out any buffered images and metadata, and close the file of
+        a v2 timestream. The metadata journal of a v1 timestream is compacted.
+        Any write session is committed and ended.
+        """
+        if self._batch is not None:
+            self._batch.close()
+        if self.version == 1 and self.path:
+            self.write_metadata(compact=True)
+        elif self.version == 2 and self._index is not None:
+            if self._index.mode == "a":
+                self.write_metadata()
+            self._index.close()
+            self._index = None
+
+    @property
+    def pot_store(self):
+        """The ``PotStore`` of the pots of each image of a v1 timestream"""
+        if self._pot_store is None:
+            self._pot_store = PotStore(path.join(self.data_dir,
+                                                 TS_POTSTORE_DIR))
+        return self._pot_store
+
+    def read_ipm(self, image):
+        """Read the ``ImagePotMatrix`` of ``image`` from the pot store.
+
+        Returns None if there is none, including for v2 timestreams.
+        """
+        if self.version != 1 or not self.path or image.datetime is None or \
+                image.datetime not in self.pot_store:
+            return None
+        store = self.pot_store
+        imgSize, rects, features = store.read(image.datetime)
+        # With the stored size, reading the pots doesn't decode the image
+        return ImagePotMatrix.fromArrays(image, store.pot_ids, rects,
+                                         store.feature_names, features,
+                                         store.metaids, imgSize=imgSize)
 
     def write_pickled_image(self, image, overwrite=False):
         if not isinstance(image, TimeStreamImage):
@@ -332,21 +503,133 @@ class TimeStream(object):
 
         return retImg
 
-    def write_metadata(self):
+    def _journal_image(self, date, data):
+        """Record the metadata of the image at ``date`` (a formatted date).
+
+        Rather than rewriting the whole image_data.json snapshot, each image
+        appends a line to the journal, and the journal is compacted into the
+        snapshot every ``TS_JOURNAL_COMPACT`` images.
+        """
+        self.image_data[date] = data
+        # SQLite keeps its own journal until it's committed
+        if not isinstance(self.image_data, ImageDataDB):
+            with open(self.journal_path, "a") as jnl_fh:
+                jnl_fh.write(json.dumps([date, data]) + "\n")
+        self._journal_len += 1
+        every = TS_JOURNAL_COMPACT
+        if self._batch is not None:
+            every = self._batch.every
+        if self._journal_len >= every:
+            self._write_metadata(compact=True)
+
+    def _read_journal(self):
+        """Apply the metadata journal to ``image_data``"""
+        self._journal_len = 0
+        try:
+            jnl_fh = open(self.journal_path)
+        except IOError:
+            return
+        with jnl_fh:
+            for line in jnl_fh:
+                try:
+                    date, data = json.loads(line)
+                except ValueError:
+                    # The last line is incomplete if a write was interrupted
+                    LOG.warn("Skipping bad line in {}".format(
+                        self.journal_path))
+                    continue
+                self.image_data[date] = data
+                self._journal_len += 1
+
+    def compact_metadata(self):
+        """Write the image_data.json snapshot, and empty the journal.
+
+        The snapshot is written to a temporary file and renamed over the old
+        one, so there is always a complete snapshot. Should we be interrupted
+        before the journal is removed, replaying it again is harmless.
+
+        Metadata stored in SQLite is committed instead, and that stored in
+        shards has its changed shards written.
+        """
+        if isinstance(self.image_data, ImageDataDB):
+            self.image_data.commit()
+        elif isinstance(self.image_data, ShardedImageData):
+            self.image_data.flush()
+            if path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        else:
+            self._write_snapshot()
+        self._journal_len = 0
+        if self._index is not None:
+            self._index.save()
+
+    def _write_snapshot(self):
+        json_dump_atomic(self.image_data, self.image_db_path)
+        if path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def batch(self, every=TS_JOURNAL_COMPACT):
+        """Start a write session, see ``TimeStreamBatch``.
+
+        Use as ``with ts.batch(): ...``, or leave it to ``close`` to commit.
+        """
+        if self._batch is not None:
+            msg = "{} already has a write session".format(self.path)
+            LOG.error(msg)
+            raise RuntimeError(msg)
+        self._batch = TimeStreamBatch(self, every)
+        return self._batch
+
+    @property
+    def in_batch(self):
+        """Whether a write session is open"""
+        return self._batch is not None
+
+    def write_metadata(self, compact=False):
+        """Write the timestream's metadata.
+
+        Per-image metadata of v1 timestreams is journalled as each image is
+        written, and is only compacted into a snapshot if ``compact`` is True,
+        or the journal is long. Metadata stored in SQLite is committed.
+
+        Does nothing during a write session, which writes the metadata when
+        it is committed instead.
+        """
         if not self.path:
             msg = "write_metadata() must be called on instance with valid path"
             LOG.error(msg)
             raise RuntimeError(msg)
-        if self.version == 1:
-            with open(self.image_db_path, "w") as db_fh:
-                json.dump(self.image_data, db_fh)
-            with open(self.db_path, "w") as db_fh:
-                json.dump(self.data, db_fh)
+        if self._batch is None:
+            self._write_metadata(compact)
+
+    def _write_metadata(self, compact=False):
+        if self.version == 1 and isinstance(self.image_data, ImageDataDB):
+            self.image_data.set_timestream_data(self.data)
+            if compact or self._journal_len >= TS_JOURNAL_COMPACT:
+                self.compact_metadata()
+            else:
+                self.image_data.commit()
+        elif self.version == 1:
+            json_dump_atomic(self.data, self.db_path)
+            has_snapshot = path.exists(self.image_db_path) or \
+                isinstance(self.image_data, ShardedImageData)
+            if compact or self._journal_len >= TS_JOURNAL_COMPACT or \
+                    not has_snapshot:
+                self.compact_metadata()
         else:
-            raise NotImplementedError("v2 metadata not implemented")
-
-    def read_metadata(self):
-        """Guesses the metadata fields of a timestream, v1 or v2."""
+            # Per-image data is stored with each image
+            tsnc = self._tsnc_for_writing()
+            tsnc.set_timestream_data(self.data)
+            tsnc.flush()
+
+    def read_metadata(self, rebuild_index=False):
+        """Guesses the metadata fields of a timestream, v1 or v2.
+
+        For v1 timestreams, the fields come from the image index, which is
+        built with a single walk of the timestream if it doesn't exist yet,
+        and refreshed otherwise. v2 timestreams are read from their netcdf4
+        file, which serves as the index.
+        """
         if not self.path:
             msg = "read_metadata() must be called on instance with valid path"
             LOG.error(msg)
@@ -362,25 +645,93 @@ class TimeStream(object):
                 LOG.error(msg)
                 raise ValueError(msg)
         if self.version == 1:
-            manifest = ts_guess_manifest_v1(self.path)
+            self._index = ts_load_index(self.path, rebuild=rebuild_index,
+                                        refresh=True)
+            manifest = dict(self._index.manifest)
             self._set_metadata(**manifest)
             for key in TS_MANIFEST_KEYS:
                 self.data[key] = manifest[key]
         elif self.version == 2:
-            raise NotImplementedError(
-                "No OOP interface to timestream v2 format")
+            self._index = TimeStreamNetCDF(self.path)
+            manifest = dict(self._index.manifest)
+            self._set_metadata(**manifest)
+            self.data.update(self._index.timestream_data())
+            for key in TS_MANIFEST_KEYS:
+                self.data[key] = manifest[key]
+            self.image_data = self._index.image_data()
         else:
             msg = "{} is neither a v1 nor v2 timestream.".format(self.path)
             LOG.error(msg)
             raise ValueError(msg)
 
+    def has_image(self, time):
+        """Check if an image exists at timepoint ``time``.
+
+        Uses the image index when there is one, so no filesystem access is
+        needed.
+        """
+        if self._index is not None:
+            return time in self._index
+        relpath = _ts_date_to_path(self.name, self.extension, time, 0)
+        return path.exists(path.join(self.path, relpath))
+
+    def read_pixels(self, time, window=None):
+        """Read the pixels of the image at ``time``.
+
+        Args:
+          time(datetime): Timestamp of the image.
+          window(tuple): ``(y0, y1, x0, x1)``. If given, only return the
+            pixels in ``[y0:y1, x0:x1]``. Only v2 timestreams can avoid reading
+            the whole image to do so.
+
+        Returns:
+          ndarray: The pixels, as ``[y, x, RGB]``.
+        """
+        if self.version == 2:
+            with self._read_lock:
+                return self._index.read(time, window)
+        img = TimeStreamImage(dt=time)
+        img.parent_timestream = self
+        pixels = img.pixels
+        if window is not None:
+            y0, y1, x0, x1 = window
+            pixels = pixels[y0:y1, x0:x1]
+        return pixels
+
     def _set_metadata(self, **metadata):
         """Sets class members from ``metadata`` dict, first validating it."""
         metadata = validate_timestream_manifest(metadata)
         for datum, value in metadata.items():
             setattr(self, datum, value)
 
-    def iter_by_files(self, ignored_timestamps=[]):
+    def _prefetch(self, imgs, prefetch):
+        """Load the pixels of up to ``prefetch`` of ``imgs`` ahead of the one
+        last yielded, in a pool of threads, so they are decoded while the
+        consumer processes that one. Errors raised loading an image's pixels
+        are raised when it is reached.
+        """
+        if not prefetch:
+            return imgs
+        threads = max(2, min(prefetch, PREFETCH_THREADS))
+        return imap_prefetch(_load_pixels, imgs, threads=threads,
+                             prefetch=prefetch)
+
+    def iter_by_files(self, ignored_timestamps=[], prefetch=0):
+        """Iterate over the images of a TimeStream, in the order of their
+        files. With ``prefetch``, the pixels of that many images are decoded
+        ahead, see ``iter_by_timepoints``.
+        """
+        return self._prefetch(self._iter_by_files(ignored_timestamps),
+                              prefetch)
+
+    def _iter_by_files(self, ignored_timestamps):
+        if self.version == 2:
+            for time in self._index:
+                if ts_format_date(time) in ignored_timestamps:
+                    LOG.info("Skip processing data at {}".format(time))
+                    continue
+                yield self._make_image(time)
+            return
         for fpath in all_files_with_ext(
                 self.path, self.extension, cs=False):
             img = TimeStreamImage()
@@ -399,13 +750,18 @@ class TimeStream(object):
                 img.data = {}
             yield img
 
-    def iter_by_timepoints(self, remove_gaps=True, start=None, end=None,
-                           interval=None, start_hour=None, end_hour=None,
-                           ignored_timestamps=[]):
-        """
-        Iterate over a TimeStream in chronological order, yielding a
-        TimeStreamImage instance for each timepoint. If ``remove_gaps`` is
-        False, yield None for missing images.
+    def timepoints(self, start=None, end=None, interval=None,
+                   start_hour=None, end_hour=None, ignored_timestamps=[]):
+        """Calculate the timepoints ``iter_by_timepoints`` visits.
+
+        Args:
+          See ``iter_by_timepoints``. ``start`` and ``end`` are clipped to
+          the extent of this TimeStream, and ``interval`` defaults to its
+          interval.
+
+        Returns:
+          tuple: ``datetime64[s]`` array of timepoints, and a boolean array
+            which is True where there is an image at that timepoint.
         """
         if not start or start < self.start_datetime:
             start = self.start_datetime
@@ -414,67 +770,123 @@ class TimeStream(object):
         if not interval:
             interval = self.interval
 
-        # fix hour range if given
-        if start_hour is not None:
-            start = dt.datetime.combine(start.date(), start_hour)
-        if end_hour is not None:
-            end = dt.datetime.combine(end.date(), end_hour)
-
-        # iterate thru times
-        for time in iter_date_range(start, end, interval):
-            # skip images in ignored_timestamps
-            if ts_format_date(time) in ignored_timestamps:
-                LOG.info("Skip processing data at {}".format(time))
-                continue
+        times = ts_timepoint_grid(start, end, interval, start_hour, end_hour,
+                                  ignored_timestamps)
+        if self._index is not None:
+            exists = self._index.exists(times)
+        else:
+            exists = np.array([self.has_image(time.item()) for time in times],
+                              dtype=bool)
+        return times, exists
 
-            # apply hour range if given
-            if start_hour is not None:
-                hrstart = dt.datetime.combine(time.date(), start_hour)
-                if time < hrstart:
-                    continue
-            if end_hour is not None:
-                hrend = dt.datetime.combine(time.date(), end_hour)
-                if time > hrend:
-                    continue
+    def iter_by_timepoints(self, remove_gaps=True, start=None, end=None,
+                           interval=None, start_hour=None, end_hour=None,
+                           ignored_timestamps=[], prefetch=0):
+        """
+        Iterate over a TimeStream in chronological order, yielding a
+        TimeStreamImage instance for each timepoint. If ``remove_gaps`` is
+        False, yield None for missing images.
 
-            # Format the path below the ts root
-            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
-            # Join to make "absolute" path, i.e. path including ts_path
-            img_path = path.join(self.path, relpath)
+        With ``prefetch``, the pixels of up to that many images after the
+        one last yielded are decoded in the background, holding at most that
+        many decoded images in memory. An error loading the pixels of an
+        image is raised as that image is reached.
+        """
+        return self._prefetch(
+            self._iter_by_timepoints(remove_gaps, start, end, interval,
+                                     start_hour, end_hour,
+                                     ignored_timestamps),
+            prefetch)
+
+    def _iter_by_timepoints(self, remove_gaps, start, end, interval,
+                            start_hour, end_hour, ignored_timestamps):
+        times, exists = self.timepoints(start, end, interval, start_hour,
+                                        end_hour, ignored_timestamps)
+        for time, img_exists in izip(times, exists):
+            time = time.item()
             # not-so-silently fail if we can't find the image
-            if path.exists(img_path):
-                LOG.debug("Image at {} in {} is {}.".format(time, self.path,
-                                                            img_path))
+            if img_exists:
+                LOG.debug("Image at {} in {} exists.".format(time, self.path))
+                yield self._make_image(time)
             else:
-                LOG.debug("Expected image {} at {} did not exist.".format(
-                    img_path, time, self.path))
-                img_path = None
-            if remove_gaps and img_path is None:
-                continue
-            elif img_path is None:
-                img = TimeStreamImage(dt=time)
-                img.pixels = np.array([])
-                yield img
-            else:
-                img = self.load_pickled_image(time)
-                if img is None:
+                LOG.debug("Expected image at {} in {} did not exist.".format(
+                    time, self.path))
+                if not remove_gaps:
                     img = TimeStreamImage(dt=time)
-                img.parent_timestream = self
-                img.path = img_path
+                    img.pixels = np.array([])
+                    yield img
+
+    def _make_image(self, time):
+        """Make the TimeStreamImage of the existing image at ``time``"""
+        img = None
+        if self.version == 1 and time not in self.pot_store:
+            # Timestreams written before the pot store pickled each image
+            img = self.load_pickled_image(time)
+        if img is None:
+            img = TimeStreamImage(dt=time)
+        img.parent_timestream = self
+        if self.version == 1:
+            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
+            img.path = path.join(self.path, relpath)
 
-                try:
-                    img_date = ts_format_date(img.datetime)
-                    img.data = self.image_data[img_date]
-                except KeyError:
-                    img.data = {}
-                yield img
+        try:
+            img_date = ts_format_date(img.datetime)
+            img.data = self.image_data[img_date]
+        except KeyError:
+            img.data = {}
+        return img
+
+
+def _load_pixels(img):
+    # Raise errors decoding the image, so the consumer gets them rather than
+    # an image without pixels
+    img._load_pixels(strict=True)
+    return img
+
+
+class TimeStreamBatch(object):
+
+    def __init__(self, timestream, every=TS_JOURNAL_COMPACT):
+        """A write session of a ``TimeStream``, as made by
+        ``TimeStream.batch``.
+
+        While the session is open, ``write_metadata`` does nothing, and the
+        timestream's metadata, manifest and image index are only written when
+        the session is committed: every ``every`` images, by ``commit``, and
+        when the session is closed. Every file is written to a temporary
+        file and renamed into place, so a crash never leaves one truncated.
+        The images' metadata is still journalled as each image is written.
+
+        Args:
+          timestream(TimeStream): The timestream being written.
+          every(int): Commit after this many images.
+        """
+        self.timestream = timestream
+        self.every = every
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Commit even if interrupted, so we can resume from here
+        self.close()
+
+    def commit(self):
+        """Write the timestream's metadata now"""
+        self.timestream._write_metadata(compact=True)
+
+    def close(self):
+        """Commit, and end the session"""
+        if self.timestream._batch is self:
+            self.commit()
+            self.timestream._batch = None
 
 
 class TimeStreamTraverser(TimeStream):
 
     def __init__(self, ts_path=None, version=None, interval=None,
                  start=None, end=None, start_hour=None, end_hour=None,
-                 ignored_timestamps=[]):
+                 ignored_timestamps=[], cache_bytes=INTERACTIVE_CACHE_BYTES):
         """Class to got back and forth on a TimeStream
 
         Use This class when you need to traverse the timestream both forwards
@@ -488,86 +900,110 @@ class TimeStreamTraverser(TimeStream):
           start_hour(datetime): Starting hour within every day of time stream
           end_hour(datetime): Ending hour within every day of time stream
           ignored_timestamps(list): List of ignore time stamps.0
+          cache_bytes(int): Most bytes of pixels to cache, so going back to
+            images already seen doesn't decode them again.
 
         Attributes:
-          _timestamps(list): List of strings that index all existing image files
-            in this timestream
+          _timestamps(ndarray): Sorted ``datetime64[s]`` array of the
+            timestamps of all existing images in this timestream
           _offset(int): Current offset within _timestamps.
 
         """
         super(TimeStreamTraverser, self).__init__(version=version)
+        self.pixel_cache = PixelCache(cache_bytes)
         self.load(ts_path)
 
         self._offset = 0
-        self._timestamps = []
-        # FIXME: Following is practically equal to
-        # TimeStream.iter_by_timepoints.
-        if not start or start < self.start_datetime:
-            start = self.start_datetime
-        if not end or end > self.end_datetime:
-            end = self.end_datetime
-        if not interval:
-            interval = self.interval
+        times, exists = self.timepoints(start, end, interval, start_hour,
+                                        end_hour, ignored_timestamps)
+        self._timestamps = times[exists]
 
-        # fix hour range if given
-        if start_hour is not None:
-            start = dt.datetime.combine(start.date(), start_hour)
-        if end_hour is not None:
-            end = dt.datetime.combine(end.date(), end_hour)
-
-        # iterate thru times
-        for time in iter_date_range(start, end, interval):
-            # skip images in ignored_timestamps
-            if ts_format_date(time) in ignored_timestamps:
-                continue
-
-            # apply hour range if given
-            if start_hour is not None:
-                hrstart = dt.datetime.combine(time.date(), start_hour)
-                if time < hrstart:
-                    continue
-            if end_hour is not None:
-                hrend = dt.datetime.combine(time.date(), end_hour)
-                if time > hrend:
-                    continue
+    def __len__(self):
+        return len(self._timestamps)
 
-            # If path exists add index to _timestamps
-            relpath = _ts_date_to_path(self.name, self.extension, time, 0)
-            img_path = path.join(self.path, relpath)
-            if path.exists(img_path):
-                self._timestamps.append(time)
+    @staticmethod
+    def _to_datetime64(time):
+        return np.datetime64(ts_parse_date(time), "s")
 
     def next(self):
-        if self._offset == len(self._timestamps) - 1:
-            self._offset = 0
-
+        """Step forward one image, wrapping around at the end"""
+        self._offset = (self._offset + 1) % len(self._timestamps)
         return self.curr()
 
     def prev(self):
-        if self._offset == 0:
-            self._offset = len(self._timestamps) - 1
-
+        """Step back one image, wrapping around at the start"""
+        self._offset = (self._offset - 1) % len(self._timestamps)
         return self.curr()
 
     def curr(self):
-        time = self._timestamps[self._offset]
-        relpath = _ts_date_to_path(self.name, self.extension, time, 0)
-        img_path = path.join(self.path, relpath)
+        return self._image_at(self._offset)
 
-        img = self.load_pickled_image(time)
-        if img is None:
-            img = TimeStreamImage(dt=time)
+    def seek(self, time):
+        """Move to the image at ``time``, or the first one after it.
 
-        img.parent_timestream = self
-        img.path = img_path
+        Args:
+          time(datetime or str): Timestamp to move to. If it is after the last
+            image, move to the last image.
 
-        try:
-            img_date = ts_format_date(img.datetime)
-            img.data = self.image_data[img_date]
-        except KeyError:
-            img.data = {}
+        Returns:
+          TimeStreamImage: The image moved to.
+        """
+        offset = np.searchsorted(self._timestamps, self._to_datetime64(time))
+        self._offset = int(min(offset, len(self._timestamps) - 1))
+        return self.curr()
 
-        return img
+    def nearest(self, time, tolerance=None):
+        """Move to the image closest in time to ``time``.
+
+        Args:
+          time(datetime or str): Timestamp to look for.
+          tolerance(int or timedelta): Maximum distance from ``time``, in
+            seconds if an int. If the closest image is further away, don't
+            move.
+
+        Returns:
+          TimeStreamImage: The image moved to, or None if no image is within
+            ``tolerance``.
+        """
+        time = self._to_datetime64(time)
+        offset = np.searchsorted(self._timestamps, time)
+        # The closest image is either side of the insertion point
+        candidates = [o for o in (offset - 1, offset)
+                      if 0 <= o < len(self._timestamps)]
+        if not candidates:
+            return None
+        dists = [abs((self._timestamps[o] - time).astype(np.int64))
+                 for o in candidates]
+        best = candidates[int(np.argmin(dists))]
+        if tolerance is not None:
+            if isinstance(tolerance, dt.timedelta):
+                tolerance = tolerance.total_seconds()
+            if min(dists) > tolerance:
+                return None
+        self._offset = int(best)
+        return self.curr()
+
+    def between(self, start=None, end=None):
+        """Iterate over the images from ``start`` to ``end``, inclusive.
+
+        Doesn't move the current position.
+
+        Args:
+          start(datetime or str): First timestamp, defaults to the first image.
+          end(datetime or str): Last timestamp, defaults to the last image.
+        """
+        first, last = 0, len(self._timestamps)
+        if start is not None:
+            first = np.searchsorted(self._timestamps,
+                                    self._to_datetime64(start), side="left")
+        if end is not None:
+            last = np.searchsorted(self._timestamps, self._to_datetime64(end),
+                                   side="right")
+        for offset in range(first, last):
+            yield self._image_at(offset)
+
+    def _image_at(self, offset):
+        return self._make_image(self._timestamps[offset].item())
 
 
 class TimeStreamImage(object):
@@ -579,6 +1015,8 @@ class TimeStreamImage(object):
           path(str): This class is driven by _path. _path should be valid at
             end of all methods.!!
           pixels(ndarray): The actual image.
+          channel_order(str): The order of the channels of the pixels as
+            they are held, "RGB" or "BGR".
           ipm(ImagePotMatrix): The ImagePotMatrix instance should contain all
             the pot specific data for this image.
           data(dict): related data.
@@ -596,6 +1034,8 @@ class TimeStreamImage(object):
         self._timestream = None
         self._path = None
         self._pixels = None
+        self._order = "RGB"
+        self._scaled = {}
         self._ipm = None
         self.data = {}
 
@@ -619,6 +1059,7 @@ class TimeStreamImage(object):
         new.data = deepcopy(self.data)
         if copy_pixels and self.pixels is not None:
             new._pixels = self._pixels.copy()
+            new._order = self._order
         if copy_timestream:
             new._timestream = self._timestream
         if copy_path:
@@ -656,15 +1097,25 @@ class TimeStreamImage(object):
         if not path.exists(path.dirname(fpath)):
             os.makedirs(path.dirname(fpath))
 
-        cv2.imwrite(fpath, self._pixels[:, :, ::-1])
+        # Converted only for writing, so arrays already handed out from
+        # pixels stay those held
+        cv2.imwrite(fpath, convert_order(self._pixels, self._order, "BGR"))
 
         # Once we have written its ok to set property
         self.path = fpath
 
-    def read(self, fpath=None):
+    def read(self, fpath=None, strict=False):
         """This will refresh pixels
 
-        It differers from pixels in that it always replaces _pixels.
+        It differers from pixels in that it always replaces _pixels. Pixels
+        are decoded by the ``decoder`` of the parent timestream, if it has
+        one, or by whichever decoder is fastest for the format, and kept in
+        the order of channels it gives. They are copied from the
+        ``pixel_cache`` of the parent timestream, or ``PIXEL_CACHE``, if they
+        are cached there.
+
+        Errors decoding the image are logged, and leave the pixels ``None``,
+        unless ``strict`` is given, when they are raised.
         """
         if fpath is None:
             fpath = self._path
@@ -675,20 +1126,31 @@ class TimeStreamImage(object):
             LOG.error(msg)
             raise ValueError(msg)
 
+        self._scaled = {}
         try:
-            import skimage.io
-            try:
-                self._pixels = skimage.io.imread(fpath, plugin="freeimage")
-            except (RuntimeError, ValueError) as exc:
-                LOG.error(str(exc))
-                self._pixels = None
-        except ImportError:
-            LOG.warn("Couln't load scikit image io module. " +
-                     "Raw images will not be loaded correctly")
-            self._pixels = cv2.imread(fpath)[:, :, ::-1]
+            self._pixels, self._order = self._cache.decode(fpath,
+                                                           self._decoder)
+        except (IOError, ValueError) as exc:
+            LOG.error(str(exc))
+            self._pixels = None
+            if strict:
+                raise
 
         self.path = fpath
 
+    @property
+    def _cache(self):
+        if self._timestream is not None and \
+                self._timestream.pixel_cache is not None:
+            return self._timestream.pixel_cache
+        return PIXEL_CACHE
+
+    @property
+    def _decoder(self):
+        if self._timestream is not None:
+            return self._timestream.decoder
+        return None
+
     @property
     def path(self):
         if self._path:
@@ -721,6 +1183,11 @@ class TimeStreamImage(object):
 
     @property
     def ipm(self):
+        """Lazy-loading ImagePotMatrix, read from the pot store of the
+        parent timestream if not set.
+        """
+        if self._ipm is None and self._timestream is not None:
+            self._ipm = self._timestream.read_ipm(self)
         return self._ipm
 
     @ipm.setter
@@ -792,37 +1259,161 @@ class TimeStreamImage(object):
             [:,:,RGB]
         not what OpenCV gives us, which is:
             [:,:,BGR]
-        So we convert OpenCV back to reality and sanity.
+        Pixels are held in whichever order they were decoded or set in (see
+        ``channel_order``), and converted to RGB on first access, as a
+        contiguous array which then replaces those held, so changes made to
+        it are written. Code passing pixels to OpenCV should use
+        ``pixels_as("BGR")`` instead, so BGR pixels are never converted.
+
+        If the ``pixel_cache`` of the parent timestream, or ``PIXEL_CACHE``
+        (see ``timestream.util.imgio``), is enabled, pixels read from a file
+        are kept there, so reading an image again copies them rather than
+        decoding it again. Each image has its own pixels, which can be
+        changed in place.
         """
+        return self.pixels_as("RGB")
+
+    @property
+    def channel_order(self):
+        """The order of the channels of the pixels as they are held, "RGB"
+        or "BGR". Loads the pixels if they aren't loaded.
+        """
+        self._load_pixels()
+        return self._order
+
+    def _load_pixels(self, strict=False):
         if self._pixels is None:
+            if self._timestream is not None and \
+                    self._timestream.version == 2:
+                self._pixels = self._timestream.read_pixels(self.datetime)
+                self._order = "RGB"
+                return
             if not self.path:
                 msg = "``path`` member of TimeStreamImage must be set " + \
                       "before ``pixels`` member is accessed."
                 LOG.error(msg)
                 raise RuntimeError(msg)
 
-            self.read(self._path)
+            self.read(self._path, strict=strict)
+
+    def _check_order(self, order, optional=True):
+        if (order is not None or not optional) and \
+                order not in CHANNEL_ORDERS:
+            msg = "Channels can only be in one of the orders {}, not {}"
+            msg = msg.format(CHANNEL_ORDERS, order)
+            LOG.error(msg)
+            raise ValueError(msg)
+
+    def pixels_as(self, order=None):
+        """Get the pixels with their channels in ``order``, "RGB" or "BGR",
+        or as they are held if ``None`` (see ``channel_order``).
+
+        Pixels held in another order are converted, and the converted pixels
+        are held from then on, so there is only one array to change, and
+        they aren't converted again unless another order is asked for.
+        """
+        self._check_order(order)
+        self._load_pixels()
+        if self._pixels is not None and order is not None and \
+                order != self._order:
+            self._pixels = convert_order(self._pixels, self._order, order)
+            self._order = order
         return self._pixels
 
+    def pixels_window(self, window):
+        """Get the pixels in ``window``, ``(y0, y1, x0, x1)``.
+
+        Images of v2 timestreams only read the window from disk, unless the
+        pixels are already loaded.
+        """
+        if self._pixels is None and self._timestream is not None and \
+                self._timestream.version == 2:
+            return self._timestream.read_pixels(self.datetime, window)
+        y0, y1, x0, x1 = window
+        return self.pixels[y0:y1, x0:x1]
+
+    def pixels_at(self, scale, order="RGB"):
+        """Get the pixels downscaled by ``scale``, 1, 2, 4 or 8, with their
+        channels in ``order``, as in ``pixels_as``.
+
+        If the pixels aren't loaded, images of v1 timestreams are downscaled
+        as they are decoded where possible (see ``read_image``), which for
+        JPEGs is much faster than decoding the whole image. Otherwise the
+        loaded pixels are downscaled. Each scale is cached until the pixels
+        are set or read again.
+        """
+        if scale not in SCALES:
+            msg = "Pixels can only be downscaled by one of {}, not {}".format(
+                SCALES, scale)
+            LOG.error(msg)
+            raise ValueError(msg)
+        self._check_order(order)
+        if scale == 1:
+            return self.pixels_as(order)
+        if scale in self._scaled:
+            scaled, src = self._scaled[scale]
+        elif self._pixels is not None:
+            scaled, src = downscale(self._pixels, scale), self._order
+        elif self._timestream is not None and self._timestream.version == 2:
+            scaled = downscale(self._timestream.read_pixels(self.datetime),
+                               scale)
+            src = "RGB"
+        else:
+            if not self.path:
+                msg = "``path`` member of TimeStreamImage must be set " + \
+                      "before ``pixels_at`` is called."
+                LOG.error(msg)
+                raise RuntimeError(msg)
+            try:
+                scaled, src = self._cache.decode(self.path, self._decoder,
+                                                 scale)
+            except (IOError, ValueError) as exc:
+                LOG.error(str(exc))
+                return None
+        if order is not None and order != src:
+            # As in pixels_as, the converted pixels replace those held
+            scaled, src = convert_order(scaled, src, order), order
+        self._scaled[scale] = (scaled, src)
+        return scaled
+
     @pixels.setter
     def pixels(self, value):
+        self.set_pixels(value)
+
+    def set_pixels(self, value, order="RGB"):
+        """Set the pixels to ``value``, with their channels in ``order``,
+        "RGB" or "BGR", so pixels from OpenCV can be set as they are, without
+        converting them.
+        """
         if not isinstance(value, np.ndarray):
             msg = "Cant set TimeStreamImage.pixels to something not an ndarray"
             LOG.error(msg)
             raise TypeError(msg)
+        self._check_order(order, optional=False)
 
         self._pixels = value
+        self._order = order
+        self._scaled = {}
 
     @pixels.deleter
     def pixels(self):
         del self._pixels
+        self._scaled = {}
 
     def strip(self):
         """Used to strip before pickling"""
         self._pixels = None
+        self._scaled = {}
         if self._ipm:
             self._ipm.strip()
 
+    def __setstate__(self, state):
+        # Images pickled before pixels_at have no downscaled pixels
+        state.setdefault("_scaled", {})
+        # nor their order, which was always RGB
+        state.setdefault("_order", "RGB")
+        self.__dict__.update(state)
+
     @classmethod
     def pickledump(cls, tsi, filepath, overwrite=False):
         if not isinstance(tsi, TimeStreamImage):
@@ -582,8 +582,8 @@ def matchTemplateLocation(Image, Template, EstimatedLocation,
 
 def matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr):
     CropedImage = Image[srchTLCnr[1]:srchBRCnr[1], srchTLCnr[0]:srchBRCnr[0]]
-    corrMap = cv2.matchTemplate(CropedImage.astype(np.uint8),
-                                Template.astype(np.uint8),
+    corrMap = cv2.matchTemplate(CropedImage.astype(np.uint8, copy=False),
+                                Template.astype(np.uint8, copy=False),
                                 cv2.TM_CCOEFF_NORMED)
     _, maxVal, _, maxLoc = cv2.minMaxLoc(corrMap)
     # recalculate max position in cropped image space
@@ -598,16 +598,17 @@ def matchTemplateWindow(Image, Template, srchTLCnr, srchBRCnr):
 def createImagePyramid(Image, NoLevels=5):
     for i in range(NoLevels):
         if i == 0:
-            PyramidImages = [Image.astype(np.uint8)]
+            PyramidImages = [Image.astype(np.uint8, copy=False)]
         else:
             pyr_tmp = cv2.pyrDown(PyramidImages[i - 1])
-            PyramidImages.append(pyr_tmp.astype(np.uint8))
+            PyramidImages.append(pyr_tmp.astype(np.uint8, copy=False))
     return PyramidImages
 
 
 def matchTemplatePyramid(PyramidImages, PyramidTemplates, RotationAngle=None,
                          EstimatedLocation=None, SearchRange=None, NoLevels=4,
                          FinalLevel=1):
+    # Levels of PyramidImages below FinalLevel aren't matched, so may be None
     for i in range(NoLevels - 1, -1, -1):
         if i == NoLevels - 1:
             if EstimatedLocation is None:
@@ -636,7 +637,8 @@ def matchTemplatePyramid(PyramidImages, PyramidTemplates, RotationAngle=None,
                 if maxVal < 0.3 and maxVal180 < 0.3:
                     LOG.warn('Low matching score')
                 if maxVal < maxVal180:
-                    PyramidImages = [np.rot90(Img, 2) for Img in PyramidImages]
+                    PyramidImages = [None if Img is None else np.rot90(Img, 2)
+                                     for Img in PyramidImages]
                     matchedLocImage, matchedLocImage180 = \
                         matchedLocImage180, matchedLocImage
                     maxVal, maxVal180 = maxVal180, maxVal
@@ -1,57 +1,81 @@
 import logging
-import netCDF4 as ncdf
-from netCDF4 import date2num
+from os import path
 
 from timestream.manipulate import (
     NOEOL,
 )
 from timestream.parse import (
+    ts_guess_manifest_v1,
     ts_iter_images,
     ts_iter_numpy,
     ts_parse_date_path,
 )
+from timestream.parse.tsnc import (
+    TimeStreamNetCDF,
+    TSNC_COMPLEVEL,
+)
+from timestream.util import (
+    imap_prefetch,
+)
+
+#: Default number of threads decoding images in ts_to_tsnc
+TSNC_DECODE_THREADS = 4
+
+
+def _read_image(img):
+    return next(ts_iter_numpy([img, ]))
+
+
+def ts_to_tsnc(ts_path, tsnc_path, threads=TSNC_DECODE_THREADS,
+               complevel=TSNC_COMPLEVEL, tile=None, resume=True):
+    """Convert the v1 timestream at ``ts_path`` to a v2 timestream.
+
+    Images are decoded by a pool of ``threads`` threads, a few images ahead
+    of the one being written, and written in batches.
 
+    Args:
+      ts_path(str): Path to the v1 timestream.
+      tsnc_path(str): Path of the netcdf4 file to write.
+      threads(int): Number of threads decoding images.
+      complevel(int): zlib compression level, 1 (fast) to 9 (small).
+      tile(tuple): ``(rows, cols)`` of each chunk of the pixel array. Each
+        chunk is a whole frame if not given.
+      resume(bool): If ``tsnc_path`` exists, only add the images it doesn't
+        have yet, e.g. after a conversion was interrupted. Images are only
+        had once their time is written, after their pixels, so images
+        whose write was interrupted are added again. Otherwise it is
+        overwritten.
 
-def ts_to_tsnc(ts_path, tsnc_path):
+    Returns:
+      int: The number of images added.
+    """
     log = logging.getLogger("CONSOLE")
     # Get timestream images
     imgs = list(ts_iter_images(ts_path))
-    mats = ts_iter_numpy(imgs)
-    # Make netcdf4 file
-    root = ncdf.Dataset(tsnc_path, 'w', format="NETCDF4")
-    root.createGroup('timestream')
-    # Make dimensions
-    # Kludge time!!!
-    mat0 = next(ts_iter_numpy([imgs[0], ]))[1]
-    root.createDimension('y', mat0.shape[0])
-    root.createDimension('x', mat0.shape[1])
-    root.createDimension('z', mat0.shape[2])
-    root.createDimension('t', None)
-    # setup variables
-    times = root.createVariable("time", 'f8', ('t',))
-    times.units = "seconds since 1970-01-01 00:00:00.0"
-    times.calendar = "standard"
-    root.createVariable("z", 'u1', ('z',))
-    root.createVariable("y", 'u4', ('y',))
-    root.createVariable("x", 'u4', ('x',))
-    # create actual pixel array
-    px_type = 'u{d}'.format(mat0.dtype.itemsize)
-    pixels = root.createVariable("pixel", px_type, ('t', 'y', 'x', 'z'),
-                                 zlib=True)
-    log.info("Created netcdf4 file {} with pixel array dimensions {!r}".format(
-        tsnc_path, pixels.shape))
+    if resume and path.exists(tsnc_path):
+        tsnc = TimeStreamNetCDF(tsnc_path, mode="a")
+        done = len(imgs)
+        imgs = [img for img in imgs if ts_parse_date_path(img) not in tsnc]
+        log.info("Resuming {}, {} of {} images left".format(
+            tsnc_path, len(imgs), done))
+    else:
+        manifest = ts_guess_manifest_v1(ts_path)
+        tsnc = TimeStreamNetCDF.create(tsnc_path, manifest["name"],
+                                       manifest["extension"],
+                                       complevel=complevel, tile=tile)
+        log.info("Created netcdf4 file {}".format(tsnc_path))
     # iteratively add images
     count = 0
-    for img, mat in mats:
-        n_dates = len(root.dimensions['t'])
-        time = ts_parse_date_path(img)
-        times[n_dates] = date2num([time, ], units=times.units,
-                                  calendar=times.calendar)
-        pixels[n_dates, :, :, :] = mat
-        count += 1
-        log.debug("Processed {}. Matrix shape is {!r}".format(img,
-                                                              pixels.shape))
-        if count % 2 == 0:
-            log.log(NOEOL, "Processed {: 5d} images.\r".format(count))
+    try:
+        for img, mat in imap_prefetch(_read_image, imgs, threads):
+            tsnc.append(ts_parse_date_path(img), mat)
+            count += 1
+            log.debug("Processed {}. Matrix shape is {!r}".format(img,
+                                                                  mat.shape))
+            if count % 2 == 0:
+                log.log(NOEOL, "Processed {: 5d} images.\r".format(count))
+    finally:
+        # Keep what we have, so we can resume from here.
+        tsnc.close()
     log.info("Processed {: 5d} images. ts_to_tsnc finished!".format(count))
-    root.close()
+    return count
@@ -19,6 +19,8 @@
 from __future__ import absolute_import, division, print_function
 
 import cPickle
+import cStringIO
+import csv
 import cv2
 from itertools import chain
 import logging
@@ -26,15 +28,27 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 from scipy import spatial
+import shutil
 import sys
 import time
 
 from timestream import TimeStreamImage
+from timestream.parse.potstore import PotStore
+from timestream.util.imgio import convert_order
 import timestream.manipulate.correct_detect as cd
 import timestream.manipulate.plantSegmenter as tm_ps
 import timestream.manipulate.pot as tm_pot
 
 LOG = logging.getLogger("CONSOLE")
+#: Factor images are downscaled by to check whether they are too dark, so
+#: that dark images needn't be decoded at full resolution
+DARK_CHECK_SCALE = 8
+
+
+def meanIntensity(tsi):
+    """Mean intensity of the pixels of ``tsi``, from a downscaled image"""
+    # The mean doesn't depend on the order of the channels
+    return np.mean(tsi.pixels_at(DARK_CHECK_SCALE, order=None))
 
 
 class PipeComponent (object):
@@ -74,6 +88,10 @@ class PipeComponent (object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        """ Is executed once all images have been processed. """
+        pass
+
     @classmethod
     def info(cls, _str=True):
         if _str:
@@ -157,25 +175,32 @@ class ImageUndistorter (PipeComponent):
     def __call__(self, context, *args):
         LOG.info(self.mess)
         tsi = args[0]
-        self.image = tsi.pixels
+        # Undistorting doesn't depend on the order of the channels, so the
+        # pixels are kept in the order they were decoded in
+        self.image = tsi.pixels_as(None)
+        self.order = tsi.channel_order
         if self.UndistMapX is not None and self.UndistMapY is not None:
-            self.imageUndistorted = cv2.remap(self.image.astype(np.uint8),
-                                              self.UndistMapX, self.UndistMapY,
-                                              cv2.INTER_CUBIC)
+            self.imageUndistorted = cv2.remap(
+                self.image.astype(np.uint8, copy=False),
+                self.UndistMapX, self.UndistMapY,
+                cv2.INTER_CUBIC)
         else:
             self.imageUndistorted = self.image
 
-        tsi.pixels = cd.rotateImage(self.imageUndistorted, self.rotationAngle)
+        tsi.set_pixels(cd.rotateImage(self.imageUndistorted,
+                                      self.rotationAngle),
+                       self.order)
         return [tsi]
 
     def show(self):
         plt.figure()
         plt.subplot(211)
-        plt.imshow(cd.rotateImage(self.image))
+        plt.imshow(convert_order(cd.rotateImage(self.image), self.order,
+                                 "RGB"))
         plt.title('Original image')
 
         plt.subplot(212)
-        plt.imshow(self.imageUndistorted)
+        plt.imshow(convert_order(self.imageUndistorted, self.order, "RGB"))
         plt.title('Undistorted image')
         plt.show()
 
@@ -221,17 +246,24 @@ class ColorCardDetector (PipeComponent):
     def __call__(self, context, *args):
         LOG.info(self.mess)
         tsi = args[0]
-        self.image = tsi.pixels
-        meanIntensity = np.mean(self.image)
-        if meanIntensity < self.minIntensity:
+        # Level 0 isn't matched, so the pyramid starts from the image at
+        # half scale, which is also dark checked, so the image is only
+        # decoded once more, in full, to extract a card that was found. It
+        # is matched in OpenCV's BGR, so neither it nor the card is
+        # converted.
+        half = None
+        if self.minIntensity > 0 or not self.useWhiteBackground:
+            half = tsi.pixels_at(2, "BGR")
+        if self.minIntensity > 0 and np.mean(half) < self.minIntensity:
             # FIXME: this should be handled with an error.
             LOG.warn('Image is too dark, skiping colorcard detection!')
-            return([self.image, [None, None, None]])
+            return([tsi, [None, None, None]])
         if not self.useWhiteBackground:
-            self.imagePyramid = cd.createImagePyramid(self.image)
-            ccdImg = cv2.imread(self.ccf)[:, :, ::-1]
+            ccdImg = cv2.imread(self.ccf)
             if ccdImg is None:
                 raise ValueError("Failed to read %s" % self.ccf)
+            self.imagePyramid = [None] + cd.createImagePyramid(half,
+                                                               NoLevels=4)
             self.colorcardPyramid = cd.createImagePyramid(ccdImg)
             # create image pyramid for multiscale matching
             SearchRange = [self.colorcardPyramid[0].shape[1],
@@ -245,6 +277,7 @@ class ColorCardDetector (PipeComponent):
             )
             if score > 0.3:
                 # extract color information
+                self.image = tsi.pixels
                 self.foundCard = self.image[
                     loc[1] - ccdImg.shape[0] // 2:loc[1] + ccdImg.shape[0] // 2,
                     loc[0] - ccdImg.shape[1] // 2:loc[0] + ccdImg.shape[1] // 2]
@@ -252,10 +285,10 @@ class ColorCardDetector (PipeComponent):
                                                           GridSize=[6, 4])
                 self.colorcardParams = cd.estimateColorParameters(
                     self.colorcardTrueColors,
-                    self.colorcardColors
+                    self.ccdColors
                 )
                 # Save colourcard image to instance
-                self.colorcardImage = ccdImg
+                self.colorcardImage = convert_order(ccdImg, "BGR", "RGB")
                 # for displaying
                 self.loc = loc
             else:
@@ -263,6 +296,7 @@ class ColorCardDetector (PipeComponent):
                 LOG.warn('Cannot find color card')
                 self.colorcardParams = [None, None, None]
         else:
+            self.image = tsi.pixels
             self.colorcardParams = cd.estimateColorParametersFromWhiteBackground(
                 self.image, self.backgroundWindow, self.maxIntensity)
         return([tsi, self.colorcardParams])
@@ -327,9 +361,9 @@ class ImageColorCorrector (PipeComponent):
         tsi, colorcardParam = args
         image = tsi.pixels
 
-        meanIntensity = np.mean(image)
         colorMatrix, colorConstant, colorGamma = colorcardParam
-        if colorMatrix is not None and meanIntensity > self.minIntensity:
+        if colorMatrix is not None and \
+                meanIntensity(tsi) > self.minIntensity:
             self.imageCorrected = cd.correctColorVectorised(
                 image.astype(np.float),
                 colorMatrix,
@@ -379,9 +413,14 @@ class TrayDetector (PipeComponent):
     def __call__(self, context, *args):
         LOG.info(self.mess)
         tsi = args[0]
-        self.image = tsi.pixels
-        temp = np.zeros_like(self.image)
-        temp[:, :, :] = self.image[:, :, :]
+        # Trays are matched in OpenCV's BGR, the order templates are read in.
+        # Only the matched copy is converted, so the pixels stay in the order
+        # later components use, and aren't converted back.
+        self.image = tsi.pixels_as(None)
+        self.order = tsi.channel_order
+        temp = convert_order(self.image, self.order, "BGR")
+        if temp is self.image:
+            temp = temp.copy()
         temp[:, :, 1] = 0  # suppress green channel
         self.imagePyramid = cd.createImagePyramid(temp)
         self.trayPyramids = []
@@ -391,7 +430,7 @@ class TrayDetector (PipeComponent):
             trayFile = os.path.join(context.ints.path,
                                     self.settingPath,
                                     self.trayFiles % i)
-            trayImage = cv2.imread(trayFile)[:, :, ::-1]
+            trayImage = cv2.imread(trayFile)
             if trayImage is None:
                 LOG.error("Fail to read", trayFile)
             trayImage[:, :, 1] = 0  # suppress green channel
@@ -419,12 +458,12 @@ class TrayDetector (PipeComponent):
         # add tray location information
         context.outputwithimage["trayLocs"] = self.trayLocs
 
-        tsi.pixels = self.image
         return([tsi, self.imagePyramid, self.trayLocs])
 
     def show(self):
         plt.figure()
-        plt.imshow(self.image.astype(np.uint8))
+        plt.imshow(convert_order(self.image, self.order,
+                                 "RGB").astype(np.uint8))
         plt.hold(True)
         PotIndex = 0
         for i, Loc in enumerate(self.trayLocs):
@@ -457,18 +496,21 @@ class PotDetector (PipeComponent):
     def __call__(self, context, *args):
         LOG.info(self.mess)
         tsi, self.imagePyramid, self.trayLocs = args
-        self.image = tsi.pixels
+        # Only shown, so kept in the order the pixels are held in
+        self.image = tsi.pixels_as(None)
+        self.order = tsi.channel_order
         # read pot template image and scale to the pot size
         potFile = os.path.join(
             context.ints.path,
             self.settingPath,
             self.potFile)
-        potImage = cv2.imread(potFile)[:, :, ::-1]
+        potImage = cv2.imread(potFile)
         potTemplateFile = os.path.join(
             context.ints.path,
             self.settingPath,
             self.potTemplateFile)
-        potTemplateImage = cv2.imread(potTemplateFile)[:, :, ::-1]
+        # Matched against the BGR pyramid of TrayDetector
+        potTemplateImage = cv2.imread(potTemplateFile)
         potTemplateImage[:, :, 1] = 0  # suppress green channel
         potTemplateImage = cv2.resize(
             potTemplateImage.astype(np.uint8),
@@ -539,7 +581,8 @@ class PotDetector (PipeComponent):
             ipmPrev = context.ipmPrev
 
         flattened = list(chain.from_iterable(self.potLocs2))
-        growM = round(min(spatial.distance.pdist(flattened)) / 2)
+        # Pots are rectangles of whole pixels, which index the pixels
+        growM = int(round(min(spatial.distance.pdist(flattened)) / 2))
         tsi.ipm = tm_pot.ImagePotMatrix(
             tsi,
             pots=[],
@@ -550,8 +593,8 @@ class PotDetector (PipeComponent):
             trayID = 1
             for center in tray:
                 r = tm_pot.ImagePotRectangle(
-                    center,
-                    tsi.pixels.shape,
+                    [int(round(x)) for x in center],
+                    self.image.shape,
                     growM=growM)
                 p = tm_pot.ImagePotHandler(potID, r, tsi.ipm)
                 p.setMetaId("trayID", trayID)
@@ -564,7 +607,8 @@ class PotDetector (PipeComponent):
 
     def show(self):
         plt.figure()
-        plt.imshow(self.image.astype(np.uint8))
+        plt.imshow(convert_order(self.image, self.order,
+                                 "RGB").astype(np.uint8))
         plt.hold(True)
         PotIndex = 0
         for i, Loc in enumerate(self.trayLocs):
@@ -615,6 +659,10 @@ class PlantExtractor (PipeComponent):
     def __call__(self, context, *args):
         LOG.info(self.mess)
         tsi = args[0]
+        if self.minIntensity > 0 and meanIntensity(tsi) < self.minIntensity:
+            # Keep the pots of the last image segmented in context
+            LOG.warn('Image is too dark, skipping segmentation!')
+            return [tsi]
         img = tsi.pixels
         self.ipm = tsi.ipm
 
@@ -652,7 +700,8 @@ class PlantExtractor (PipeComponent):
             # Child Section
             try:
                 os.close(In)
-                msk = cPickle.dumps(iph.getSegmented())
+                msk = cPickle.dumps(tm_pot.PackedMask(iph.getSegmented()),
+                                    cPickle.HIGHEST_PROTOCOL)
                 cOut = os.fdopen(Out, "wb", sys.getsizeof(msk))
                 cOut.write(msk)
                 cOut.close()
@@ -710,6 +759,14 @@ class ResultingFeatureWriter_ndarray (PipeComponent):
     runReturns = [TimeStreamImage]
 
     def __init__(self, context, **kwargs):
+        """ Features are appended to memory-mapped arrays as each image is
+        processed (see PotStore), and written to the npz file once, by close.
+        There is no npz file until close is called, which ImagePipeline.close
+        does, so drivers must close the pipeline once processing stops.
+
+        A run that was killed before close left its features in the arrays,
+        and the next run adds to them.
+        """
         super(ResultingFeatureWriter_ndarray, self).__init__(**kwargs)
 
         # np.savez_compressed expects an npz extension
@@ -721,43 +778,31 @@ class ResultingFeatureWriter_ndarray (PipeComponent):
         if os.path.exists(self.outputfile):
             raise Exception("File %s already exists" % self.outputfile)
 
+        self.store = PotStore(os.path.splitext(self.outputfile)[0]
+                              + ".featmat")
+
     def __call__(self, context, *args):
         LOG.info(self.mess)
         ipm = args[0].ipm
+        self.store.write(context.origImg.datetime, *ipm.asArrays())
 
-        # Get timestamp of current image.
-        ts = time.mktime(context.origImg.datetime.timetuple()) * 1000
-
-        if not os.path.isfile(self.outputfile):
-            fNames = np.array(ipm.potFeatures)
-            pIds = np.array(ipm.potIds)
-            tStamps = np.array([ts])
-
-        else:
-            npload = np.load(self.outputfile)
-            fNames = npload["fNames"]
-            pIds = npload["pIds"]
-            featMat = npload["featMat"]
-            tStamps = npload["tStamps"]
-            tStamps = np.append(tStamps, ts)  # New timestamp
-
-        tmpMat = np.zeros([fNames.shape[0], pIds.shape[0], 1])
-        for pId, pot in ipm.iter_through_pots():
-            for fName, fVal in pot.getCalcedFeatures().iteritems():
-                fOff = np.where(fNames == fName)
-                pOff = np.where(pIds == pId)
-                tmpMat[fOff, pOff, 0] = fVal
-
-        if "featMat" not in locals():
-            featMat = tmpMat
-        else:
-            featMat = np.concatenate((featMat, tmpMat), axis=2)
+        return (args[0])
 
+    def close(self):
+        """ Export the (feature, pot, time) matrix to the npz file. Must be
+        called for the features to be written, see __init__. """
+        if len(self.store) == 0:
+            return
+        dts, featMat = self.store.features()
+        # Features a pot didn't have are 0.
+        featMat = np.nan_to_num(np.transpose(featMat, (2, 1, 0)))
+        tStamps = np.array([time.mktime(dt.timetuple()) * 1000
+                            for dt in dts.tolist()])
         np.savez_compressed(self.outputfile,
-                            **{"fNames": fNames, "pIds": pIds,
-                                "featMat": featMat, "tStamps": tStamps})
-
-        return (args[0])
+                            **{"fNames": np.array(self.store.feature_names),
+                               "pIds": np.array(self.store.pot_ids),
+                               "featMat": featMat, "tStamps": tStamps})
+        shutil.rmtree(self.store.store_dir)
 
 
 class ResultingFeatureWriter_csv (PipeComponent):
@@ -766,12 +811,31 @@ class ResultingFeatureWriter_csv (PipeComponent):
         "mess": [False, "Default message", "Writing the features"],
         "outputdir": [False, "Dir where the output files go", None],
         "overwrite": [False, "Whether to overwrite out files", True],
+        "longformat": [False, "Write all features to this one csv file in "
+                       "outputdir, named as given, a row per pot and "
+                       "feature, instead of a file per feature", None],
+        "flushrows": [False, "Write buffered rows once there are this many",
+                      1000],
+        "flushsecs": [False, "Write buffered rows at least this often",
+                      60],
     }
 
     runExpects = [TimeStreamImage]
     runReturns = [TimeStreamImage]
 
+    # Columns of the long format file
+    longHeader = ["timestamp", "potId", "metaids", "feature", "value"]
+
     def __init__(self, context, **kwargs):
+        """ Rows are buffered, and written to files which are kept open,
+        once there are flushrows of them, every flushsecs, and on close.
+
+        A long format file has the same columns whatever the pots and
+        features, so files written by separate runs (e.g. for parts of a
+        timestream, in parallel) can be concatenated. The metaids of each
+        pot are one field of "key=value" pairs separated by ";", quoted as
+        csv fields are if they contain ";".
+        """
         super(ResultingFeatureWriter_csv, self).__init__(**kwargs)
 
         if self.outputdir is None:
@@ -788,8 +852,13 @@ class ResultingFeatureWriter_csv (PipeComponent):
             os.makedirs(self.outputdir)
 
         # Are there any feature csv files? We check all possible features.
-        for fName in tm_ps.StatParamCalculator.statParamMethods():
-            outputfile = os.path.join(self.outputdir, fName + ".csv")
+        if self.longformat is not None:
+            fNames = [self.longformat]
+        else:
+            fNames = [fName + ".csv" for fName in
+                      tm_ps.StatParamCalculator.statParamMethods()]
+        for fName in fNames:
+            outputfile = os.path.join(self.outputdir, fName)
             if os.path.exists(outputfile):
                 if self.overwrite:
                     os.remove(outputfile)
@@ -797,35 +866,79 @@ class ResultingFeatureWriter_csv (PipeComponent):
                     raise Exception("%s might have important info"
                                     % outputfile)
 
+        # Open files, their csv writers, and their buffered rows, by file
+        # name
+        self._files = {}
+        self._writers = {}
+        self._rows = {}
+        self._numRows = 0
+        self._lastFlush = time.time()
+
+    def _buffer(self, fName, row, header):
+        """ Buffer row for the file fName, opening it if needed """
+        if fName not in self._files:
+            outputfile = os.path.join(self.outputdir, fName)
+            self._files[fName] = open(outputfile, "ab")
+            self._writers[fName] = csv.writer(self._files[fName],
+                                              lineterminator="\n")
+            self._rows[fName] = []
+            if self._files[fName].tell() == 0:  # we initialize it.
+                self._rows[fName].append(header)
+        self._rows[fName].append(row)
+        self._numRows += 1
+
+    def _metaIds(self, pot):
+        """ The metaids of pot as one field, quoting any containing ";" """
+        mids = cStringIO.StringIO()
+        csv.writer(mids, delimiter=";", lineterminator="").writerow(
+            ["%s=%s" % (k, pot.getMetaId(k))
+             for k in sorted(pot.getMetaIdKeys())])
+        return mids.getvalue()
+
     def __call__(self, context, *args):
         LOG.info(self.mess)
         ipm = args[0].ipm
-        ts = time.mktime(context.origImg.datetime.timetuple()) * 1000
-
-        for fName in ipm.potFeatures:
-            outputfile = os.path.join(self.outputdir, fName + ".csv")
-
-            # Sorted so we can easily append after.
-            potIds = sorted(ipm.potIds)
-
-            if not os.path.exists(outputfile):  # we initialize it.
-                fd = open(outputfile, "w+")
-                fd.write("timestamp")
-                for potId in potIds:
-                    fd.write(",%s" % potId)
-                fd.write("\n")
-                fd.close()
-
-            fd = open(outputfile, 'a')
-            fd.write("%f" % ts)
-            for potId in potIds:
-                pot = ipm.getPot(potId)
-                fd.write(",%f" % pot.getCalcedFeatures()[fName])
-            fd.write("\n")
-            fd.close()
+        ts = "%f" % (time.mktime(context.origImg.datetime.timetuple()) * 1000)
+
+        # Sorted so we can easily append after.
+        pots = sorted(ipm.iter_through_pots())
+        if self.longformat is not None:
+            for potId, pot in pots:
+                mids = self._metaIds(pot)
+                for feat, val in pot.getCalcedFeatures().iteritems():
+                    self._buffer(self.longformat, [ts, str(potId), mids, feat,
+                                                   "%f" % val],
+                                 self.longHeader)
+        else:
+            header = ["timestamp"] + [str(potId) for potId, _ in pots]
+            for fName in ipm.potFeatures:
+                row = [ts] + ["%f" % pot.getCalcedFeatures().get(fName, np.nan)
+                              for _, pot in pots]
+                self._buffer(fName + ".csv", row, header)
+
+        if self._numRows >= self.flushrows or \
+                time.time() - self._lastFlush >= self.flushsecs:
+            self.flush()
 
         return (args[0])
 
+    def flush(self):
+        """ Write all buffered rows """
+        for fName, rows in self._rows.iteritems():
+            self._writers[fName].writerows(rows)
+            self._files[fName].flush()
+            del rows[:]
+        self._numRows = 0
+        self._lastFlush = time.time()
+
+    def close(self):
+        self.flush()
+        for fd in self._files.itervalues():
+            fd.close()
+        self._files = {}
+        self._writers = {}
+        self._rows = {}
+
 
 class ResultingImageWriter (PipeComponent):
     actName = "imagewrite"
@@ -850,8 +963,10 @@ class ResultingImageWriter (PipeComponent):
         for key, value in context.outputwithimage.iteritems():
             img.data[key] = value
 
+        # Metadata is written when ts_out is closed, or every so often.
+        if not ts_out.in_batch:
+            ts_out.batch()
         ts_out.write_image(img)
-        ts_out.write_metadata()
         img.parent_timestream = None  # reset to move forward
 
         return [img]
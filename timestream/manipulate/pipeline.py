@@ -96,6 +96,13 @@ class ImagePipeline (object):
                 elem.show()
         return (res)
 
+    def close(self):
+        """ Finish up, once all images have been processed. Components
+        may only write their output here, so call it even if processing
+        stops early. """
+        for elem in self.pipeline:
+            elem.close()
+
     @classmethod
     def printCompList(cls):
         for clKey, clVal in ImagePipeline.complist.iteritems():
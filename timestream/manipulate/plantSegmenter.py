@@ -287,8 +287,7 @@ class PotSegmenter_Method1(PotSegmenter):
             if indx[0].shape[0] < self.blobMinSize:
                 mask[indx] = 0
 
-        indx = np.where(mask != 0)
-        mask[indx] = 1
+        mask = (mask != 0).astype(np.uint8)
 
         return ([mask, hints])
 
@@ -357,14 +356,14 @@ class PotSegmenter_KmeansSquare(PotSegmenter):
 
         labels = np.reshape(labels, (oShape[0], oShape[1]), order="F")
 
-        labels = labels.astype(np.float64)
+        labels = labels.astype(np.uint8)
         # FIXME: do this check if we don't have mean centers.
-        FG = sum(sum(labels == 1))
-        BG = sum(sum(labels == 0))
+        FG = np.count_nonzero(labels == 1)
+        BG = np.count_nonzero(labels == 0)
         if BG < FG:
-            labels = -(labels - 1)
+            labels = 1 - labels
 
-        return (labels.astype(np.float64))
+        return (labels)
 
 # FIXME: Find a better place to put this.
 segmentingMethods = {"k-means-square": PotSegmenter_KmeansSquare,
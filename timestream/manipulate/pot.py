@@ -21,6 +21,69 @@ import matplotlib.pyplot as plt
 import timestream.manipulate.plantSegmenter as tm_ps
 
 
+class PackedMask(object):
+
+    def __init__(self, mask):
+        """ A binary mask, stored in a fraction of the space of an array.
+
+        The mask is run-length encoded if that is smaller, as with sparse
+        plants, or bit-packed otherwise. It is only expanded back into an
+        array when needed, by unpack or anything converting it to an array.
+
+        Args:
+          mask(ndarray): 2D array, where non-zero values are in the mask.
+
+        Attributes:
+          shape(tuple): Shape of the mask.
+          _bits(ndarray): The packed mask, if bit-packed.
+          _runs(ndarray): Indices of the flattened mask where its value
+            changes, if run-length encoded.
+          _first(bool): Value of the first element, if run-length encoded.
+          _count(int): Number of elements in the mask.
+        """
+        mask = np.asarray(mask)
+        self.shape = mask.shape
+        flat = mask.ravel() != 0
+        self._count = int(np.count_nonzero(flat))
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        if changes.size * 4 < (flat.size + 7) // 8:
+            self._bits = None
+            self._runs = changes.astype(np.uint32)
+            self._first = bool(flat[0])
+        else:
+            self._bits = np.packbits(flat)
+            self._runs = None
+            self._first = None
+
+    def unpack(self):
+        """ Return the mask as a uint8 array of 0s and 1s """
+        size = int(np.prod(self.shape))
+        if self._bits is not None:
+            flat = np.unpackbits(self._bits)[:size]
+        else:
+            # The value flips at the start of each run.
+            flat = np.zeros(size, dtype=np.uint8)
+            flat[self._runs] = 1
+            if self._first:
+                flat[0] = 1
+            flat = np.bitwise_xor.accumulate(flat)
+        return flat.reshape(self.shape)
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.unpack()
+        return self.unpack().astype(dtype)
+
+    def any(self):
+        return self._count > 0
+
+    @property
+    def nbytes(self):
+        if self._bits is not None:
+            return self._bits.nbytes
+        return self._runs.nbytes
+
+
 class ImagePotRectangle(object):
 
     def __init__(self, rectDesc, imgSize, growM=100):
@@ -121,7 +184,8 @@ class ImagePotHandler(object):
           image(ndarray): Return the cropped image (defined by rect) of
             self._ipm.image.
           maskedImage: Return the segmented cropped image.
-          mask,_mask(ndarray): binary image represenging the mask.
+          mask(ndarray): binary image represenging the mask.
+          packedMask,_mask(PackedMask): The mask, as kept.
           features: Return the calculated features
 
         Raises:
@@ -135,8 +199,8 @@ class ImagePotHandler(object):
 
         if not isinstance(rect, ImagePotRectangle):
             raise TypeError("rect must be an instance of ImagePotRectangle")
-        if rect.imgSize[0] != self._ipm.image.pixels.shape[0] \
-                or rect.imgSize[1] != self._ipm.image.pixels.shape[1]:
+        imgSize = self._ipm.imgSize
+        if rect.imgSize[0] != imgSize[0] or rect.imgSize[1] != imgSize[1]:
             raise RuntimeError("rect size must be equal to superImage shape")
         self._rect = rect
 
@@ -165,23 +229,33 @@ class ImagePotHandler(object):
                                 + "int, long, float, complex or string")
 
     @property
-    def mask(self):
+    def packedMask(self):
         if self._mask is not None:
             return self._mask
 
         if self._ps is None:
-            return np.zeros([self._rect.height, self._rect.width],
-                            np.dtype("float64"))
+            return PackedMask(np.zeros([self._rect.height, self._rect.width],
+                                       np.dtype("uint8")))
 
-        self._mask = self.getSegmented()
+        self._mask = PackedMask(self.getSegmented())
         return (self._mask)
 
+    @property
+    def mask(self):
+        """ Expanded on every access, so keep the result if needed twice """
+        return self.packedMask.unpack()
+
     @mask.setter
     def mask(self, m):
-        if m is not None:
-            raise ValueError("Can only reset mask to None")
+        """ Set to None to reset, or to an ndarray or PackedMask """
+        if m is None or isinstance(m, PackedMask):
+            pass
+        elif isinstance(m, np.ndarray):
+            m = PackedMask(m)
+        else:
+            raise TypeError("mask must be None, ndarray or PackedMask")
 
-        # Resetting mask invalidates calculated features.
+        # Setting mask invalidates calculated features.
         self._features = {}
         self._mask = m
 
@@ -239,44 +313,24 @@ class ImagePotHandler(object):
         msk, hint = self._ps.segment(self._image, {})
 
         # if bad segmentation
-        if 1 not in msk and self.iphPrev is not None:
+        if not np.any(msk) and self.iphPrev is not None:
             # We try previous mask. This is tricky because we need to fit the
             # previous mask size into msk
             pm = self.iphPrev.mask
 
-            vDiff = msk.shape[0] - pm.shape[0]
-            if vDiff < 0:  # reduce pm vertically
-                side = True
-                for i in range(abs(vDiff)):
-                    if side:
-                        pm = pm[1:, :]
-                    else:
-                        pm = pm[:-1, :]
-                    side = not side
-
-            if vDiff > 0:  # grow pm vertically
-                padS = np.array([1, 0])
-                for i in range(abs(vDiff)):
-                    pm = np.lib.pad(pm, (padS.tolist(), (0, 0)), 'constant',
-                                    constant_values=0)
-                    padS = -(padS - 1)  # other side
-
-            hDiff = msk.shape[1] - pm.shape[1]
-            if hDiff < 0:  # reduce pm horizontally
-                side = True
-                for i in range(abs(hDiff)):
-                    if side:
-                        pm = pm[:, 1:]
-                    else:
-                        pm = pm[:, :-1]
-                    side = not side
-
-            if hDiff > 0:  # grow pm horizontally
-                padS = np.array([1, 0])
-                for i in range(abs(hDiff)):
-                    pm = np.lib.pad(pm, ((0, 0), padS.tolist()), 'constant',
-                                    constant_values=0)
-                    padS = -(padS - 1)  # other side
+            # Crop or pad pm on both sides, the first side by one more if
+            # the difference is odd.
+            for axis in (0, 1):
+                diff = msk.shape[axis] - pm.shape[axis]
+                first = (abs(diff) + 1) // 2
+                if diff < 0:  # reduce pm
+                    idx = [slice(None), slice(None)]
+                    idx[axis] = slice(first, pm.shape[axis] + diff + first)
+                    pm = pm[tuple(idx)]
+                elif diff > 0:  # grow pm
+                    pad = [(0, 0), (0, 0)]
+                    pad[axis] = (first, diff - first)
+                    pm = np.lib.pad(pm, pad, 'constant', constant_values=0)
 
             msk = pm
 
@@ -407,7 +461,8 @@ class ImagePotHandler(object):
             self._mids[mKey] = mValue
 
     def strip(self):
-        self._mask = None
+        # Packed masks are small enough to keep, e.g. for iphPrev.
+        pass
 
 
 class ImagePotMatrix(object):
@@ -433,6 +488,8 @@ class ImagePotMatrix(object):
           _pots(dict): Pots indexed by pot IDs.
           _image(TimeStreamImage): Image where all the pots fit. Set only once.
           _ipmPrev(ImagePotMatrix): Previous ImagePotMatrix. Set only once.
+          _imgSize(tuple): (height, width) of the image, if known without
+            reading its pixels.
         """
         # import here to avoid circular imports
         from timestream import TimeStreamImage
@@ -455,6 +512,7 @@ class ImagePotMatrix(object):
             raise TypeError("pots must be a list")
         potIndex = -1  # Used when creating from rect
         self._pots = {}
+        self._imgSize = None
         for p in pots:
             if isinstance(p, ImagePotMatrix):
                 self._pots[p.id] = p
@@ -481,6 +539,14 @@ class ImagePotMatrix(object):
     def ipmPrev(self):
         return self._ipmPrev
 
+    @property
+    def imgSize(self):
+        """ (height, width) of the image, read from its pixels if unknown """
+        # ImagePotMatrix pickled before _imgSize don't have it
+        if getattr(self, "_imgSize", None) is not None:
+            return self._imgSize
+        return self._image.pixels.shape[0:2]
+
     @ipmPrev.setter
     def ipmPrev(self, val):
         if not isinstance(val, ImagePotMatrix) and val is not None:
@@ -550,3 +616,55 @@ class ImagePotMatrix(object):
         self._ipmPrev = None
         for key, pot in self._pots.iteritems():
             pot.strip()
+
+    def asArrays(self):
+        """ Return the pots as arrays, as stored by PotStore.
+
+        Returns:
+          (imgSize, potIds, rects, featNames, features, metaids): Where rects
+            is a (N,4) array, features a (N,F) array with NaN for features not
+            calculated and metaids a list of dicts, for the N pots in potIds
+            and F features in featNames.
+        """
+        potIds = sorted(self._pots.keys())
+        featNames = self.potFeatures
+        pots = [self._pots[potId] for potId in potIds]
+        if len(pots) > 0:
+            imgSize = pots[0].rect.imgSize
+        else:
+            imgSize = self.imgSize
+        rects = np.array([pot.rect.asList() for pot in pots],
+                         dtype=np.int32).reshape((-1, 4))
+        features = np.array(
+            [[pot.getCalcedFeatures().get(fName, np.nan)
+              for fName in featNames] for pot in pots],
+            dtype=np.float64).reshape((len(pots), len(featNames)))
+        metaids = [dict(pot._mids) for pot in pots]
+        return (imgSize, potIds, rects, featNames, features, metaids)
+
+    @classmethod
+    def fromArrays(cls, image, potIds, rects, featNames=(), features=None,
+                   metaids=None, imgSize=None):
+        """ Make the ImagePotMatrix of image from arrays, as from asArrays.
+
+        Pots with a rect of -1s are missing, and are skipped. As are NaN
+        features. Given the (height, width) imgSize of the image, as stored
+        with the arrays, its pixels needn't be read.
+        """
+        ipm = cls(image)
+        if imgSize is not None and min(imgSize[0:2]) > 0:
+            ipm._imgSize = (int(imgSize[0]), int(imgSize[1]))
+        for i, potId in enumerate(potIds):
+            if np.all(rects[i] == -1):
+                continue
+            r = ImagePotRectangle([int(x) for x in rects[i]],
+                                  ipm.imgSize)
+            mids = None
+            if metaids is not None:
+                mids = dict(metaids[i])
+            pot = ImagePotHandler(potId, r, ipm, metaids=mids)
+            for j, fName in enumerate(featNames):
+                if not np.isnan(features[i, j]):
+                    pot._features[fName] = float(features[i, j])
+            ipm.addPot(pot)
+        return ipm
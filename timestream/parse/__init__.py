@@ -21,18 +21,17 @@
 .. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
 """
 
+import bisect
 import collections
-import cv2
 from datetime import (
     datetime,
     timedelta,
 )
 import glob
-from itertools import (
-    ifilter,
-)
 import json
 import logging
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import os
 from os import path
 from voluptuous import MultipleInvalid
@@ -48,11 +47,38 @@ from timestream.parse.validate import (
 from timestream.util import (
     PARAM_TYPE_ERR,
     dict_unicode_to_str,
+    json_dump_atomic,
+)
+from timestream.util.imgio import (
+    read_image,
 )
+from timestream.util.validation import (
+    strptime_fixed,
+)
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 #: Default timestream manifest extension
 MANIFEST_EXT = "tsm"
+#: File name of the persistent image index, stored under a timestream's _data
+TS_INDEX_FNAME = "image_index.json"
 LOG = logging.getLogger("timestreamlib")
+# Number of date-named directory levels above each image in a v1 timestream
+_TS_V1_DIR_DEPTH = len(path.dirname(TS_V1_FMT).split(os.sep))
+# Indices loaded by ts_load_index, keyed by absolute timestream path
+_TS_INDEX_CACHE = {}
+# Manifests read by ts_get_manifest, keyed by absolute timestream path
+_TS_MANIFEST_CACHE = {}
+#: Default number of threads used to list directories when scanning
+SCAN_THREADS = 8
+# Thread pools used by ts_scan_sorted, keyed by (process id, size)
+_SCAN_POOLS = {}
 
 
 def _ts_has_manifest(ts_path):
@@ -69,18 +95,92 @@ def _ts_has_manifest(ts_path):
         return False
 
 
+def _ts_date_str_path(img):
+    """Get the date string from an image path like TS_V1_FMT's file name"""
+    base = path.splitext(path.basename(img))[0]
+    # The date is the fixed-width field before the _NN image number, which
+    # works even if the timestream name has underscores in it.
+    string_time = base[-22:-3]
+    if len(string_time) == 19 and base[-3] == "_":
+        return string_time
+    return "_".join(base.split("_")[1:7])
+
+
 def ts_parse_date_path(img):
-    basename = path.basename(img)
-    fields = basename.split("_")[1:7]
-    string_time = "_".join(fields)
-    return ts_parse_date(string_time)
+    try:
+        return strptime_fixed(_ts_date_str_path(img))
+    except ValueError:
+        fields = path.basename(img).split("_")[1:7]
+        return ts_parse_date("_".join(fields))
 
 
 def ts_parse_date(dt):
     if isinstance(dt, datetime):
         return dt
     else:
-        return datetime.strptime(dt, TS_DATE_FORMAT)
+        return strptime_fixed(dt)
+
+
+# Positions of the digits of each field in a TS_DATE_FORMAT date
+_TS_DATE_FIELDS = [(0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19)]
+
+
+def ts_parse_dates(dates):
+    """Parse a sequence of dates in TS_DATE_FORMAT all at once.
+
+    The fixed-width fields are converted to integers for all dates with array
+    operations. Dates that fail this fast path are parsed one at a time by
+    ``ts_parse_date``, which raises the ValueError for malformed ones.
+
+    :param dates: Sequence of date strings.
+    :returns: ``datetime64[s]`` array of the dates, in the same order.
+    :raises: ValueError
+    """
+    # One byte longer than a date, so that longer strings aren't truncated
+    # into valid-looking ones.
+    strs = np.asarray(dates, dtype="S20")
+    if len(strs) == 0:
+        return np.array([], dtype="datetime64[s]")
+    chars = strs.view(np.uint8).reshape(len(strs), 20).astype(np.int64)
+    seps = chars[:, [4, 7, 10, 13, 16]]
+    digits = np.delete(chars[:, :19], [4, 7, 10, 13, 16], axis=1) - ord("0")
+    ok = (seps == ord("_")).all(axis=1) & (chars[:, 19] == 0) & \
+        ((digits >= 0) & (digits <= 9)).all(axis=1)
+    # Each field's value from its digits
+    fields = []
+    start = 0
+    for first, last in _TS_DATE_FIELDS:
+        width = last - first
+        scale = 10 ** np.arange(width - 1, -1, -1)
+        fields.append((digits[:, start:start + width] * scale).sum(axis=1))
+        start += width
+    year, month, day, hour, minute, second = fields
+    ok &= (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & \
+        (minute < 60) & (second < 60)
+    month = np.where(ok, month, 1)
+    day = np.where(ok, day, 1)
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # Catch days past the end of their month
+    ok &= days.astype("datetime64[M]") == months
+    times = days.astype("datetime64[s]") + \
+        (hour * 3600 + minute * 60 + second).astype("timedelta64[s]")
+    for iii in np.flatnonzero(~ok):
+        times[iii] = ts_parse_date(str(dates[iii]))
+    return times
+
+
+def ts_dates_to_datetime64(dates):
+    """Convert a sequence of datetimes or formatted dates to a sorted
+    ``datetime64[s]`` array.
+    """
+    strs = [date for date in dates if not isinstance(date, datetime)]
+    times = np.concatenate([
+        ts_parse_dates(strs),
+        np.array([date for date in dates if isinstance(date, datetime)],
+                 dtype="datetime64[s]"),
+    ])
+    return np.sort(times)
 
 
 def ts_format_date(dt):
@@ -104,58 +204,57 @@ def ts_guess_manifest(ts_path):
 
 def ts_guess_manifest_v1(ts_path):
     """Guesses the values of manifest fields in a timestream
+
+    This makes a single pass over the timestream in sorted order, keeping
+    running statistics for each image extension, so memory use does not grow
+    with the number of images.
     """
-    # This whole thing's one massive fucking kludge. But it seems to work
-    # pretty good so, well, whoop.
     retval = {}
-    # get a sorted list of all files
-    all_files = []
-    for root, folders, files in os.walk(ts_path):
-        for folder in folders:
-            if folder.startswith("_"):
-                folders.remove(folder)
-        for fle in files:
-            all_files.append(path.join(root, fle))
-    all_files = sorted(all_files)
-    # find most common extension, and assume this is the ext
-    exts = collections.Counter(IMAGE_EXT_CONSTANTS)
-    our_exts = map(lambda x: path.splitext(x)[1][1:], all_files)
-    our_exts = ifilter(lambda x: x.lower() in IMAGE_EXT_CONSTANTS, our_exts)
-    for ext in our_exts:
+    # Running statistics for each image extension, as we see images in order
+    stats = {}
+    for fle in _ts_iter_sorted_files(ts_path):
+        ext = path.splitext(fle)[1][1:]
+        if ext.lower() not in IMAGE_EXT_CONSTANTS:
+            continue
         try:
-            exts[ext] += 1
+            stat = stats[ext]
         except KeyError:
-            pass
-    # most common gives list of tuples. [0] = (ext, count), [0][0] = ext
-    retval["extension"] = exts.most_common(1)[0][0]
-    all_files = ifilter(
-        lambda x: path.splitext(x)[1][1:] == retval["extension"],
-        all_files)
+            stat = stats[ext] = {"count": 0, "first": None, "last": None,
+                                 "interval": None, "error": None}
+        stat["count"] += 1
+        if stat["error"] is not None:
+            continue
+        try:
+            time = ts_parse_date_path(fle)
+        except ValueError as exc:
+            # Only an error if this turns out to be the timestream's ext
+            stat["error"] = exc
+            continue
+        if stat["last"] is None:
+            stat["first"] = time
+        else:
+            interval = int((time - stat["last"]).total_seconds())
+            if stat["interval"] is None or interval < stat["interval"]:
+                stat["interval"] = interval
+        stat["last"] = time
+    if not stats:
+        msg = "{} is an invalid V1 timestream".format(ts_path)
+        LOG.error(msg)
+        raise ValueError(msg)
+    # find most common extension, and assume this is the ext
+    retval["extension"] = max(stats, key=lambda x: stats[x]["count"])
+    stat = stats[retval["extension"]]
+    if stat["error"] is not None:
+        raise stat["error"]
     # get image type from extension:
     try:
         retval["image_type"] = IMAGE_EXT_TO_TYPE[retval["extension"]]
     except KeyError:
         retval["image_type"] = None
-    # Get list of images:
-    images = ifilter(
-        lambda x: path.splitext(x)[1][1:] == retval["extension"],
-        all_files)
-    # decode times from images:
-    times = map(ts_parse_date_path, sorted(images))
-    # get first and last dates:
-    try:
-        retval["start_datetime"] = ts_format_date(times[0])
-        retval["end_datetime"] = ts_format_date(times[-1])
-    except IndexError:
-        msg = "{} is an invalid V1 timestream".format(ts_path)
-        LOG.error(msg)
-        raise ValueError(msg)
-    # Get time intervals between images
-    intervals = list()
-    for iii in range(len(times) - 1):
-        interval = times[iii + 1] - times[iii]
-        intervals.append(interval.seconds)
-    retval["interval"] = max(min(intervals), 1)
+    retval["start_datetime"] = ts_format_date(stat["first"])
+    retval["end_datetime"] = ts_format_date(stat["last"])
+    # Single-image timestreams get the minimum interval
+    retval["interval"] = max(stat["interval"] or 1, 1)
     retval["name"] = path.basename(ts_path.rstrip(os.sep))
     # This is dodgy isn't it :S
     retval["missing"] = []
@@ -164,8 +263,411 @@ def ts_guess_manifest_v1(ts_path):
     return retval
 
 
-def all_files_with_ext(topdir, ext, cs=False):
+def _ts_iter_sorted_files(topdir, threads=None):
+    """Iterate over the names of all files below ``topdir`` in sorted order,
+    skipping directories starting with ``_``.
+    """
+    for root, fle in ts_scan_sorted(topdir, threads):
+        yield fle
+
+
+def _list_dir(dirpath):
+    """List ``dirpath``, returning sorted lists of its files & subdirectories.
+
+    Subdirectories starting with ``_`` are skipped, as are symlinks to
+    directories, as in ``os.walk``. Unreadable directories are empty.
+    """
+    files = []
+    folders = []
+    try:
+        if scandir is not None:
+            # scandir gets the type from the listing itself, without a stat
+            # per entry where the OS allows it.
+            for entry in scandir(dirpath):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        folders.append(entry.name)
+                else:
+                    files.append(entry.name)
+        else:
+            for name in os.listdir(dirpath):
+                full = path.join(dirpath, name)
+                if path.isdir(full):
+                    if not path.islink(full):
+                        folders.append(name)
+                else:
+                    files.append(name)
+    except (IOError, OSError):
+        LOG.debug("Couldn't list {}".format(dirpath))
+    folders = [x for x in folders if not x.startswith("_")]
+    return sorted(files), sorted(folders)
+
+
+def ts_scan_sorted(topdir, threads=None):
+    """Iterate over all files below ``topdir``, in sorted order.
+
+    Directories are listed in a pool of ``threads`` threads, so that the
+    listings of sibling year, month, day and hour directories are fetched
+    concurrently, which hides the per-directory latency of network
+    filesystems. Files are still yielded in the same order a sorted, top-down
+    ``os.walk`` would give, i.e. chronologically for a v1 timestream.
+    Directories starting with ``_`` are skipped.
+
+    :param str topdir: Directory to scan.
+    :param int threads: Number of threads to list directories with. Defaults
+                        to ``SCAN_THREADS``; 1 scans serially.
+    :returns: generator of ``(directory, file name)`` tuples.
+    """
+    if threads is None:
+        threads = SCAN_THREADS
+    if threads <= 1:
+        stack = [(topdir, _list_dir(topdir))]
+        while stack:
+            dirpath, (files, folders) = stack.pop()
+            for fle in files:
+                yield dirpath, fle
+            stack.extend((path.join(dirpath, x), _list_dir(path.join(
+                dirpath, x))) for x in reversed(folders))
+        return
+    # Pools are expensive to start, so they are kept for the life of the
+    # process. Forked children can't use their parent's threads.
+    key = (os.getpid(), threads)
+    pool = _SCAN_POOLS.get(key)
+    if pool is None:
+        pool = _SCAN_POOLS[key] = ThreadPool(threads)
+    # A stack in depth-first order of directories whose listings have been
+    # requested. Subdirectory listings are requested as soon as their parent
+    # is reached, so the pool works ahead of the consumer, while only
+    # listings along the current path are held in memory.
+    stack = [(topdir, pool.apply_async(_list_dir, (topdir, )))]
+    while stack:
+        dirpath, listing = stack.pop()
+        files, folders = listing.get()
+        children = [path.join(dirpath, x) for x in folders]
+        stack.extend((x, pool.apply_async(_list_dir, (x, )))
+                     for x in children[::-1])
+        for fle in files:
+            yield dirpath, fle
+
+
+class TimeStreamIndex(object):
+
+    def __init__(self, ts_path):
+        """A persistent index of the image timestamps in a v1 timestream.
+
+        The index is built from a single walk of the timestream and stored
+        as JSON under ``_data/``, so that checking whether an image exists at
+        a timepoint never needs to touch the filesystem. The mtime of every
+        directory is stored with it, so that ``refresh`` only has to list the
+        directories which have changed since.
+
+        Args:
+          ts_path(str): Path to the root of a v1 timestream.
+
+        Attributes:
+          index_path(str): Path of the JSON file the index is stored in.
+          manifest(dict): The guessed manifest of the timestream, with dates
+            formatted as strings.
+          _timestamps(set): Formatted timestamps of all existing images.
+          _sorted(list): ``_timestamps`` in chronological order.
+          _times(ndarray): ``_sorted`` as ``datetime64[s]``, made on demand.
+          _dir_mtimes(dict): mtime of each directory, keyed by its path
+            relative to ``ts_path``.
+        """
+        self.ts_path = ts_path.rstrip(os.sep)
+        self.index_path = path.join(self.ts_path, "_data", TS_INDEX_FNAME)
+        self.manifest = {}
+        self._timestamps = set()
+        self._sorted = []
+        self._times = None
+        self._dir_mtimes = {}
+
+    def __contains__(self, date):
+        return ts_format_date(date) in self._timestamps
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def __iter__(self):
+        for date in self.timestamps:
+            yield ts_parse_date(date)
+
+    @property
+    def extension(self):
+        return self.manifest.get("extension")
+
+    @property
+    def timestamps(self):
+        """Sorted list of formatted timestamps of all images in the index"""
+        return self._sorted
+
+    @property
+    def times(self):
+        """Sorted ``datetime64[s]`` array of all images in the index"""
+        if self._times is None:
+            self._times = ts_dates_to_datetime64(self._sorted)
+        return self._times
+
+    def exists(self, times):
+        """Boolean mask of which of the ``datetime64`` ``times`` have an
+        image.
+        """
+        return np.in1d(times, self.times)
+
+    def _set_timestamps(self, timestamps):
+        self._timestamps = set(timestamps)
+        self._times = None
+        # TS_DATE_FORMAT is fixed-width & big-endian, so lexical order is
+        # chronological order.
+        self._sorted = sorted(self._timestamps)
+        self._update_manifest_times()
+
+    def _update_manifest_times(self):
+        """Recalculate the start, end and interval fields of the manifest"""
+        if not self._sorted:
+            return
+        self.manifest["start_datetime"] = self._sorted[0]
+        self.manifest["end_datetime"] = self._sorted[-1]
+        # Get the smallest interval between images, as ts_guess_manifest_v1
+        # does. Single-image timestreams get the minimum interval.
+        intervals = np.diff(self.times) / np.timedelta64(1, "s")
+        if len(intervals):
+            self.manifest["interval"] = max(int(intervals.min()), 1)
+        else:
+            self.manifest["interval"] = 1
+
+    def add(self, date):
+        """Record that an image exists at ``date``, updating the manifest"""
+        date = ts_format_date(date)
+        if date in self._timestamps:
+            return
+        self._timestamps.add(date)
+        self._times = None
+        pos = bisect.bisect(self._sorted, date)
+        self._sorted.insert(pos, date)
+        self.manifest["start_datetime"] = self._sorted[0]
+        self.manifest["end_datetime"] = self._sorted[-1]
+        # Only the gaps either side of the new image can shrink the interval
+        this = ts_parse_date(date)
+        for nbr in self._sorted[max(pos - 1, 0):pos + 2]:
+            if nbr == date:
+                continue
+            gap = max(int(abs(ts_parse_date(nbr) - this).total_seconds()), 1)
+            if len(self._sorted) == 2 or gap < self.manifest["interval"]:
+                self.manifest["interval"] = gap
+
+    def _scan(self, reldir, ext, found):
+        """Recursively list ``reldir``, recording directory mtimes and
+        appending image file names to ``found``, keyed by extension.
+        """
+        absdir = path.join(self.ts_path, reldir)
+        # stat before listing, so that files added in between are caught by
+        # the next refresh rather than lost.
+        self._dir_mtimes[reldir] = os.stat(absdir).st_mtime
+        for entry in os.listdir(absdir):
+            fext = path.splitext(entry)[1][1:]
+            if fext in IMAGE_EXT_CONSTANTS:
+                if ext is None or fext == ext:
+                    found[fext].append(entry)
+            elif not entry.startswith("_") and \
+                    path.isdir(path.join(absdir, entry)):
+                self._scan(path.join(reldir, entry), ext, found)
+
+    def build(self, ext=None):
+        """(Re)build the index with one walk of the timestream.
+
+        :param str ext: Image extension to index. If not given, the most
+                        common image extension in the timestream is used.
+        :raises: ValueError
+        """
+        found = collections.defaultdict(list)
+        self._dir_mtimes = {}
+        self._scan("", ext, found)
+        if not found:
+            msg = "{} is an invalid V1 timestream".format(self.ts_path)
+            LOG.error(msg)
+            raise ValueError(msg)
+        if ext is None:
+            ext = max(found, key=lambda x: len(found[x]))
+        try:
+            image_type = IMAGE_EXT_TO_TYPE[ext]
+        except KeyError:
+            image_type = None
+        self.manifest = {
+            "name": path.basename(self.ts_path),
+            "version": 1,
+            "image_type": image_type,
+            "extension": ext,
+            "missing": [],
+        }
+        self._set_timestamps(
+            ts_format_date(ts_parse_date_path(x)) for x in found[ext])
+
+    def refresh(self):
+        """Patch the index with any images added or removed since it was
+        built or last refreshed.
+
+        Every known directory is stat'ed, but only those whose mtime has
+        changed are listed again. Removed images are only noticed in hour
+        directories, or when a whole directory is removed.
+
+        :returns: ``True`` if the index changed, else ``False``.
+        """
+        if not self._dir_mtimes:
+            # Index predates directory mtimes, so we can't be incremental
+            self.build(self.extension)
+            return True
+        children = collections.defaultdict(list)
+        for reldir in self._dir_mtimes:
+            if reldir:
+                children[path.dirname(reldir)].append(reldir)
+        changed = False
+        stack = [""]
+        while stack:
+            reldir = stack.pop()
+            try:
+                mtime = os.stat(path.join(self.ts_path, reldir)).st_mtime
+            except OSError:
+                self._forget_dir(reldir)
+                changed = True
+                continue
+            if mtime != self._dir_mtimes[reldir]:
+                self._rescan_dir(reldir, mtime)
+                changed = True
+            stack.extend(children[reldir])
+        if changed:
+            LOG.debug("Refreshed index of {}".format(self.ts_path))
+        return changed
+
+    def _rescan_dir(self, reldir, mtime):
+        """List a single changed directory, and patch the index with what is
+        in it. New subdirectories are scanned completely.
+        """
+        ext = self.extension
+        absdir = path.join(self.ts_path, reldir)
+        self._dir_mtimes[reldir] = mtime
+        found = collections.defaultdict(list)
+        for entry in os.listdir(absdir):
+            fext = path.splitext(entry)[1][1:]
+            if fext == ext:
+                found[fext].append(entry)
+            elif fext in IMAGE_EXT_CONSTANTS or entry.startswith("_"):
+                continue
+            elif path.join(reldir, entry) not in self._dir_mtimes and \
+                    path.isdir(path.join(absdir, entry)):
+                self._scan(path.join(reldir, entry), ext, found)
+        present = set(ts_format_date(ts_parse_date_path(x))
+                      for x in found[ext])
+        for date in present:
+            self.add(date)
+        if reldir.count(os.sep) + 1 == _TS_V1_DIR_DEPTH:
+            # Hour directories hold all images of that hour, so anything else
+            # with the same prefix has been removed.
+            self._discard_prefix(path.basename(reldir), keep=present)
+
+    def _forget_dir(self, reldir):
+        """Remove a directory that no longer exists, and all its images"""
+        prefix = reldir + os.sep
+        for known in list(self._dir_mtimes):
+            if known == reldir or known.startswith(prefix):
+                if known.count(os.sep) + 1 == _TS_V1_DIR_DEPTH:
+                    self._discard_prefix(path.basename(known))
+                del self._dir_mtimes[known]
+
+    def _discard_prefix(self, prefix, keep=()):
+        """Remove all timestamps starting with ``prefix``, except ``keep``"""
+        prefix = prefix + "_"
+        start = bisect.bisect_left(self._sorted, prefix)
+        # "~" sorts after all characters in a formatted date
+        end = bisect.bisect_left(self._sorted, prefix + "~")
+        gone = [x for x in self._sorted[start:end] if x not in keep]
+        if gone:
+            self._set_timestamps(self._timestamps.difference(gone))
+
+    def load(self):
+        """Read the index from ``index_path``.
+
+        :returns: ``True`` if the index was read, ``False`` if it doesn't
+                  exist or can't be parsed.
+        """
+        try:
+            with open(self.index_path) as ifh:
+                stored = json.load(ifh)
+            manifest = dict_unicode_to_str(stored["manifest"])
+            timestamps = set(str(x) for x in stored["timestamps"])
+            dir_mtimes = dict((str(k), v) for k, v in
+                              stored.get("dir_mtimes", {}).items())
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                AttributeError):
+            LOG.debug("No usable index at {}".format(self.index_path))
+            return False
+        self.manifest = manifest
+        self._timestamps = timestamps
+        self._sorted = sorted(timestamps)
+        self._times = None
+        self._dir_mtimes = dir_mtimes
+        return True
+
+    def save(self):
+        """Write the index to ``index_path``"""
+        stored = {
+            "manifest": self.manifest,
+            "timestamps": self.timestamps,
+            "dir_mtimes": self._dir_mtimes,
+        }
+        try:
+            ts_make_dirs(self.index_path)
+            json_dump_atomic(stored, self.index_path)
+        except (IOError, OSError):
+            LOG.warn("Couldn't write index for ts {}".format(self.ts_path))
+
+
+def ts_load_index(ts_path, ext=None, rebuild=False, refresh=False):
+    """Get the image index of the timestream at ``ts_path``.
+
+    Indices are kept in memory once loaded, and read from ``_data/`` and
+    refreshed, or built from scratch (and stored) otherwise. An index kept in
+    memory is only refreshed if ``refresh`` is given, as refreshing stats
+    every directory of the timestream, so looking up images doesn't touch
+    the filesystem.
+
+    :param str ts_path: Path to the root of a v1 timestream.
+    :param str ext: Image extension the index must cover.
+    :param bool rebuild: Always rebuild the index from the filesystem.
+    :param bool refresh: Patch the index with any changes to the timestream
+                         since it was last refreshed, even if it is already
+                         in memory.
+    :returns: The loaded index.
+    :rtype: TimeStreamIndex
+    :raises: ValueError
+    """
+    key = path.abspath(ts_path)
+    index = _TS_INDEX_CACHE.get(key)
+    if index is None:
+        index = TimeStreamIndex(ts_path)
+        if not index.load():
+            rebuild = True
+        # The stored index may be stale
+        refresh = True
+    if rebuild or (ext is not None and index.extension != ext):
+        # Creating _data/ changes the root's mtime, so do it before the build
+        # records that mtime.
+        try:
+            ts_make_dirs(index.index_path)
+        except (IOError, OSError):
+            pass
+        index.build(ext)
+        index.save()
+    elif refresh and index.refresh():
+        index.save()
+    _TS_INDEX_CACHE[key] = index
+    return index
+
+
+def all_files_with_ext(topdir, ext, cs=False, threads=None):
     """Iterates over files with extension ``ext`` recursively from ``topdir``
+
+    Directories are listed in parallel, see ``ts_scan_sorted``.
     """
     if not isinstance(topdir, str):
         msg = PARAM_TYPE_ERR.format(param="topdir",
@@ -189,25 +691,17 @@ def all_files_with_ext(topdir, ext, cs=False):
     # insensitive
     if not cs:
         ext = ext.lower()
-    # OK, walk the dir. we only care about files, hence why dirs never gets
-    # touched
-    for root, folders, files in os.walk(topdir):
-        # These *must* be in place, not f = sorted(f)
-        folders.sort()
-        files.sort()
-        for folder in folders:
-            if folder.startswith("_"):
-                folders.remove(folder)
-        for fpath in files:
-            # split out ext, and do any case-conversion we need
-            fname, fext = path.splitext(fpath)
-            if not cs:
-                fext = fext.lower()
-            # remove the dot at the start, as splitext returns ("fn", ".ext")
-            fext = fext[1:]
-            if fext == ext:
-                # we give the whole path to  the file
-                yield path.join(root, fpath)
+    # OK, scan the dir. we only care about files, in sorted order
+    for root, fpath in ts_scan_sorted(topdir, threads):
+        # split out ext, and do any case-conversion we need
+        fname, fext = path.splitext(fpath)
+        if not cs:
+            fext = fext.lower()
+        # remove the dot at the start, as splitext returns ("fn", ".ext")
+        fext = fext[1:]
+        if fext == ext:
+            # we give the whole path to  the file
+            yield path.join(root, fpath)
 
 
 def all_files_with_exts(topdir, exts, cs=False):
@@ -224,11 +718,54 @@ def all_files_with_exts(topdir, exts, cs=False):
     return ext_dict
 
 
+def _ts_manifest_stamp(ts_path, mfname):
+    """mtimes that tell whether a cached manifest is still current"""
+    stamp = [os.stat(ts_path).st_mtime]
+    if mfname:
+        stamp.append(os.stat(mfname).st_mtime)
+    return stamp
+
+
 def ts_get_manifest(ts_path):
     """Reads in or makes up a manifest for the timestream at ``ts_path``, and
     returns it as a ``dict``
+
+    Manifests are cached for the life of the process. A cached manifest is
+    used until the mtime of the manifest file or of ``ts_path`` changes.
+    Adding or removing a manifest file changes the mtime of ``ts_path``, but
+    adding images below it might not, so guessed manifests can be out of date
+    until then.
+    """
+    key = path.abspath(ts_path)
+    try:
+        mfname, stamp, manifest = _TS_MANIFEST_CACHE[key]
+        if _ts_manifest_stamp(ts_path, mfname) == stamp:
+            return _ts_copy_manifest(manifest)
+    except (KeyError, OSError):
+        pass
+    mfname = _ts_has_manifest(ts_path)
+    try:
+        # Stat before reading, so that later changes invalidate the cache
+        stamp = _ts_manifest_stamp(ts_path, mfname)
+    except OSError:
+        stamp = None
+    manifest = _ts_read_manifest(ts_path, mfname)
+    if stamp is not None:
+        _TS_MANIFEST_CACHE[key] = (mfname, stamp, manifest)
+    return _ts_copy_manifest(manifest)
+
+
+def _ts_copy_manifest(manifest):
+    """Copy ``manifest`` so callers can't change the cached one"""
+    manifest = dict(manifest)
+    manifest["missing"] = list(manifest["missing"])
+    return manifest
+
+
+def _ts_read_manifest(ts_path, manifest):
+    """Reads the manifest file ``manifest``, or makes up a manifest if it is
+    ``False`` or can't be read.
     """
-    manifest = _ts_has_manifest(ts_path)
     if manifest:
         try:
             LOG.debug("Manifest for {} exists at {}".format(ts_path, manifest))
@@ -257,6 +794,8 @@ def ts_update_manifest(ts_path, ts_info):
         mfname = path.join(ts_path, mfname)
         with open(mfname, "w") as mffh:
             json.dump(ts_info, mffh)
+        # The mtime might not change if the manifest was read this second
+        _TS_MANIFEST_CACHE.pop(path.abspath(ts_path), None)
     except:
         LOG.warn("Couldn't write JSON manifest for ts {}".format(ts_path))
 
@@ -273,8 +812,57 @@ def ts_iter_images_all_times(ts_path):
     """Iterate over a ``timestream`` in chronological order, returning a tuple
     of (time, image)
     """
-    for time in ts_iter_times(ts_path):
-        yield (time, ts_get_image(ts_path, time))
+    times = list(ts_iter_times(ts_path))
+    for time, img in zip(times, ts_get_images(ts_path, times)):
+        yield (time, img)
+
+
+def _time_to_seconds(time):
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def ts_timepoint_grid(start, end, interval, start_hour=None, end_hour=None,
+                      ignored=None):
+    """Calculate all timepoints from ``start`` to ``end`` at once.
+
+    The schedule matches ``iter_date_range``, but is returned as a
+    ``datetime64[s]`` array, with the hour window and ignored timestamps
+    already masked out.
+
+    Args:
+      start(datetime): First timepoint. If ``start_hour`` is given, the grid
+        starts at ``start_hour`` on the day of ``start`` instead.
+      end(datetime): Last possible timepoint. If ``end_hour`` is given, the
+        grid ends at ``end_hour`` on the day of ``end`` instead.
+      interval(int): Seconds between timepoints.
+      start_hour(datetime.time): Drop timepoints before this time of day.
+      end_hour(datetime.time): Drop timepoints after this time of day.
+      ignored(list): Timestamps (datetimes or formatted strings) to drop.
+
+    Returns:
+      ndarray: Sorted ``datetime64[s]`` array of the remaining timepoints.
+    """
+    if start_hour is not None:
+        start = datetime.combine(start.date(), start_hour)
+    if end_hour is not None:
+        end = datetime.combine(end.date(), end_hour)
+    range_secs = int((end - start).total_seconds())
+    offsets = np.arange(0, range_secs + 1, interval, dtype=np.int64)
+    grid = np.datetime64(start, "s") + offsets.astype("timedelta64[s]")
+
+    keep = np.ones(len(grid), dtype=bool)
+    if start_hour is not None or end_hour is not None:
+        secs = (grid - grid.astype("datetime64[D]")).astype(np.int64)
+        if start_hour is not None:
+            keep &= secs >= _time_to_seconds(start_hour)
+        if end_hour is not None:
+            keep &= secs <= _time_to_seconds(end_hour)
+    if ignored:
+        skip = np.in1d(grid, ts_dates_to_datetime64(ignored))
+        LOG.info("Skipping {} ignored timepoints".format(
+            np.count_nonzero(skip & keep)))
+        keep &= ~skip
+    return grid[keep]
 
 
 def iter_date_range(start, end, interval):
@@ -295,6 +883,21 @@ def ts_iter_times(ts_path):
         yield time
 
 
+def _ts_image_exists(index, date, abspath):
+    """Whether the image at ``date`` exists, at ``abspath``.
+
+    The index only confirms images exist, as it isn't refreshed once in
+    memory. Images it doesn't have are looked for on disk, and added to it if
+    they have been written since.
+    """
+    if date in index:
+        return True
+    if path.exists(abspath):
+        index.add(date)
+        return True
+    return False
+
+
 def ts_get_image(ts_path, date, n=0, write_manifest=False):
     """Get the image path of the image in ``ts_path`` at ``date``
     """
@@ -321,8 +924,14 @@ def ts_get_image(ts_path, date, n=0, write_manifest=False):
                                ts_parse_date(date), n)
     # Join to make "absolute" path, i.e. path including ts_path
     abspath = path.join(ts_path, relpath)
+    # The index only knows about timepoints, not sub-second image numbers
+    if n == 0:
+        index = ts_load_index(ts_path, ext=ts_info["extension"])
+        exists = _ts_image_exists(index, date, abspath)
+    else:
+        exists = path.exists(abspath)
     # not-so-silently fail if we can't find the image
-    if path.exists(abspath):
+    if exists:
         LOG.debug("Image at {} in {} is {}.".format(date, ts_path, abspath))
         return abspath
     else:
@@ -335,6 +944,56 @@ def ts_get_image(ts_path, date, n=0, write_manifest=False):
         return None
 
 
+def ts_get_images(ts_path, dates, n=0):
+    """Get the image paths of the images in ``ts_path`` at each of ``dates``
+
+    Like ``ts_get_image``, but the manifest and image index are only looked
+    up once for all ``dates``.
+
+    :param str ts_path: Path to the root of a timestream.
+    :param dates: Sequence of ``datetime.datetime`` objects or dates in
+                  TS_DATE_FORMAT.
+    :param int n: Image number within each timepoint.
+    :returns: A list of paths, with None for images that don't exist.
+    :raises: ValueError
+    """
+    if not isinstance(ts_path, str):
+        msg = PARAM_TYPE_ERR.format(param="ts_path",
+                                    func="ts_get_images", type="str")
+        LOG.error(msg)
+        raise ValueError(msg)
+    ts_info = ts_get_manifest(ts_path)
+    missing = set(ts_info["missing"])
+    index = None
+    if n == 0:
+        index = ts_load_index(ts_path, ext=ts_info["extension"])
+    paths = []
+    for date in dates:
+        if not isinstance(date, (datetime, str)):
+            msg = PARAM_TYPE_ERR.format(param="dates",
+                                        func="ts_get_images",
+                                        type="list of datetime.datetime or str")
+            LOG.error(msg)
+            raise ValueError(msg)
+        date = ts_parse_date(date)
+        if ts_format_date(date) in missing:
+            paths.append(None)
+            continue
+        relpath = _ts_date_to_path(ts_info["name"], ts_info["extension"],
+                                   date, n)
+        abspath = path.join(ts_path, relpath)
+        if index is not None:
+            exists = _ts_image_exists(index, date, abspath)
+        else:
+            exists = path.exists(abspath)
+        paths.append(abspath if exists else None)
+    n_missing = paths.count(None)
+    if n_missing:
+        LOG.warn("{} of {} expected images in {} did not exist.".format(
+            n_missing, len(paths), ts_path))
+    return paths
+
+
 def _ts_date_to_path(ts_name, ts_ext, date, n=0):
     """Formats a string that should correspond to the relative (from
     ``ts_path``) path to the image at the given ``time``.
@@ -343,19 +1002,14 @@ def _ts_date_to_path(ts_name, ts_ext, date, n=0):
     return date.strftime(pth)
 
 
-def ts_iter_numpy(fname_iter):
+def ts_iter_numpy(fname_iter, decoder=None):
     """Take each image filename from ``fname_iter`` and yield the image as a
-    numpy array, via ``cv2.imread``. The image is returned as a tuple of
-    ``(img_path, img_matrix)``.
+    numpy array, via ``read_image``. The image is returned as a tuple of
+    ``(img_path, img_matrix)``, with the matrix as ``[y, x, RGB]``.
+    ``decoder`` names the decoder to use, otherwise the fastest is.
     """
     for img in fname_iter:
-        try:
-            import skimage.io as imgio
-            yield (img, imgio.imread(img, plugin="freeimage"))
-        except ImportError:
-            LOG.warn("Couln't load scikit image io module. " +
-                     "Raw images not supported")
-            yield (img, cv2.imread(img))
+        yield (img, read_image(img, decoder))
 
 
 def _is_ts_v2(ts_path):
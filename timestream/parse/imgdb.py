@@ -0,0 +1,214 @@
+# Copyright 2014 Kevin Murray
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.imgdb
+    :platform: Unix, Windows
+    :synopsis: Stores the metadata of a timestream's images in SQLite, as an
+               alternative to image_data.json.
+
+.. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
+"""
+
+from collections import MutableMapping
+import json
+import logging
+import os
+from os import path
+import sqlite3
+
+from timestream.parse import (
+    ts_format_date,
+)
+
+LOG = logging.getLogger("timestreamlib")
+#: File name of the image metadata database, stored under a timestream's _data
+TS_IMGDB_FNAME = "image_data.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_data (
+    date TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_fields (
+    date TEXT NOT NULL REFERENCES image_data(date) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (date, key)
+);
+CREATE INDEX IF NOT EXISTS image_fields_key ON image_fields (key, value);
+CREATE TABLE IF NOT EXISTS timestream_data (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _db_date(date):
+    if isinstance(date, basestring):
+        return str(date)
+    return ts_format_date(date)
+
+
+class ImageDataDB(MutableMapping):
+
+    def __init__(self, db_path):
+        """The ``data`` of each image of a timestream, stored in SQLite.
+
+        Behaves like the ``image_data`` dict of ``TimeStream``, keyed by
+        formatted timestamp, but each image's data is only read when it is
+        looked up, so neither the time nor memory taken to open a timestream
+        grows with its length. Images are stored by timestamp, and each of
+        the top-level keys of their data is indexed, for ``query``. The
+        ``data`` of the timestream is stored alongside.
+
+        Changes are only visible to other connections once committed, by
+        ``commit`` or ``close``.
+
+        Args:
+          db_path(str): Path to the SQLite database, which is created if it
+            doesn't exist.
+        """
+        self.path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(_SCHEMA)
+
+    def __getitem__(self, date):
+        row = self.conn.execute("SELECT data FROM image_data WHERE date = ?",
+                                (_db_date(date),)).fetchone()
+        if row is None:
+            raise KeyError(date)
+        return json.loads(row[0])
+
+    def __setitem__(self, date, data):
+        date = _db_date(date)
+        self.conn.execute("INSERT OR REPLACE INTO image_data VALUES (?, ?)",
+                          (date, json.dumps(data)))
+        self.conn.execute("DELETE FROM image_fields WHERE date = ?", (date,))
+        self.conn.executemany(
+            "INSERT INTO image_fields VALUES (?, ?, ?)",
+            ((date, key, json.dumps(val)) for key, val in data.items()))
+
+    def __delitem__(self, date):
+        cur = self.conn.execute("DELETE FROM image_data WHERE date = ?",
+                                (_db_date(date),))
+        if cur.rowcount == 0:
+            raise KeyError(date)
+
+    def __contains__(self, date):
+        return self.conn.execute(
+            "SELECT 1 FROM image_data WHERE date = ?",
+            (_db_date(date),)).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.conn.execute(
+                "SELECT date FROM image_data ORDER BY date"):
+            yield str(row[0])
+
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM image_data").fetchone()[0]
+
+    def query(self, start=None, end=None, has=(), where=None):
+        """Find the images with matching data, in chronological order.
+
+        For example, the processed images in June with their trays found are
+        ``query(datetime(2014, 6, 1), datetime(2014, 6, 30, 23, 59, 59),
+        has=["trayLocs"], where={"processed": "yes"})``.
+
+        Args:
+          start(datetime): Earliest timestamp, inclusive.
+          end(datetime): Latest timestamp, inclusive.
+          has(list): Keys the image's data must have.
+          where(dict): Keys the image's data must have, with these values.
+
+        Returns:
+          generator: ``(date, data)`` for each image, where ``date`` is the
+            formatted timestamp.
+        """
+        conds = []
+        args = []
+        if start is not None:
+            conds.append("date >= ?")
+            args.append(_db_date(start))
+        if end is not None:
+            conds.append("date <= ?")
+            args.append(_db_date(end))
+        for key in has:
+            conds.append("date IN (SELECT date FROM image_fields "
+                         "WHERE key = ?)")
+            args.append(key)
+        for key, val in (where or {}).items():
+            conds.append("date IN (SELECT date FROM image_fields "
+                         "WHERE key = ? AND value = ?)")
+            args.extend((key, json.dumps(val)))
+        sql = "SELECT date, data FROM image_data"
+        if conds:
+            sql += " WHERE " + " AND ".join(conds)
+        sql += " ORDER BY date"
+        for date, data in self.conn.execute(sql, args):
+            yield str(date), json.loads(data)
+
+    def timestream_data(self):
+        """The ``data`` of the timestream, as stored by
+        ``set_timestream_data``.
+        """
+        return dict((str(key), json.loads(val)) for key, val in
+                    self.conn.execute("SELECT key, value FROM timestream_data"))
+
+    def set_timestream_data(self, data):
+        self.conn.execute("DELETE FROM timestream_data")
+        self.conn.executemany(
+            "INSERT INTO timestream_data VALUES (?, ?)",
+            ((key, json.dumps(val)) for key, val in data.items()))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def ts_image_data_to_sqlite(ts_path):
+    """Move the metadata of the v1 timestream at ``ts_path`` from its JSON
+    files (and journal) into an ``ImageDataDB``, which ``TimeStream.load``
+    then uses.
+
+    :param str ts_path: Path to the root of a v1 timestream.
+    :returns: int -- The number of images whose data was moved.
+    """
+    # Imported here, as timestream imports this module
+    from timestream import TimeStream
+    ts = TimeStream()
+    ts.load(ts_path)
+    if isinstance(ts.image_data, ImageDataDB):
+        msg = "{} already stores image data in SQLite".format(ts_path)
+        LOG.error(msg)
+        raise ValueError(msg)
+    db = ImageDataDB(path.join(ts.data_dir, TS_IMGDB_FNAME))
+    with db.conn:
+        for date, data in ts.image_data.items():
+            db[date] = data
+        db.set_timestream_data(ts.data)
+    db.close()
+    # Only remove the JSON files once the database is committed
+    for fname in (ts.image_db_path, ts.journal_path, ts.db_path):
+        if path.exists(fname):
+            os.remove(fname)
+    return len(ts.image_data)
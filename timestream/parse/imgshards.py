@@ -0,0 +1,261 @@
+# Copyright 2014 Kevin Murray
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.imgshards
+    :platform: Unix, Windows
+    :synopsis: Stores the metadata of a timestream's images in a JSON file per
+               day or month, which are only loaded as needed.
+
+.. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
+"""
+
+from collections import (
+    MutableMapping,
+    OrderedDict,
+)
+import json
+import logging
+import os
+from os import path
+
+from timestream.parse import (
+    ts_format_date,
+)
+from timestream.util import (
+    json_dump_atomic,
+)
+
+LOG = logging.getLogger("timestreamlib")
+#: Directory of the shards, under a timestream's _data
+TS_SHARDS_DIR = "image_data"
+#: Approximate number of bytes of shards kept loaded, by their size on disk
+TS_SHARDS_BUDGET = 64 << 20
+_HEADER_FNAME = "shards.json"
+# Length of the prefix of a formatted date (YYYY_MM_DD_hh_mm_ss) naming the
+# shard it is in
+_SHARD_PREFIX = {
+    "day": 10,
+    "month": 7,
+}
+
+
+def _shard_date(date):
+    if isinstance(date, basestring):
+        return str(date)
+    return ts_format_date(date)
+
+
+def _entry_bytes(date, data):
+    """Approximate bytes ``data`` of the image at ``date`` takes in a shard"""
+    return len(json.dumps({date: data}))
+
+
+class ShardedImageData(MutableMapping):
+
+    def __init__(self, shard_dir, by=None, max_bytes=TS_SHARDS_BUDGET):
+        """The ``data`` of each image of a timestream, in a JSON file per day
+        or month.
+
+        Behaves like the ``image_data`` dict of ``TimeStream``, keyed by
+        formatted timestamp, but a shard is only read when one of its images
+        is first looked up, so opening a timestream reads none of them, and
+        reading a range of images reads only the shards of that range. The
+        least recently used shards are dropped once those loaded exceed
+        ``max_bytes``, and reread if needed again.
+
+        Changes are kept in memory until ``flush``, or until their shard is
+        dropped.
+
+        Args:
+          shard_dir(str): Directory of the shards, created if it doesn't
+            exist.
+          by(str): ``"day"`` or ``"month"``, the period of each shard. Taken
+            from an existing ``shard_dir``, or ``"day"`` for a new one.
+          max_bytes(int): Approximate number of bytes of shards to keep
+            loaded, by their size on disk.
+        """
+        self.shard_dir = shard_dir
+        self.max_bytes = max_bytes
+        header_path = path.join(shard_dir, _HEADER_FNAME)
+        if path.exists(header_path):
+            with open(header_path) as hdr_fh:
+                stored = str(json.load(hdr_fh)["by"])
+            if by is not None and by != stored:
+                msg = "{} is sharded by {}, not {}".format(shard_dir, stored,
+                                                           by)
+                LOG.error(msg)
+                raise ValueError(msg)
+            by = stored
+        elif by is None:
+            by = "day"
+        if by not in _SHARD_PREFIX:
+            msg = "Image data can only be sharded by day or month, not {}"
+            msg = msg.format(by)
+            LOG.error(msg)
+            raise ValueError(msg)
+        self.by = by
+        if not path.exists(header_path):
+            if not path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+            json_dump_atomic({"by": by}, header_path)
+        self._on_disk = set(path.splitext(x)[0] for x in os.listdir(shard_dir)
+                            if x != _HEADER_FNAME and x.endswith(".json"))
+        self._shards = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._dirty = set()
+
+    def _shard_name(self, date):
+        return _shard_date(date)[:_SHARD_PREFIX[self.by]]
+
+    def _fname(self, name):
+        return path.join(self.shard_dir, name + ".json")
+
+    def _shard(self, name):
+        """The dict of the shard ``name``, loading it if needed"""
+        try:
+            shard = self._shards.pop(name)
+        except KeyError:
+            shard = {}
+            size = 0
+            if name in self._on_disk:
+                with open(self._fname(name)) as shard_fh:
+                    shard = json.load(shard_fh)
+                size = path.getsize(self._fname(name))
+            self._sizes[name] = size
+            self._nbytes += size
+            self._evict()
+        # Most recently used last
+        self._shards[name] = shard
+        return shard
+
+    def _resize(self, name, nbytes):
+        """Account for the shard ``name`` growing by ``nbytes``"""
+        self._sizes[name] += nbytes
+        self._nbytes += nbytes
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes and self._shards:
+            name, shard = self._shards.popitem(last=False)
+            if name in self._dirty:
+                self._write(name, shard)
+            self._nbytes -= self._sizes.pop(name)
+
+    def _write(self, name, shard):
+        if shard:
+            json_dump_atomic(shard, self._fname(name))
+            self._on_disk.add(name)
+        elif name in self._on_disk:
+            os.remove(self._fname(name))
+            self._on_disk.discard(name)
+        self._dirty.discard(name)
+
+    def __getitem__(self, date):
+        return self._shard(self._shard_name(date))[_shard_date(date)]
+
+    def __setitem__(self, date, data):
+        name = self._shard_name(date)
+        date = _shard_date(date)
+        shard = self._shard(name)
+        nbytes = _entry_bytes(date, data)
+        if date in shard:
+            nbytes -= _entry_bytes(date, shard[date])
+        shard[date] = data
+        self._dirty.add(name)
+        # Written shards count towards the budget as loaded ones do
+        self._resize(name, nbytes)
+        self._evict()
+
+    def __delitem__(self, date):
+        name = self._shard_name(date)
+        date = _shard_date(date)
+        shard = self._shard(name)
+        nbytes = _entry_bytes(date, shard[date])
+        del shard[date]
+        self._dirty.add(name)
+        self._resize(name, -nbytes)
+
+    def __contains__(self, date):
+        name = self._shard_name(date)
+        if name not in self._on_disk and name not in self._shards:
+            return False
+        return _shard_date(date) in self._shard(name)
+
+    def shards(self, start=None, end=None):
+        """Names of the shards with images from ``start`` to ``end``,
+        inclusive, chronologically.
+        """
+        names = self._on_disk | set(self._shards)
+        if start is not None:
+            start = self._shard_name(start)
+            names = [x for x in names if x >= start]
+        if end is not None:
+            end = self._shard_name(end)
+            names = [x for x in names if x <= end]
+        return sorted(names)
+
+    def iteritems(self, start=None, end=None):
+        """``(date, data)`` of the images from ``start`` to ``end``,
+        inclusive, chronologically, reading only the shards of that range.
+        """
+        start = None if start is None else _shard_date(start)
+        end = None if end is None else _shard_date(end)
+        for name in self.shards(start, end):
+            shard = self._shard(name)
+            for date in sorted(shard):
+                if (start is None or date >= start) and \
+                        (end is None or date <= end):
+                    yield str(date), shard[date]
+
+    def __iter__(self):
+        for date, _ in self.iteritems():
+            yield date
+
+    def __len__(self):
+        return sum(1 for _ in self.iteritems())
+
+    def flush(self):
+        """Write the shards changed since they were loaded"""
+        for name in list(self._dirty):
+            self._write(name, self._shards[name])
+
+
+def ts_shard_image_data(ts_path, by="day"):
+    """Move the metadata of the v1 timestream at ``ts_path`` from its JSON
+    file (and journal) into a ``ShardedImageData``, which ``TimeStream.load``
+    then uses.
+
+    :param str ts_path: Path to the root of a v1 timestream.
+    :param str by: ``"day"`` or ``"month"``, the period of each shard.
+    :returns: int -- The number of images whose data was moved.
+    """
+    # Imported here, as timestream imports this module
+    from timestream import TimeStream
+    ts = TimeStream()
+    ts.load(ts_path)
+    if not isinstance(ts.image_data, dict):
+        msg = "{} doesn't store image data in image_data.json".format(ts_path)
+        LOG.error(msg)
+        raise ValueError(msg)
+    shards = ShardedImageData(path.join(ts.data_dir, TS_SHARDS_DIR), by=by)
+    for date, data in ts.image_data.items():
+        shards[date] = data
+    shards.flush()
+    # Only remove the JSON files once the shards are written
+    for fname in (ts.image_db_path, ts.journal_path):
+        if path.exists(fname):
+            os.remove(fname)
+    return len(ts.image_data)
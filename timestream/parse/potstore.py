@@ -0,0 +1,334 @@
+# Copyright 2014 Kevin Murray
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.potstore
+    :platform: Unix, Windows
+    :synopsis: Stores the pots of each image of a timestream as columns of
+               memory-mappable arrays.
+
+.. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
+"""
+
+import json
+import logging
+import numpy as np
+import os
+from os import path
+
+from timestream.util import (
+    dict_unicode_to_str,
+    json_dump_atomic,
+)
+
+LOG = logging.getLogger("timestreamlib")
+#: Directory of the pot store, under a timestream's _data
+TS_POTSTORE_DIR = "pots"
+
+# File name, dtype and shape of each row (as a function of the number of pots
+# and features) of each column.
+_COLUMNS = {
+    "times": ("times.i8", np.int64, lambda npot, nfeat: ()),
+    "sizes": ("sizes.i4", np.int32, lambda npot, nfeat: (2,)),
+    "rects": ("rects.i4", np.int32, lambda npot, nfeat: (npot, 4)),
+    "features": ("features.f8", np.float64,
+                 lambda npot, nfeat: (npot, nfeat)),
+}
+# Value of missing sizes, rects and features
+_FILL = {
+    "sizes": -1,
+    "rects": -1,
+    "features": np.nan,
+}
+_HEADER_FNAME = "pots.json"
+# Columns which are rewritten when pots or features are added, so whose file
+# names carry the version of the header that refers to them
+_VERSIONED = ("rects", "features")
+
+
+def _to_seconds(time):
+    return np.datetime64(time, "s").astype(np.int64).item()
+
+
+class PotStore(object):
+
+    def __init__(self, store_dir):
+        """The pots of each image of a v1 timestream, stored by column.
+
+        Each image is a row of each of the arrays ``rects``, ``(T, N, 4)``
+        ints, and ``features``, ``(T, N, F)`` floats, for ``T`` images,
+        ``N`` pots and ``F`` features. These are raw binary files which are
+        memory mapped on reading, so reading one image, or a range of them,
+        is a slice. Missing rects are -1, missing features NaN. Pot ids,
+        feature names and the metaids of each pot are a small JSON table.
+
+        Rows are appended as images are written, so are in chronological
+        order if the images were written in order. A new pot or feature
+        means rewriting the arrays with another column, which is rare. The
+        rewritten arrays are new files, which the header is then atomically
+        replaced to refer to, so a crash leaves the old arrays in use.
+
+        Reading never changes the files, so a store can be read from a
+        read-only filesystem, or while another process appends to it. Rows
+        of an interrupted write are only dropped on the next write.
+
+        Args:
+          store_dir(str): Directory of the store, created on first write.
+
+        Attributes:
+          pot_ids(list): Id of each pot.
+          feature_names(list): Name of each feature.
+          metaids(list): The metaids of each pot, as dicts.
+        """
+        self.store_dir = store_dir
+        self.pot_ids = []
+        self.feature_names = []
+        self.metaids = []
+        self._rows = {}
+        self._times = []
+        self._times_arr = None
+        self._maps = {}
+        self._version = 0
+        self._repaired = False
+        self._load()
+
+    def _fname(self, column, version=None):
+        fname = _COLUMNS[column][0]
+        if version is None:
+            version = self._version
+        if column in _VERSIONED and version:
+            # The version goes before the extension, as in rects.2.i4
+            name, ext = path.splitext(fname)
+            fname = "{}.{}{}".format(name, version, ext)
+        return path.join(self.store_dir, fname)
+
+    def _row_shape(self, column):
+        return _COLUMNS[column][2](len(self.pot_ids),
+                                   len(self.feature_names))
+
+    def _row_bytes(self, column):
+        dtype = np.dtype(_COLUMNS[column][1])
+        return dtype.itemsize * int(np.prod(self._row_shape(column)))
+
+    def _load(self):
+        try:
+            with open(path.join(self.store_dir, _HEADER_FNAME)) as hdr_fh:
+                header = json.load(hdr_fh)
+        except IOError:
+            return
+        self.pot_ids = header["pot_ids"]
+        self.feature_names = [str(x) for x in header["feature_names"]]
+        self.metaids = [dict_unicode_to_str(x) for x in header["metaids"]]
+        self._version = header.get("version", 0)
+        # The times are written last, so any rows beyond those of the times
+        # are from an interrupted, or ongoing, write, and are ignored.
+        self._times = np.fromfile(self._fname("times"),
+                                  dtype=np.int64).tolist()
+        self._rows = dict((x, i) for i, x in enumerate(self._times))
+
+    def _repair(self):
+        """Drop any rows of an interrupted write beyond those of the times,
+        before the first write.
+        """
+        if self._repaired:
+            return
+        for column in _COLUMNS:
+            with open(self._fname(column), "r+b") as col_fh:
+                col_fh.truncate(len(self) * self._row_bytes(column))
+        self._repaired = True
+
+    def _save_header(self):
+        json_dump_atomic({"pot_ids": self.pot_ids,
+                          "feature_names": self.feature_names,
+                          "metaids": self.metaids,
+                          "version": self._version},
+                         path.join(self.store_dir, _HEADER_FNAME))
+
+    def __len__(self):
+        return len(self._times)
+
+    def __contains__(self, time):
+        return _to_seconds(time) in self._rows
+
+    def _times_array(self):
+        if self._times_arr is None:
+            self._times_arr = np.array(self._times, dtype=np.int64)
+        return self._times_arr
+
+    @property
+    def times(self):
+        """The time of each row, as ``datetime64[s]``"""
+        return self._times_array().astype("datetime64[s]")
+
+    def _memmap(self, column):
+        """Map ``column``, which stays mapped until the next write"""
+        if column in self._maps:
+            return self._maps[column]
+        shape = (len(self),) + self._row_shape(column)
+        if len(self) == 0 or 0 in shape:
+            arr = np.zeros(shape, dtype=_COLUMNS[column][1])
+        else:
+            arr = np.memmap(self._fname(column), dtype=_COLUMNS[column][1],
+                            mode="r", shape=shape)
+        self._maps[column] = arr
+        return arr
+
+    def _add_columns(self, pot_ids, feature_names):
+        """Add any new pots and features, rewriting the arrays"""
+        new_pots = [x for x in pot_ids if x not in self.pot_ids]
+        new_feats = [x for x in feature_names if x not in self.feature_names]
+        if not new_pots and not new_feats:
+            return
+        old = dict((col, np.array(self._memmap(col))) for col in _FILL)
+        npot = len(self.pot_ids)
+        nfeat = len(self.feature_names)
+        self.pot_ids.extend(new_pots)
+        self.feature_names.extend(new_feats)
+        self.metaids.extend({} for _ in new_pots)
+        self._maps = {}
+        version = self._version + 1
+        for column in _VERSIONED:
+            arr = np.empty((len(self),) + self._row_shape(column),
+                           dtype=_COLUMNS[column][1])
+            arr.fill(_FILL[column])
+            if column == "rects":
+                arr[:, :npot] = old[column]
+            else:
+                arr[:, :npot, :nfeat] = old[column]
+            # Not yet referred to by the header, so can be written in place
+            with open(self._fname(column, version), "wb") as col_fh:
+                arr.tofile(col_fh)
+                col_fh.flush()
+                os.fsync(col_fh.fileno())
+        # Switch to the new arrays, then remove the old
+        old_version = self._version
+        self._version = version
+        self._save_header()
+        for column in _VERSIONED:
+            try:
+                os.remove(self._fname(column, old_version))
+            except OSError:
+                pass
+
+    def write(self, time, img_size, pot_ids, rects, feature_names=(),
+              features=None, metaids=None):
+        """Store the pots of the image at ``time``, replacing any stored.
+
+        Args:
+          time(datetime): Timestamp of the image.
+          img_size(tuple): ``(height, width)`` of the image.
+          pot_ids(list): Id of each pot.
+          rects(array): ``(n, 4)`` rects of each pot.
+          feature_names(list): Name of each feature.
+          features(array): ``(n, f)`` value of each feature of each pot.
+          metaids(list): The metaids of each pot, as dicts.
+        """
+        self._maps = {}
+        if not path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        if not path.exists(path.join(self.store_dir, _HEADER_FNAME)):
+            for column in _COLUMNS:
+                open(self._fname(column), "wb").close()
+            self._save_header()
+            self._repaired = True
+        self._repair()
+        self._add_columns(pot_ids, feature_names)
+        # Arrange the given pots and features as the store's columns
+        pos = dict((x, i) for i, x in enumerate(self.pot_ids))
+        pidx = [pos[x] for x in pot_ids]
+        pos = dict((x, i) for i, x in enumerate(self.feature_names))
+        fidx = [pos[x] for x in feature_names]
+        values = {
+            "times": np.array(_to_seconds(time), dtype=np.int64),
+            "sizes": np.array(img_size[:2], dtype=np.int32),
+        }
+        for column in ("rects", "features"):
+            values[column] = np.empty(self._row_shape(column),
+                                      dtype=_COLUMNS[column][1])
+            values[column].fill(_FILL[column])
+        if len(pidx):
+            values["rects"][pidx] = rects
+            if len(fidx):
+                values["features"][np.ix_(pidx, fidx)] = features
+        if metaids is not None:
+            changed = False
+            for iii, mids in zip(pidx, metaids):
+                if self.metaids[iii] != mids:
+                    self.metaids[iii] = dict(mids)
+                    changed = True
+            if changed:
+                self._save_header()
+
+        row = self._rows.get(values["times"].item())
+        # The times go last, see _load
+        for column in ("sizes", "rects", "features", "times"):
+            data = values[column].tostring()
+            if row is None:
+                with open(self._fname(column), "ab") as col_fh:
+                    col_fh.write(data)
+            else:
+                with open(self._fname(column), "r+b") as col_fh:
+                    col_fh.seek(row * len(data))
+                    col_fh.write(data)
+        if row is None:
+            self._rows[values["times"].item()] = len(self._times)
+            self._times.append(values["times"].item())
+            self._times_arr = None
+
+    def read(self, time):
+        """Read the pots of the image at ``time``.
+
+        Returns:
+          tuple: ``(img_size, rects, features)``, the ``(height, width)`` of
+            the image, the ``(N, 4)`` rects and ``(N, F)`` features.
+        """
+        try:
+            row = self._rows[_to_seconds(time)]
+        except KeyError:
+            msg = "No pots stored at {}".format(time)
+            LOG.error(msg)
+            raise KeyError(msg)
+        return (tuple(self._memmap("sizes")[row]), self._memmap("rects")[row],
+                self._memmap("features")[row])
+
+    def _range(self, start, end):
+        """Slice or index of the rows from ``start`` to ``end``, inclusive"""
+        times = self._times_array()
+        sel = np.ones(len(self), dtype=bool)
+        if start is not None:
+            sel &= times >= _to_seconds(start)
+        if end is not None:
+            sel &= times <= _to_seconds(end)
+        rows = np.flatnonzero(sel)
+        rows = rows[np.argsort(times[rows], kind="mergesort")]
+        if len(rows) and np.all(np.diff(rows) == 1):
+            return slice(rows[0], rows[-1] + 1)
+        return rows
+
+    def rects(self, start=None, end=None):
+        """The rects of images from ``start`` to ``end``, inclusive.
+
+        Returns:
+          tuple: ``(times, rects)``, the ``datetime64[s]`` time of each
+            image, chronologically, and their ``(T, N, 4)`` rects. The rects
+            are memory mapped if the images were stored in order.
+        """
+        rows = self._range(start, end)
+        return self.times[rows], self._memmap("rects")[rows]
+
+    def features(self, start=None, end=None):
+        """As ``rects``, for the ``(T, N, F)`` features of each image"""
+        rows = self._range(start, end)
+        return self.times[rows], self._memmap("features")[rows]
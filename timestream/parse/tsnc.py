@@ -0,0 +1,407 @@
+# Copyright 2014 Kevin Murray
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.parse.tsnc
+    :platform: Unix, Windows
+    :synopsis: Reads and writes v2 timestreams, stored as netcdf4 (HDF5)
+               files.
+
+.. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
+"""
+
+from datetime import datetime
+import json
+import logging
+import numpy as np
+from os import path
+
+from timestream.parse import (
+    ts_format_date,
+    ts_parse_date,
+)
+from timestream.parse.validate import (
+    IMAGE_EXT_TO_TYPE,
+)
+
+try:
+    import netCDF4 as ncdf
+except ImportError:
+    ncdf = None
+
+LOG = logging.getLogger("timestreamlib")
+#: Units of the time variable of v2 timestreams, as written by ts_to_tsnc
+TSNC_TIME_UNITS = "seconds since 1970-01-01 00:00:00.0"
+#: Variable holding the JSON-encoded ``data`` of each image, if any
+TSNC_DATA_VAR = "image_data"
+#: Extension assumed for images of v2 timestreams without an extension attr
+TSNC_DEFAULT_EXT = "png"
+#: Attribute holding the JSON-encoded ``data`` of the whole timestream
+TSNC_TS_DATA_ATTR = "timestream_data"
+#: zlib compression level of pixel arrays written by TimeStreamNetCDF
+TSNC_COMPLEVEL = 4
+#: Flush buffered frames once there are this many of them...
+TSNC_BUFFER_FRAMES = 32
+#: ... or once they take up this many bytes
+TSNC_BUFFER_BYTES = 256 * 2 ** 20
+
+
+class TimeStreamNetCDF(object):
+
+    def __init__(self, tsnc_path, mode="r", complevel=TSNC_COMPLEVEL,
+                 tile=None):
+        """Access to a v2 timestream.
+
+        A v2 timestream is a netcdf4 file with a ``pixel(t, y, x, z)``
+        variable holding one image per ``t``, and a ``time(t)`` variable
+        holding their timestamps, as written by ``ts_to_tsnc``. Frames, or
+        windows of them, are read straight from the (chunked) pixel array.
+
+        This has the same lookup interface as ``TimeStreamIndex``, as the
+        file is its own index.
+
+        Opened with ``mode="a"``, frames can be appended with ``append``.
+        They are buffered, and written in batches by ``flush``. Only
+        ``in`` sees buffered frames; everything else flushes them first.
+
+        Args:
+          tsnc_path(str): Path to the netcdf4 file.
+          mode(str): "r" to read, "a" to also append.
+          complevel(int): zlib compression level of the pixel array, if it
+            is created by this instance.
+          tile(tuple): ``(rows, cols)`` of each chunk of the pixel array, if
+            it is created by this instance. Each chunk is a whole frame if
+            not given. Smaller tiles make reading windows cheaper.
+
+        Attributes:
+          manifest(dict): The manifest of the timestream, with dates
+            formatted as strings. Doesn't cover buffered frames.
+          _order(ndarray): ``t`` index of each image, in chronological order.
+            Frames whose time was never written, as a flush was interrupted,
+            are left out.
+          _times(ndarray): ``datetime64[s]`` timestamps, in chronological
+            order.
+          _buffer(list): ``(time, pixels, data)`` of frames not yet written.
+          _buffered(set): ``datetime64`` timestamps of buffered frames.
+        """
+        if ncdf is None:
+            msg = "netCDF4 must be installed to read v2 timestreams"
+            LOG.error(msg)
+            raise ImportError(msg)
+        if mode not in ("r", "a"):
+            msg = "Invalid mode {}, must be 'r' or 'a'".format(mode)
+            LOG.error(msg)
+            raise ValueError(msg)
+        self.path = tsnc_path
+        self.mode = mode
+        self.complevel = complevel
+        self.tile = tile
+        self._buffer = []
+        self._buffered = set()
+        self.root = ncdf.Dataset(tsnc_path, mode)
+        try:
+            self._time_var = self.root.variables["time"]
+            self._pixels = self.root.variables.get("pixel")
+            if self._pixels is None and mode == "r":
+                raise KeyError("pixel")
+        except KeyError:
+            msg = "{} has no pixel or time variable".format(tsnc_path)
+            LOG.error(msg)
+            raise ValueError(msg)
+        if self._pixels is not None:
+            # We want the raw pixel values, never masked arrays
+            self._pixels.set_auto_maskandscale(False)
+            # Files written before image data was stored don't have it
+            if mode == "a" and TSNC_DATA_VAR not in self.root.variables:
+                self.root.createVariable(TSNC_DATA_VAR, str, ("t",))
+        self._set_times(*self._read_times(self._time_var))
+
+    @classmethod
+    def create(cls, tsnc_path, name, extension, complevel=TSNC_COMPLEVEL,
+               tile=None):
+        """Create an empty v2 timestream, and open it for appending.
+
+        The pixel array is created when the first frame is flushed, as its
+        shape is only known then.
+        """
+        if ncdf is None:
+            msg = "netCDF4 must be installed to write v2 timestreams"
+            LOG.error(msg)
+            raise ImportError(msg)
+        root = ncdf.Dataset(tsnc_path, "w", format="NETCDF4")
+        root.createDimension("t", None)
+        time_var = root.createVariable("time", "f8", ("t",))
+        time_var.units = TSNC_TIME_UNITS
+        time_var.calendar = "standard"
+        root.setncattr("name", name)
+        root.setncattr("extension", extension)
+        root.close()
+        return cls(tsnc_path, mode="a", complevel=complevel, tile=tile)
+
+    def __contains__(self, date):
+        if np.datetime64(ts_parse_date(date), "s") in self._buffered:
+            return True
+        return self.frame_index(date) is not None
+
+    def __len__(self):
+        self.flush()
+        return len(self._times)
+
+    def __iter__(self):
+        self.flush()
+        for time in self._times:
+            yield time.item()
+
+    def __del__(self):
+        # Don't lose buffered frames if we are never closed
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @property
+    def extension(self):
+        return self.manifest["extension"]
+
+    @property
+    def times(self):
+        """Sorted ``datetime64[s]`` array of all images in the timestream"""
+        self.flush()
+        return self._times
+
+    def exists(self, times):
+        """Boolean mask of which of the ``datetime64`` ``times`` have an
+        image.
+        """
+        return np.in1d(times, self.times)
+
+    def _set_times(self, times, tidx):
+        """Set the timestamps of the frames in the file, and their ``t``
+        indices.
+        """
+        # Images are usually in order, but needn't be.
+        order = np.argsort(times, kind="mergesort")
+        self._order = tidx[order]
+        self._times = times[order]
+        self.manifest = self._make_manifest()
+
+    @staticmethod
+    def _read_times(time_var):
+        """Read the timestamps of the frames, and their ``t`` indices.
+
+        Time is written after the pixels of a frame, so frames without one
+        were never completely written, and are skipped.
+        """
+        values = time_var[:]
+        tidx = np.flatnonzero(~np.ma.getmaskarray(values))
+        values = np.ma.getdata(values)[tidx]
+        units = getattr(time_var, "units", TSNC_TIME_UNITS)
+        if units == TSNC_TIME_UNITS:
+            secs = np.round(np.asarray(values)).astype(np.int64)
+            return secs.astype("datetime64[s]"), tidx
+        calendar = getattr(time_var, "calendar", "standard")
+        dates = ncdf.num2date(values, units=units, calendar=calendar)
+        times = np.array([datetime(*d.timetuple()[:6]) for d in dates],
+                         dtype="datetime64[s]")
+        return times, tidx
+
+    def _make_manifest(self):
+        if not len(self._times) and self.mode == "r":
+            msg = "{} has no images".format(self.path)
+            LOG.error(msg)
+            raise ValueError(msg)
+        attrs = self.root.ncattrs()
+        if "name" in attrs:
+            name = str(self.root.getncattr("name"))
+        else:
+            name = path.splitext(path.basename(self.path))[0]
+        ext = TSNC_DEFAULT_EXT
+        if "extension" in attrs:
+            ext = str(self.root.getncattr("extension"))
+        gaps = np.diff(self._times).astype(np.int64)
+        gaps = gaps[gaps > 0]
+        interval = int(gaps.min()) if len(gaps) else 1
+        manifest = {
+            "name": name,
+            "version": 2,
+            "image_type": IMAGE_EXT_TO_TYPE[ext],
+            "extension": ext,
+            "interval": interval,
+            "missing": [],
+        }
+        if len(self._times):
+            manifest["start_datetime"] = ts_format_date(self._times[0].item())
+            manifest["end_datetime"] = ts_format_date(self._times[-1].item())
+        return manifest
+
+    def frame_index(self, date):
+        """The ``t`` index of the image at ``date``, or None"""
+        time = np.datetime64(ts_parse_date(date), "s")
+        pos = np.searchsorted(self._times, time)
+        if pos < len(self._times) and self._times[pos] == time:
+            return int(self._order[pos])
+        return None
+
+    def read(self, date, window=None):
+        """Read the pixels of the image at ``date``.
+
+        Args:
+          date(datetime or str): Timestamp of the image.
+          window(tuple): ``(y0, y1, x0, x1)``. If given, only read the pixels
+            in ``[y0:y1, x0:x1]``, which only touches the chunks they are in.
+
+        Returns:
+          ndarray: The pixels, as ``[y, x, z]``.
+
+        Raises:
+          KeyError: if there is no image at ``date``.
+        """
+        self.flush()
+        tidx = self.frame_index(date)
+        if tidx is None:
+            msg = "No image at {} in {}".format(ts_format_date(date),
+                                                self.path)
+            LOG.error(msg)
+            raise KeyError(msg)
+        if window is None:
+            return self._pixels[tidx, :, :, :]
+        y0, y1, x0, x1 = window
+        return self._pixels[tidx, y0:y1, x0:x1, :]
+
+    def image_data(self):
+        """The ``data`` of each image, keyed by formatted timestamp"""
+        self.flush()
+        if TSNC_DATA_VAR not in self.root.variables:
+            return {}
+        values = self.root.variables[TSNC_DATA_VAR][:]
+        image_data = {}
+        for tidx, time in zip(self._order, self._times):
+            if values[tidx]:
+                image_data[ts_format_date(time.item())] = \
+                    json.loads(values[tidx])
+        return image_data
+
+    def timestream_data(self):
+        """The ``data`` of the timestream, as stored by
+        ``set_timestream_data``.
+        """
+        if TSNC_TS_DATA_ATTR not in self.root.ncattrs():
+            return {}
+        return json.loads(self.root.getncattr(TSNC_TS_DATA_ATTR))
+
+    def set_timestream_data(self, data):
+        self._check_writable()
+        self.root.setncattr(TSNC_TS_DATA_ATTR, json.dumps(data))
+
+    def _check_writable(self):
+        if self.mode != "a":
+            msg = "{} was not opened for appending".format(self.path)
+            LOG.error(msg)
+            raise RuntimeError(msg)
+
+    def append(self, date, pixels, data=None):
+        """Add the image at ``date`` to the end of the timestream.
+
+        The frame is buffered, and written with the rest of the buffer once
+        there are ``TSNC_BUFFER_FRAMES`` frames or ``TSNC_BUFFER_BYTES``
+        bytes buffered, or when ``flush`` is called.
+
+        Args:
+          date(datetime): Timestamp of the image.
+          pixels(ndarray): ``[y, x, z]`` pixels of the image. All images must
+            have the same shape and dtype.
+          data(dict): JSON-serialisable data of the image.
+
+        Raises:
+          ValueError: if there is already an image at ``date``.
+        """
+        self._check_writable()
+        if date in self:
+            msg = "There is already an image at {} in {}".format(
+                ts_format_date(date), self.path)
+            LOG.error(msg)
+            raise ValueError(msg)
+        time = np.datetime64(ts_parse_date(date), "s")
+        self._buffer.append((time, np.asarray(pixels), data))
+        self._buffered.add(time)
+        nbytes = sum(frame.nbytes for _, frame, _ in self._buffer)
+        if len(self._buffer) >= TSNC_BUFFER_FRAMES or \
+                nbytes >= TSNC_BUFFER_BYTES:
+            self.flush()
+
+    def replace(self, date, pixels, data=None):
+        """Overwrite the existing image at ``date``"""
+        self._check_writable()
+        self.flush()
+        tidx = self.frame_index(date)
+        if tidx is None:
+            msg = "No image at {} in {}".format(ts_format_date(date),
+                                                self.path)
+            LOG.error(msg)
+            raise KeyError(msg)
+        self._pixels[tidx, :, :, :] = pixels
+        self.root.variables[TSNC_DATA_VAR][tidx] = json.dumps(data or {})
+
+    def _create_pixels(self, frame):
+        """Create the pixel array, chunked with one frame or tile per chunk"""
+        shape = frame.shape if frame.ndim == 3 else frame.shape + (1,)
+        for dim, size in zip(("y", "x", "z"), shape):
+            self.root.createDimension(dim, size)
+        chunks = shape
+        if self.tile is not None:
+            chunks = (min(self.tile[0], shape[0]),
+                      min(self.tile[1], shape[1]), shape[2])
+        self._pixels = self.root.createVariable(
+            "pixel", frame.dtype, ("t", "y", "x", "z"), zlib=True,
+            complevel=self.complevel, shuffle=True,
+            chunksizes=(1, ) + chunks)
+        self._pixels.set_auto_maskandscale(False)
+        if TSNC_DATA_VAR not in self.root.variables:
+            self.root.createVariable(TSNC_DATA_VAR, str, ("t",))
+
+    def flush(self):
+        """Write all buffered frames to the file.
+
+        The time of each frame is written last, so a frame is only seen once
+        its pixels and data are written. Frames stay buffered until they are
+        all written.
+        """
+        if not self._buffer:
+            return
+        times, frames, data = zip(*self._buffer)
+        frames = np.array(frames)
+        if frames.ndim == 3:
+            frames = frames[..., np.newaxis]
+        if self._pixels is None:
+            self._create_pixels(frames[0])
+        start = len(self.root.dimensions["t"])
+        end = start + len(frames)
+        times = np.array(times, dtype="datetime64[s]")
+        self._pixels[start:end, :, :, :] = frames
+        data_var = self.root.variables[TSNC_DATA_VAR]
+        for tidx, datum in enumerate(data, start):
+            data_var[tidx] = json.dumps(datum or {})
+        self._time_var[start:end] = times.astype(np.int64)
+        self.root.sync()
+        self._buffer = []
+        self._buffered = set()
+        self._set_times(np.concatenate([self._times, times]),
+                        np.concatenate([self._order, np.arange(start, end)]))
+
+    def close(self):
+        if self.root.isopen():
+            if self.mode == "a":
+                self.flush()
+            self.root.close()
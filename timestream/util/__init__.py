@@ -1,7 +1,13 @@
 import base64
+from collections import deque
+import hashlib
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import numpy as np
+import os
+from os import path
+import tempfile
 from warnings import warn
 
 # Error string constants
@@ -9,6 +15,11 @@ from warnings import warn
 PARAM_TYPE_ERR = "Param `{param}` to `{func}` must be a `{type}`"
 
 LOG = logging.getLogger("timestreamlib")
+#: Default number of threads used by imap_prefetch
+PREFETCH_THREADS = 4
+#: Arrays of at least this many bytes are written to ``.npy`` sidecars by
+#: jsonify_data, when given a sidecar directory
+SIDECAR_MIN_BYTES = 1 << 16
 
 try:
     isinstance(u"ABC", unicode)
@@ -77,24 +88,77 @@ def str2numpy(arr_str):
     return arr
 
 
-def dejsonify_data(data):
-    """Converd jsonified dict back to a real dict"""
-    if not isinstance(data, str):
-        msg = "dejsonify_data must be given a str`"
+def numpy2npy(array, sidecar_dir):
+    """Save a numpy array to a ``.npy`` file in ``sidecar_dir``, named by the
+    SHA-1 of its contents, so an array saved again is only stored once.
+
+    :returns: str -- The file name of the array, relative to ``sidecar_dir``.
+    """
+    if not isinstance(array, np.ndarray):
+        msg = "numpy2npy must be given a numpy array"
         LOG.error(msg)
         raise TypeError(msg)
-    data = json.loads(data)
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str(array.dtype) + str(array.shape))
+    digest.update(array.data)
+    fname = digest.hexdigest() + ".npy"
+    fpath = path.join(sidecar_dir, fname)
+    if not path.exists(fpath):
+        try:
+            os.makedirs(sidecar_dir)
+        except OSError:
+            # Another writer may have made it first
+            if not path.isdir(sidecar_dir):
+                raise
+        _write_atomic(fpath, lambda ofh: np.save(ofh, array), "wb")
+    return fname
+
+
+def _dejsonify_dict(data, sidecar_dir, mmap_mode):
     clean_dict = {}
     for key, val in data.items():
         if key.startswith("NP_ARR."):
             val = str2numpy(val)
             key = key[7:]
+        elif key.startswith("NP_NPY."):
+            if sidecar_dir is None:
+                msg = "Array {} is in a sidecar, but no sidecar_dir given"
+                msg = msg.format(key[7:])
+                LOG.error(msg)
+                raise ValueError(msg)
+            val = np.load(path.join(sidecar_dir, val), mmap_mode=mmap_mode)
+            key = key[7:]
+        elif isinstance(val, dict):
+            val = _dejsonify_dict(val, sidecar_dir, mmap_mode)
         clean_dict[key] = val
     return clean_dict
 
 
-def jsonify_data(data, recursive=False):
-    """Jsonify a dict that may contain numpy arrays"""
+def dejsonify_data(data, sidecar_dir=None, mmap_mode="r"):
+    """Converd jsonified dict back to a real dict
+
+    :param str data: The output of ``jsonify_data``.
+    :param str sidecar_dir: Directory of any ``.npy`` sidecars of the arrays.
+    :param str mmap_mode: Mode with which ``.npy`` sidecars are memory mapped,
+            or None to read them into memory. By default they are mapped
+            read-only, so are not copied.
+    """
+    if not isinstance(data, str):
+        msg = "dejsonify_data must be given a str`"
+        LOG.error(msg)
+        raise TypeError(msg)
+    return _dejsonify_dict(json.loads(data), sidecar_dir, mmap_mode)
+
+
+def jsonify_data(data, recursive=False, sidecar_dir=None,
+                 sidecar_min_bytes=SIDECAR_MIN_BYTES):
+    """Jsonify a dict that may contain numpy arrays
+
+    Arrays are base64 encoded into the JSON, unless ``sidecar_dir`` is given,
+    in which case those of at least ``sidecar_min_bytes`` are saved to
+    ``.npy`` files there, and only their file names are in the JSON. These
+    are memory mapped by ``dejsonify_data``, rather than decoded.
+    """
     if not isinstance(data, dict):
         msg = "jsonify_data must be given a dict"
         LOG.error(msg)
@@ -105,12 +169,82 @@ def jsonify_data(data, recursive=False):
             warn("All keys are coersed to strings")
             key = str(key)
         if isinstance(val, np.ndarray):
-            key = "NP_ARR.{}".format(key)
-            val = numpy2str(val)
+            if sidecar_dir is not None and val.nbytes >= sidecar_min_bytes:
+                key = "NP_NPY.{}".format(key)
+                val = numpy2npy(val, sidecar_dir)
+            else:
+                key = "NP_ARR.{}".format(key)
+                val = numpy2str(val)
         if isinstance(val, dict):
-            val = jsonify_data(val, recursive=True)
+            val = jsonify_data(val, recursive=True, sidecar_dir=sidecar_dir,
+                               sidecar_min_bytes=sidecar_min_bytes)
         clean_dict[key] = val
     if recursive:
         return clean_dict
     else:
         return json.dumps(clean_dict)
+
+
+def _write_atomic(fpath, write, mode="w"):
+    """Call ``write`` with a temporary file opened in ``mode``, then rename
+    the temporary file over ``fpath``.
+    """
+    # A unique name, so concurrent writers never share a temporary file
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(fpath)),
+                                    prefix=path.basename(fpath) + ".")
+    try:
+        with os.fdopen(fd, mode) as ofh:
+            write(ofh)
+            ofh.flush()
+            os.fsync(ofh.fileno())
+        # mkstemp creates files private to the user; keep the old mode
+        perms = os.stat(fpath).st_mode if path.exists(fpath) else 0o644
+        os.chmod(tmp_path, perms & 0o777)
+        os.rename(tmp_path, fpath)
+    finally:
+        # Only left behind if writing failed
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def json_dump_atomic(obj, fpath):
+    """Write ``obj`` as JSON to ``fpath``, via a temporary file which is
+    renamed over ``fpath``, so ``fpath`` is never left half-written.
+    """
+    _write_atomic(fpath, lambda ofh: json.dump(obj, ofh))
+
+
+def imap_prefetch(func, items, threads=PREFETCH_THREADS, prefetch=None):
+    """Map ``func`` over ``items`` in a pool of threads, in order.
+
+    Up to ``prefetch`` calls run ahead of the result last yielded, which
+    bounds the memory held by results that aren't consumed yet. An exception
+    raised by ``func`` is raised again when its result is reached.
+
+    :param func: Function of one item. Should release the GIL (e.g. image
+                 decoding or file IO) to gain from more than one thread.
+    :param items: Iterable of items, consumed lazily.
+    :param int threads: Number of threads. With 1 or less, map serially.
+    :param int prefetch: Maximum number of results computed ahead, defaults
+                         to twice ``threads``.
+    :returns: Generator of ``func(item)`` for each item, in order.
+    """
+    if threads is None or threads <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if prefetch is None:
+        prefetch = 2 * threads
+    prefetch = max(prefetch, 1)
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) > prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # Also reached if the consumer stops early, or func raised.
+        pool.terminate()
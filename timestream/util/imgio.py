@@ -0,0 +1,409 @@
+# Copyright 2014 Kevin Murray
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+.. module:: timestream.util.imgio
+    :platform: Unix, Windows
+    :synopsis: Decode images with whichever of OpenCV, Pillow or
+               scikit-image/FreeImage is fastest for their format.
+
+.. moduleauthor:: Kevin Murray <spam@kdmurray.id.au>
+"""
+
+from collections import OrderedDict
+import cv2
+import logging
+import numpy as np
+import os
+from os import path
+import threading
+import time
+
+from timestream.parse.validate import (
+    IMAGE_EXT_TO_TYPE,
+)
+
+LOG = logging.getLogger("timestreamlib")
+#: Number of times each decoder decodes the first image of a format, when
+#: picking the fastest
+CALIBRATE_ROUNDS = 3
+#: Most mean absolute difference from the pixels of the reference decoder
+#: that the pixels of another decoder may have, for it to be picked. Allows
+#: for JPEG decoders rounding differently.
+MATCH_TOLERANCE = 1.0
+#: Factors images can be downscaled by as they are decoded
+SCALES = (1, 2, 4, 8)
+#: Default number of bytes of pixels held by a PixelCache, including
+#: PIXEL_CACHE. Caching is disabled unless this, or the ``max_bytes`` of the
+#: cache, is set, as pipelines reading each image once never hit it.
+PIXEL_CACHE_BYTES = 0
+#: Bytes of pixels held by the caches of tools going back and forth over
+#: images, such as TimeStreamTraverser and the GUIs in util/
+INTERACTIVE_CACHE_BYTES = 512 * 2 ** 20
+#: Orders the channels of colour pixels can be in
+CHANNEL_ORDERS = ("RGB", "BGR")
+
+# Name of each decoder, to the decoding function, the image types it can
+# decode, the function decoding them downscaled, if it can, and the order of
+# the channels it decodes, in order of preference when they are as fast
+DECODERS = OrderedDict()
+# Name of the decoder picked for each lower case extension
+_CHOSEN = {}
+
+
+def register_decoder(name, func, image_types, reduced=None, order="RGB"):
+    """Register a function decoding images.
+
+    :param str name: Name of the decoder, as given to ``read_image``.
+    :param func: Function of the path to an image returning its pixels, as
+                 ``[y, x, channel]``. Raises ``ImportError`` if the library it
+                 needs isn't installed, and ``IOError`` or ``ValueError`` if
+                 the image can't be decoded.
+    :param list image_types: Image types (see ``IMAGE_EXT_TO_TYPE``) it can
+                             decode.
+    :param reduced: Function of the path to an image and a factor in
+                    ``SCALES`` returning its pixels downscaled by that
+                    factor, as it is decoded. Raises as ``func`` does,
+                    including if it can't downscale that image.
+    :param str order: Order of the channels of the pixels it returns, one of
+                      ``CHANNEL_ORDERS``.
+
+    Decoders registered earlier are preferred, see ``time_decoders``.
+    """
+    if order not in CHANNEL_ORDERS:
+        msg = "Channels can only be in one of the orders {}, not {}".format(
+            CHANNEL_ORDERS, order)
+        LOG.error(msg)
+        raise ValueError(msg)
+    DECODERS[name] = (func, set(image_types), reduced, order)
+    _CHOSEN.clear()
+
+
+def _decode_opencv(fpath):
+    # Keep the bit depth of raw images
+    pixels = cv2.imread(fpath, cv2.IMREAD_COLOR | cv2.IMREAD_ANYDEPTH)
+    if pixels is None:
+        raise IOError("OpenCV can't decode {}".format(fpath))
+    return pixels
+
+
+_REDUCED_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def _decode_opencv_reduced(fpath, scale):
+    # libjpeg decodes at 1/2, 1/4 or 1/8 scale directly, other formats would
+    # be decoded at full scale and resized, losing the bit depth of raw images
+    if _image_type(fpath)[1] != "jpg":
+        raise ValueError("OpenCV only decodes JPEGs downscaled")
+    pixels = cv2.imread(fpath, _REDUCED_FLAGS[scale])
+    if pixels is None:
+        raise IOError("OpenCV can't decode {}".format(fpath))
+    return pixels
+
+
+def _decode_pillow(fpath):
+    from PIL import Image
+    img = Image.open(fpath)
+    # Converting to RGB would clip images of more than 8 bits a channel
+    if img.mode in ("I", "F") or img.mode.startswith("I;"):
+        raise ValueError("Pillow only decodes 8-bit images, not {}".format(
+            img.mode))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return np.asarray(img)
+
+
+def _decode_freeimage(fpath):
+    import skimage.io
+    try:
+        return skimage.io.imread(fpath, plugin="freeimage")
+    except RuntimeError as exc:
+        raise IOError(str(exc))
+
+
+# OpenCV decodes to BGR, which is kept rather than flipped, see convert_order
+register_decoder("opencv", _decode_opencv, ["jpg", "png", "raw"],
+                 _decode_opencv_reduced, order="BGR")
+register_decoder("pillow", _decode_pillow, ["jpg", "png"])
+register_decoder("freeimage", _decode_freeimage, ["jpg", "png", "raw"])
+
+
+def convert_order(pixels, src, dst):
+    """Convert colour ``pixels`` with channels in the order ``src`` to the
+    order ``dst``, as a new contiguous array. ``pixels`` themselves are
+    returned if the orders are the same, or they aren't ``[y, x, 3]``.
+    """
+    for order in (src, dst):
+        if order not in CHANNEL_ORDERS:
+            msg = "Channels can only be in one of the orders {}, not {}"
+            msg = msg.format(CHANNEL_ORDERS, order)
+            LOG.error(msg)
+            raise ValueError(msg)
+    if src == dst or pixels.ndim != 3 or pixels.shape[2] != 3:
+        return pixels
+    # Swapping R and B is the same conversion either way
+    return cv2.cvtColor(np.ascontiguousarray(pixels), cv2.COLOR_BGR2RGB)
+
+
+def downscale(pixels, scale):
+    """Downscale ``pixels`` by ``scale``, averaging each ``scale`` by
+    ``scale`` block, to the size an image is decoded at by ``read_image``.
+    """
+    if scale == 1:
+        return pixels
+    height, width = pixels.shape[:2]
+    size = ((width + scale - 1) // scale, (height + scale - 1) // scale)
+    return cv2.resize(np.ascontiguousarray(pixels), size,
+                      interpolation=cv2.INTER_AREA)
+
+
+def _image_type(fpath):
+    ext = path.splitext(fpath)[1].lstrip(".")
+    return ext.lower(), IMAGE_EXT_TO_TYPE.get(ext)
+
+
+def decoders_for(fpath):
+    """Names of the decoders which may decode ``fpath``, by its extension"""
+    image_type = _image_type(fpath)[1]
+    return [name for name in DECODERS
+            if image_type is None or image_type in DECODERS[name][1]]
+
+
+def _matches(reference, pixels):
+    """Whether RGB ``pixels`` are those of RGB ``reference``, to within
+    ``MATCH_TOLERANCE``.
+    """
+    if pixels.dtype != reference.dtype or pixels.shape != reference.shape:
+        return False
+    diff = cv2.absdiff(np.ascontiguousarray(reference),
+                       np.ascontiguousarray(pixels))
+    return diff.mean() <= MATCH_TOLERANCE
+
+
+def time_decoders(fpath, rounds=CALIBRATE_ROUNDS):
+    """Time each decoder which may decode ``fpath``.
+
+    The first decoder registered which decodes ``fpath`` is the reference,
+    and the others are only timed if the pixels they decode have the same
+    dtype and shape as those of the reference, and about the same values
+    (see ``MATCH_TOLERANCE``), so the pixels of an image don't depend on
+    which decoder is fastest.
+
+    :returns: list -- ``(seconds, name, pixels)`` of each decoder which
+              decoded ``fpath`` as the reference did, fastest first, where
+              ``seconds`` is its quickest time, and ``pixels`` are in its
+              order of channels.
+    """
+    times = []
+    reference = None
+    for preference, name in enumerate(decoders_for(fpath)):
+        func, _, _, order = DECODERS[name]
+        best = None
+        try:
+            for _ in range(rounds):
+                start = time.time()
+                pixels = func(fpath)
+                taken = time.time() - start
+                if best is None or taken < best:
+                    best = taken
+        except (ImportError, IOError, ValueError) as exc:
+            LOG.debug("Decoder {} can't decode {}: {}".format(name, fpath,
+                                                              exc))
+            continue
+        rgb = convert_order(pixels, order, "RGB")
+        if reference is None:
+            reference = (name, rgb)
+        elif not _matches(reference[1], rgb):
+            LOG.debug("Decoder {} decodes {} differently from {}".format(
+                name, fpath, reference[0]))
+            continue
+        times.append((best, preference, name, pixels))
+    times.sort(key=lambda x: x[:2])
+    return [(x[0], x[2], x[3]) for x in times]
+
+
+def _read_reduced(fpath, decoder, scale):
+    if decoder is None:
+        names = [x for x in decoders_for(fpath) if DECODERS[x][2] is not None]
+    elif decoder in DECODERS and DECODERS[decoder][2] is not None:
+        names = [decoder]
+    else:
+        names = []
+    for name in names:
+        try:
+            return DECODERS[name][2](fpath, scale), DECODERS[name][3]
+        except (ImportError, IOError, ValueError) as exc:
+            LOG.debug("Decoder {} can't downscale {}: {}".format(name, fpath,
+                                                                 exc))
+    pixels, order = decode_image(fpath, decoder)
+    return downscale(pixels, scale), order
+
+
+def decode_image(fpath, decoder=None, scale=1):
+    """Decode the image at ``fpath``, with its channels in whichever order
+    the decoder gives them, so they aren't copied to reorder them.
+
+    Unless ``decoder`` is given, the first image of each format is decoded by
+    each decoder which may decode it (see ``time_decoders``), and whichever
+    is fastest of those decoding it as the preferred decoder does is used
+    for every image of that format after.
+
+    With a ``scale`` above 1, the image is downscaled by that factor, while
+    it is decoded if the decoder can (as OpenCV can for JPEGs), which is much
+    faster than decoding the whole image. Otherwise the whole image is
+    decoded and resized, see ``downscale``.
+
+    :param str fpath: Path to the image.
+    :param str decoder: Name of the decoder to use.
+    :param int scale: Factor in ``SCALES`` to downscale the image by.
+    :returns: tuple -- ``(pixels, order)``, the pixels as ``[y, x,
+              channel]``, and the order of their channels, one of
+              ``CHANNEL_ORDERS``.
+    :raises: IOError, ValueError
+    """
+    if scale not in SCALES:
+        msg = "Images can only be downscaled by one of {}, not {}".format(
+            SCALES, scale)
+        LOG.error(msg)
+        raise ValueError(msg)
+    if scale > 1:
+        return _read_reduced(fpath, decoder, scale)
+    if decoder is not None:
+        try:
+            func = DECODERS[decoder][0]
+        except KeyError:
+            msg = "Unknown image decoder {}".format(decoder)
+            LOG.error(msg)
+            raise ValueError(msg)
+        return func(fpath), DECODERS[decoder][3]
+    ext, _ = _image_type(fpath)
+    if ext in _CHOSEN:
+        func, _, _, order = DECODERS[_CHOSEN[ext]]
+        return func(fpath), order
+    times = time_decoders(fpath)
+    if not times:
+        msg = "No decoder can decode {}".format(fpath)
+        LOG.error(msg)
+        raise IOError(msg)
+    _CHOSEN[ext] = times[0][1]
+    LOG.info("Decoding .{} images with {}".format(ext, _CHOSEN[ext]))
+    return times[0][2], DECODERS[_CHOSEN[ext]][3]
+
+
+def read_image(fpath, decoder=None, scale=1, order="RGB"):
+    """As ``decode_image``, returning only the pixels, with their channels in
+    ``order``, converted if the decoder gives them in another.
+
+    :returns: numpy.ndarray -- The pixels, as ``[y, x, channel]``.
+    :raises: IOError, ValueError
+    """
+    pixels, decoded = decode_image(fpath, decoder, scale)
+    return convert_order(pixels, decoded, order)
+
+
+class PixelCache(object):
+
+    def __init__(self, max_bytes=PIXEL_CACHE_BYTES):
+        """Decoded pixels of images, least recently used dropped first.
+
+        Pixels are kept in the order of channels they are decoded in, and
+        keyed by the path and modification time of the image file, the
+        decoder and the factor they are downscaled by, so an image which is
+        rewritten is decoded again. Each read returns its own copy of the
+        cached pixels, which can be changed in place. It is safe to use from
+        more than one thread.
+
+        Args:
+          max_bytes(int): Most bytes of pixels to hold. 0, the default,
+            disables the cache.
+
+        Attributes:
+          hits(int): Number of reads of pixels that were cached.
+          misses(int): Number of reads of pixels that had to be decoded.
+          nbytes(int): Number of bytes of pixels held.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._pixels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pixels)
+
+    def clear(self):
+        """Drop all pixels, and reset the counters"""
+        with self._lock:
+            self._pixels.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self, nbytes):
+        """Drop pixels until another ``nbytes`` fit"""
+        while self._pixels and self.nbytes + nbytes > self.max_bytes:
+            _, (pixels, _) = self._pixels.popitem(last=False)
+            self.nbytes -= pixels.nbytes
+
+    def decode(self, fpath, decoder=None, scale=1):
+        """As ``decode_image``, returning a copy of the cached ``(pixels,
+        order)`` if there are any, otherwise caching those decoded.
+        """
+        if self.max_bytes <= 0:
+            return decode_image(fpath, decoder, scale)
+        try:
+            key = (path.abspath(fpath), os.stat(fpath).st_mtime, decoder,
+                   scale)
+        except OSError:
+            # Let decode_image raise that there is no such image
+            key = None
+        with self._lock:
+            cached = self._pixels.pop(key, None)
+            if cached is not None:
+                # Most recently used last
+                self._pixels[key] = cached
+                self.hits += 1
+                return cached[0].copy(), cached[1]
+            self.misses += 1
+        # Not under the lock, so other threads can decode meanwhile
+        pixels, order = decode_image(fpath, decoder, scale)
+        if key is None or pixels.nbytes > self.max_bytes:
+            return pixels, order
+        # The cached copy is never handed out, so is never changed
+        cached = pixels.copy()
+        cached.flags.writeable = False
+        with self._lock:
+            if key not in self._pixels:
+                self._evict(cached.nbytes)
+                self._pixels[key] = (cached, order)
+                self.nbytes += cached.nbytes
+        return pixels, order
+
+    def read(self, fpath, decoder=None, scale=1, order="RGB"):
+        """As ``read_image``, converting the pixels to ``order`` if they are
+        cached in another.
+        """
+        pixels, decoded = self.decode(fpath, decoder, scale)
+        return convert_order(pixels, decoded, order)
+
+
+#: The cache of pixels read by TimeStreamImage, shared by all its instances.
+#: Disabled unless its ``max_bytes`` is set.
+PIXEL_CACHE = PixelCache()
@@ -43,6 +43,29 @@ def v_date(x, format="%Y_%m_%d"):
         return datetime.datetime.strptime(x, format)
 
 
+def strptime_fixed(x):
+    """Parse a date in ``%Y_%m_%d_%H_%M_%S`` format.
+
+    The fields are fixed-width, so they are sliced out directly, which is
+    several times faster than ``datetime.datetime.strptime``. Anything that
+    doesn't look right is passed on to ``strptime`` to raise the error.
+
+    :arg str x: String to parse.
+    :returns:  the parsed object
+    :rtype: datetime.datetime
+    :raises: ``ValueError``
+    """
+    if len(x) == 19 and x[4::3] == "_____" and \
+            x.replace("_", "").isdigit():
+        try:
+            return datetime.datetime(int(x[0:4]), int(x[5:7]), int(x[8:10]),
+                                     int(x[11:13]), int(x[14:16]),
+                                     int(x[17:19]))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(x, "%Y_%m_%d_%H_%M_%S")
+
+
 def v_datetime(x, format="%Y_%m_%d_%H_%M_%S"):
     """Validate string contains a date in ``fmt`` strptime-compatible format,
     and coerce to a ``datetime.datetime`` object.
@@ -55,6 +78,8 @@ def v_datetime(x, format="%Y_%m_%d_%H_%M_%S"):
     """
     if isinstance(x, datetime.datetime):
         return x
+    elif format == "%Y_%m_%d_%H_%M_%S":
+        return strptime_fixed(x)
     else:
         return datetime.datetime.strptime(x, format)
 
@@ -1,28 +1,21 @@
-import skimage.io as skimgio
-import cv2
-import time
-ROUNDS = 1
+from __future__ import print_function
+import sys
 
-def load_scikit(img):
-    a = skimgio.imread(img, plugin="freeimage")
-    skimgio.imsave("./scikit.tiff", a, plugin="freeimage")
-    print a.shape, a.dtype
+from timestream.util.imgio import (
+    decoders_for,
+    time_decoders,
+)
+ROUNDS = 3
 
-def load_cv(img):
-    a = cv2.imread(img, -2)
-    cv2.imwrite("./cv2.tiff", a)
-    print a.shape, a.dtype
 
 def main(img):
-    start = time.time()
-    for _ in range(ROUNDS):
-        load_scikit(img)
-    print "Scikit image took {:.4f} seconds".format(time.time() - start)
-    start = time.time()
-    for _ in range(ROUNDS):
-        load_cv(img)
-    print "OpenCV took {:.4f} seconds".format(time.time() - start)
+    times = time_decoders(img, rounds=ROUNDS)
+    for taken, name, pixels in times:
+        print("{} took {:.4f} seconds, giving {} {}".format(
+            name, taken, pixels.shape, pixels.dtype))
+    failed = set(decoders_for(img)) - set(x[1] for x in times)
+    for name in sorted(failed):
+        print("{} couldn't decode {}".format(name, img))
 
 if __name__ == "__main__":
-    import sys
     main(sys.argv[1])
@@ -0,0 +1,45 @@
+from __future__ import print_function
+import os
+from os import path
+from sys import argv
+import time
+
+from timestream.parse import all_files_with_ext
+
+THREADS = [1, 2, 4, 8, 16, 32]
+
+
+def walk_files_with_ext(topdir, ext):
+    """The serial os.walk scanner all_files_with_ext used to use"""
+    for root, folders, files in os.walk(topdir):
+        folders.sort()
+        files.sort()
+        folders[:] = [x for x in folders if not x.startswith("_")]
+        for fpath in files:
+            if path.splitext(fpath)[1][1:].lower() == ext:
+                yield path.join(root, fpath)
+
+
+def time_scan(scanner):
+    start = time.time()
+    count = sum(1 for _ in scanner)
+    return time.time() - start, count
+
+
+def main():
+    """Usage: benchmark_scan_ts.py TS_PATH EXT
+
+    Run on a cold cache (e.g. a freshly mounted network share) to see the
+    effect of directory listing latency.
+    """
+    ts_path, ext = argv[1], argv[2].lower()
+    base, count = time_scan(walk_files_with_ext(ts_path, ext))
+    print("os.walk found {} files in {:.3f}s".format(count, base))
+    for threads in THREADS:
+        took, count = time_scan(all_files_with_ext(ts_path, ext,
+                                                   threads=threads))
+        print("{:2d} threads found {} files in {:.3f}s ({:.2f}x)".format(
+            threads, count, took, base / took))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+from __future__ import print_function
+import os
+from os import path
+from sys import argv
+import time
+
+from timestream.manipulate.netcdf import ts_to_tsnc
+from timestream.parse import ts_iter_images
+
+THREADS = [1, 2, 4, 8]
+COMPLEVELS = [1, 4]
+TILES = [None, (512, 512)]
+
+
+def main():
+    """Usage: benchmark_ts_to_tsnc.py TS_PATH OUT_DIR
+
+    Converts the timestream at TS_PATH with each combination of settings,
+    writing to OUT_DIR, and reports the throughput of each.
+    """
+    ts_path, out_dir = argv[1], argv[2]
+    in_bytes = sum(path.getsize(img) for img in ts_iter_images(ts_path))
+    for complevel in COMPLEVELS:
+        for tile in TILES:
+            for threads in THREADS:
+                out = path.join(out_dir, "bench-{}-{}-{}.nc".format(
+                    complevel, tile and tile[0], threads))
+                if path.exists(out):
+                    os.remove(out)
+                start = time.time()
+                count = ts_to_tsnc(ts_path, out, threads=threads,
+                                   complevel=complevel, tile=tile,
+                                   resume=False)
+                took = time.time() - start
+                print("complevel {} tile {} threads {:2d}: {:.2f} images/s, "
+                      "{:.1f} MB/s read, {:.1f} MB written".format(
+                          complevel, tile, threads, count / took,
+                          in_bytes / took / 2 ** 20,
+                          path.getsize(out) / 2.0 ** 20))
+                os.remove(out)
+
+if __name__ == "__main__":
+    main()
@@ -198,26 +198,42 @@ if plConf.general.hasSubSecName("endHourRange"):
 else:
     endHourRange = None #datetime.time(23,59,59)
 
-for img in ts.iter_by_timepoints(remove_gaps=False, start=startDate,
-                                 end=endDate, interval=timeInterval,
-                                 start_hour = startHourRange, end_hour = endHourRange,
-                                 ignored_timestamps = ignored_timestamps):
-
-    if len(img.pixels) == 0:
-        print('Missing image at {}'.format(img.datetime))
-        continue
-
-    # Detach img from timestream. We don't need it!
-    img.parent_timestream = None
-    print("Process", img.path, '...'),
-    print("Time stamp", img.datetime)
-    ctx.setVal("origImg", img)
-    try:
-        result = pl.process(ctx, [img], visualise)
-    except PCExBrakeInPipeline as bip:
-        print(bip.message)
-        continue
-    print("Done")
+# Number of images to decode ahead of the one being processed
+if plConf.general.hasSubSecName("prefetch"):
+    prefetch = plConf.general.prefetch
+else:
+    prefetch = 2
+
+# Components such as writefeatures_ndarray only write their output on
+# close, so close the pipeline even if processing stops early
+try:
+    for img in ts.iter_by_timepoints(remove_gaps=False, start=startDate,
+                                     end=endDate, interval=timeInterval,
+                                     start_hour = startHourRange, end_hour = endHourRange,
+                                     ignored_timestamps = ignored_timestamps,
+                                     prefetch = prefetch):
+
+        if len(img.pixels) == 0:
+            print('Missing image at {}'.format(img.datetime))
+            continue
+
+        # Detach img from timestream. We don't need it!
+        img.parent_timestream = None
+        print("Process", img.path, '...'),
+        print("Time stamp", img.datetime)
+        ctx.setVal("origImg", img)
+        try:
+            result = pl.process(ctx, [img], visualise)
+        except PCExBrakeInPipeline as bip:
+            print(bip.message)
+            continue
+        print("Done")
+finally:
+    pl.close()
+
+# Compact the metadata of the output timestreams
+for k, outstream in plConf.outstreams.asDict().iteritems():
+    ctx.getVal("outts." + outstream["name"]).close()
 
 # Example of the 2 yaml configuration files:
 #
@@ -18,6 +18,7 @@ import cv2
 import numpy as np
 import timestream
 import timestream.manipulate.correct_detect as cd
+from timestream.util.imgio import INTERACTIVE_CACHE_BYTES, PixelCache
 import yaml
 from timestream.manipulate import pipeline
 
@@ -232,6 +233,7 @@ class Window(QtGui.QDialog):
         if len(self.timestreamRootPath) > 0:
             self.status.append('Initialise a timestream at ' + str(self.timestreamRootPath))
             self.ts = timestream.TimeStream()
+            self.ts.pixel_cache = PixelCache(INTERACTIVE_CACHE_BYTES)
             self.ts.load(self.timestreamRootPath)
             self.status.append('Done')
             startDate = None
@@ -252,6 +254,7 @@ class Window(QtGui.QDialog):
         if len(self.timestreamRootPath) > 0:
             self.status.append('Initialise a timestream at ' + str(self.timestreamRootPath))
             self.ts = timestream.TimeStream()
+            self.ts.pixel_cache = PixelCache(INTERACTIVE_CACHE_BYTES)
             self.ts.load(self.timestreamRootPath)
             self.status.append('Done')
             self.tsImages = self.ts.iter_by_files()
@@ -0,0 +1,18 @@
+from __future__ import print_function
+from sys import argv
+
+from timestream.parse.imgdb import ts_image_data_to_sqlite
+
+
+def main():
+    """Usage: ts_image_data_to_sqlite.py TS_PATH [TS_PATH ...]
+
+    Moves the image metadata of each v1 timestream from image_data.json into
+    an SQLite database under its _data directory.
+    """
+    for ts_path in argv[1:]:
+        count = ts_image_data_to_sqlite(ts_path)
+        print("{}: moved data of {} images".format(ts_path, count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+from __future__ import print_function
+from sys import argv
+
+from timestream.parse.imgshards import ts_shard_image_data
+
+
+def main():
+    """Usage: ts_shard_image_data.py [day|month] TS_PATH [TS_PATH ...]
+
+    Moves the image metadata of each v1 timestream from image_data.json into
+    a JSON file per day (the default) or month under its _data directory.
+    """
+    args = argv[1:]
+    by = "day"
+    if args and args[0] in ("day", "month"):
+        by = args.pop(0)
+    for ts_path in args:
+        count = ts_shard_image_data(ts_path, by=by)
+        print("{}: moved data of {} images".format(ts_path, count))
+
+if __name__ == "__main__":
+    main()